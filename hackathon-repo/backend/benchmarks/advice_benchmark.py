@@ -0,0 +1,341 @@
+"""
+Benchmarks of the advice pipeline and its endpoints.
+
+Measures the per-stage timings of `advice_engine`, which serves the advice endpoints, and of the
+legacy `anomaly_detector.SpendingAnalyzer`, and the end-to-end latency and throughput of the
+advice endpoints through the FastAPI app, and writes the results as JSON:
+
+    python -m benchmarks.advice_benchmark --users 1 2 12 --output benchmarks/results/run.json
+    python -m benchmarks.advice_benchmark --compare benchmarks/results/run.json
+
+Run it from the backend directory. The eKasa API is replaced by the local fake server unless
+--live-ekasa is given, and the result/receipt caches live in a temporary directory, so the first
+request of every user is a cold one. Use DATA_DIR to benchmark another (e.g. generated) dataset.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+RESULTS_DIR = 'benchmarks/results'
+
+# Stages of the advice engine, which serves /advices, in the order a cold request runs them
+ENGINE_STAGES = [
+    'load_snapshot',
+    'build_spending_cube',
+    'score_window',
+    'product_anomalies',
+    'compute_advice',
+    'find_anomalous_products',
+    'find_user_product_anomalies',
+]
+
+# Stages of the legacy SpendingAnalyzer
+STAGES = [
+    'preprocess_data',
+    'calculate_user_spending',
+    'calculate_main_category_statistics',
+    'calculate_subcategory_statistics',
+    'calculate_anomalies',
+    'analyze_anomalies',
+    'save_all_data_to_csv',
+]
+
+ENDPOINTS = ['/advices', '/get_expense_categories', '/get_discounted_categories']
+
+# Metrics where a higher value is better, all others are durations
+HIGHER_IS_BETTER = {'requests_per_second'}
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    """
+    Summary statistics of a list of durations in seconds.
+    """
+    values = np.asarray(durations, dtype=float)
+    if not len(values):
+        return {'runs': 0}
+    return {
+        'runs': int(len(values)),
+        'total': float(values.sum()),
+        'mean': float(values.mean()),
+        'median': float(np.median(values)),
+        'p95': float(np.percentile(values, 95)),
+        'min': float(values.min()),
+        'max': float(values.max()),
+    }
+
+
+def timed(function: Callable, *args, **kwargs) -> float:
+    """
+    Runs the function with its output suppressed and returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchmark_engine_stages(spending_file: str, user_ids: List[int], repeats: int) -> Dict[str, dict]:
+    """
+    Times the stages of the advice engine on a fresh snapshot per repeat: loading it, building
+    its spending cube and scoring the cohort (cohort_scoring.score_window) and its product
+    anomalies once, then the advice and the product drilldowns of every user on the scored
+    snapshot, as the API serves them.
+    """
+    from ml_services.advice_engine import (compute_advice, find_anomalous_products, find_user_product_anomalies,
+                                           get_product_anomalies, load_snapshot, resolve_year)
+    from ml_services.cohort_scoring import score_window
+    from ml_services.incremental_aggregates import get_live_spending
+    from ml_services.receipt_item_index import receipt_item_index
+    from ml_services.spending_cube import build_spending_cube, get_spending_cube
+
+    # Loaded once when the API starts
+    receipt_item_index.get()
+
+    durations: Dict[str, List[float]] = {stage: [] for stage in ENGINE_STAGES}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        snapshot = load_snapshot(spending_file)
+        durations['load_snapshot'].append(time.perf_counter() - start)
+
+        durations['build_spending_cube'].append(timed(build_spending_cube, snapshot.data))
+        year = resolve_year(snapshot)
+        durations['score_window'].append(timed(score_window, get_spending_cube(snapshot), year, 10))
+        durations['product_anomalies'].append(timed(get_product_anomalies, snapshot, year, 10))
+        # The scores the requests read, built once per snapshot like in the API
+        get_live_spending(snapshot).scores(year, 10)
+
+        for user_id in user_ids:
+            start = time.perf_counter()
+            advice = compute_advice(snapshot, user_id, 10, year)
+            durations['compute_advice'].append(time.perf_counter() - start)
+            durations['find_anomalous_products'].append(timed(find_anomalous_products, snapshot, advice))
+            durations['find_user_product_anomalies'].append(timed(find_user_product_anomalies, snapshot, advice))
+
+    return {stage: summarize(values) for stage, values in durations.items()}
+
+
+def benchmark_stages(spending_file: str, user_ids: List[int], repeats: int) -> Dict[str, dict]:
+    """
+    Times the construction and every analysis step of SpendingAnalyzer, in pipeline order.
+    """
+    from ml_services.anomaly_detector import SpendingAnalyzer
+
+    # The analyzer writes its CSV reports here
+    os.makedirs('ml_services/output', exist_ok=True)
+
+    durations: Dict[str, List[float]] = {'load_dataset': [], **{stage: [] for stage in STAGES}}
+    for _ in range(repeats):
+        for user_id in user_ids:
+            start = time.perf_counter()
+            analyzer = SpendingAnalyzer(file_path=spending_file, user_id=user_id)
+            durations['load_dataset'].append(time.perf_counter() - start)
+
+            for stage in STAGES:
+                durations[stage].append(timed(getattr(analyzer, stage)))
+
+    return {stage: summarize(values) for stage, values in durations.items()}
+
+
+def benchmark_endpoint(client, path: str, user_ids: List[int], requests: int, concurrency: int) -> dict:
+    """
+    Latency of the first (cold) and repeated (warm) requests of every user, and the throughput of
+    `requests` warm requests sent by `concurrency` threads.
+    """
+    def request(user_id: int) -> float:
+        start = time.perf_counter()
+        response = client.get(path, params={'user_id': user_id})
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        return elapsed
+
+    cold = [request(user_id) for user_id in user_ids]
+    warm = [request(user_id) for user_id in user_ids]
+
+    schedule = [user_ids[i % len(user_ids)] for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(request, schedule))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'cold': summarize(cold),
+        'warm': summarize(warm),
+        'under_load': summarize(latencies),
+        'concurrency': concurrency,
+        'requests_per_second': requests / elapsed if elapsed else None,
+    }
+
+
+def benchmark_endpoints(user_ids: List[int], requests: int, concurrency: int) -> Dict[str, dict]:
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        return {path: benchmark_endpoint(client, path, user_ids, requests, concurrency) for path in ENDPOINTS}
+
+
+def describe_dataset(spending_file: str) -> dict:
+    """
+    Size of the dataset, and the memory its spending rows take as parsed from the CSV, prepared
+    and in the compact layout the advice snapshot keeps (per column, see dataset_store.memory_report).
+    """
+    from ml_services.dataset_store import (COMPACT_SOURCE_COLUMNS, compact_spending_data, dataset_version,
+                                           memory_report, read_dataset)
+
+    data = read_dataset(spending_file, columns=COMPACT_SOURCE_COLUMNS)
+    layouts = {
+        'csv': pd.read_csv(spending_file),
+        'prepared': data,
+        'compact': compact_spending_data(data),
+    }
+    memory_bytes = {}
+    for name, frame in layouts.items():
+        report = memory_report(frame)
+        memory_bytes[name] = dict(zip(report['column'], report['bytes'].astype(int).tolist()))
+
+    return {
+        'file': spending_file,
+        'version': dataset_version(spending_file),
+        'rows': int(len(data)),
+        'users': int(data['customer_id'].nunique()),
+        'receipts': int(data['receipt_id'].nunique()),
+        'memory_bytes': memory_bytes,
+    }
+
+
+def _flatten(results: dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.3) -> List[str]:
+    """
+    Lists the medians, p95s and throughputs that got worse than the baseline by more than
+    `tolerance` (relative).
+    """
+    baseline_metrics, current_metrics = _flatten(baseline), _flatten(current)
+    regressions = []
+    for name, value in current_metrics.items():
+        metric = name.rsplit('.', 1)[-1]
+        if metric not in ('median', 'p95', *HIGHER_IS_BETTER):
+            continue
+        old_value = baseline_metrics.get(name)
+        if not old_value or value is None:
+            continue
+
+        change = value / old_value - 1
+        if metric in HIGHER_IS_BETTER:
+            change = -change
+        if change > tolerance:
+            regressions.append(f'{name}: {old_value:.6g} -> {value:.6g} ({change:+.0%} worse)')
+    return regressions
+
+
+def _isolate_environment(live_ekasa: bool):
+    """
+    Points the caches and the receipt journal at a temporary directory and, unless `live_ekasa`,
+    the receipt API at the fake server. Must run before the application modules are imported.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='advice-benchmark-')
+    os.environ['RESULTS_DB'] = os.path.join(cache_dir, 'results.sqlite')
+    os.environ['RECEIPT_ITEMS_DB'] = os.path.join(cache_dir, 'receipt_items.sqlite')
+    os.environ['INGESTED_RECEIPTS_DB'] = os.path.join(cache_dir, 'ingested_receipts.sqlite')
+    os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite:///:memory:')
+
+    if live_ekasa:
+        return contextlib.nullcontext()
+
+    # The URL is read when the settings are imported, so the port is reserved up front
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    os.environ['EKASA_RECEIPT_URL'] = f'http://127.0.0.1:{port}/mdu/api/v1/opd/receipt/find'
+
+    from ml_services.fake_ekasa_server import FakeEkasaServer, receipts_from_local_data
+
+    return FakeEkasaServer(receipts_from_local_data(), port=port)
+
+
+def run(user_ids: List[int], repeats: int, requests: int, concurrency: int, live_ekasa: bool) -> dict:
+    with _isolate_environment(live_ekasa):
+        from ml_services.advice_engine import SPENDING_DATA_FILE
+
+        return {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'dataset': describe_dataset(SPENDING_DATA_FILE),
+            'users': user_ids,
+            'ekasa': 'live' if live_ekasa else 'fake',
+            'engine_stages': benchmark_engine_stages(SPENDING_DATA_FILE, user_ids, repeats),
+            'stages': benchmark_stages(SPENDING_DATA_FILE, user_ids, repeats),
+            'endpoints': benchmark_endpoints(user_ids, requests, concurrency),
+        }
+
+
+def main(arguments: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the advice pipeline and endpoints.")
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 2, 12])
+    parser.add_argument('--repeats', type=int, default=3, help="runs of the advice engine and SpendingAnalyzer stages")
+    parser.add_argument('--requests', type=int, default=200, help="requests per endpoint in the throughput run")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--live-ekasa', action='store_true', help="call the real eKasa API")
+    parser.add_argument('--output', help=f"result file, by default a timestamped file in {RESULTS_DIR}")
+    parser.add_argument('--compare', help="earlier result file to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="relative slowdown reported as a regression")
+    options = parser.parse_args(arguments)
+
+    results = run(options.users, options.repeats, options.requests, options.concurrency, options.live_ekasa)
+
+    output = options.output or os.path.join(RESULTS_DIR, f"advice-{datetime.now():%Y%m%d-%H%M%S}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    for layout, columns in results['dataset']['memory_bytes'].items():
+        print(f"{layout + ' rows':<40} {columns['total'] / 2 ** 20:9.2f} MiB")
+    for stage, timings in results['engine_stages'].items():
+        print(f"{'advice_engine.' + stage:<40} median {timings['median'] * 1000:9.2f} ms")
+    for stage, timings in results['stages'].items():
+        print(f"{stage:<40} median {timings['median'] * 1000:9.2f} ms")
+    for path, timings in results['endpoints'].items():
+        print(f"{path:<40} cold {timings['cold']['median'] * 1000:9.2f} ms, "
+              f"warm {timings['warm']['median'] * 1000:9.2f} ms, {timings['requests_per_second']:.1f} req/s")
+
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+        if baseline['dataset']['rows'] != results['dataset']['rows']:
+            print(f"Note: the baseline ran on {baseline['dataset']['rows']} rows, this run on "
+                  f"{results['dataset']['rows']} rows")
+        regressions = compare(baseline, results, options.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,73 +1,215 @@
-import os
+import asyncio
+import json
+from typing import List, Literal, Optional, Union
+
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from ml_services.advice_engine import spending_snapshot, compute_advice_batch, find_advice_result, resolve_year
+from ml_services.analysis_pool import PoolSaturated, advice_result, analysis_pool
+from ml_services.incremental_aggregates import get_live_spending
+from ml_services.savings_engine import savings_table
+from ml_services.spending_cube import period_ordinal
+
+# Fields of the product anomalies returned by /get_anomaly_product
+PRODUCT_ANOMALY_FIELDS = ['product_name', 'quantity', 'historical_avg_quantity', 'quantity_z_score', 'is_new_product',
+                          'issue_date', 'message']
 
-import pandas as pd
-from fastapi import APIRouter
-from ml_services.anomaly_detector import analyzer
-from ml_services.saving_categorizator import saving_categorizator
 advice_router = APIRouter()
 
+
+async def run_analysis(key: tuple, function, *args):
+    """
+    Runs an analysis in the worker pool, joining an identical one that is already running.
+    """
+    try:
+        return await analysis_pool.run(key, function, *args)
+    except PoolSaturated as e:
+        raise HTTPException(status_code=503, detail=f"Too many analyses in progress: {e}", headers={"Retry-After": "1"})
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def find_stored_advice(user_id: int, month: int, year: Optional[int]):
+    """
+    The version of the user's results, the resolved year and the stored advice result (None
+    if missing). Attaching the snapshot, applying new receipts and reading the store all block.
+    """
+    snapshot = spending_snapshot.get()
+    live = get_live_spending(snapshot)
+    live.sync()
+    if not live.has_user(user_id):
+        raise HTTPException(status_code=404, detail=f"User {user_id} does not exist in the dataset.")
+
+    year = resolve_year(snapshot, year)
+    return live.result_version(user_id), year, find_advice_result(snapshot, user_id, month, year)
+
+
+async def load_advice_result(user_id: int, month: int, year: Optional[int]):
+    # Stored results are served directly, only missing ones go to the worker pool; the lookup
+    # runs in a thread, so the event loop is not blocked meanwhile
+    version, year, result = await asyncio.to_thread(find_stored_advice, user_id, month, year)
+    if result is None:
+        key = ("advice", user_id, year, month, version)
+        result = await run_analysis(key, advice_result, user_id, month, year, version)
+    return result
+
+
 @advice_router.get("/advices")
-def get_advice(user_id: int = 12):
-    analyzer.user_id = user_id
-    analyzer.preprocess_data()
-    analyzer.calculate_user_spending()
-    analyzer.calculate_main_category_statistics()
-    analyzer.calculate_subcategory_statistics()
-    analyzer.calculate_anomalies()
-    analyzer.analyze_anomalies()
-    analyzer.save_all_data_to_csv()
-    output_file_path = f'ml_services/output/user_{user_id}_biggest_anomaly.csv'
-
-    if os.path.exists(output_file_path):
-        anomaly_df = pd.read_csv(output_file_path)
-        if not anomaly_df.empty:
-            message = anomaly_df['message'].iloc[0]
-            return {"user_id": user_id, "advice_message": message}
-        else:
-            return {"user_id": user_id, "message": "No anomalies found in the specified period."}
+async def get_advice(user_id: int = 12, month: int = Query(10, ge=1, le=12), year: Optional[int] = None):
+    result = await load_advice_result(user_id, month, year)
+
+    if result.message is not None:
+        return {"user_id": user_id, "advice_message": result.message}
+    else:
+        return {"user_id": user_id, "message": "No anomalies found in the specified period."}
+
+
+class AdviceBatchRequest(BaseModel):
+    user_ids: Union[List[int], Literal["all"]] = "all"
+    month: int = Field(10, ge=1, le=12)
+    year: Optional[int] = None
+
+
+@advice_router.post("/advices/batch")
+def get_advice_batch(request: AdviceBatchRequest):
+    """
+    Streams the advice message of many users as newline-delimited JSON, one object per user.
+    """
+    user_ids = None if request.user_ids == "all" else request.user_ids
+
+    def generate():
+        for user_id, advice in compute_advice_batch(spending_snapshot.get(), user_ids, request.month, request.year):
+            if advice is None:
+                line = {"user_id": user_id, "error": f"User {user_id} does not exist in the dataset."}
+            elif advice.message is not None:
+                line = {"user_id": user_id, "advice_message": advice.message}
+            else:
+                line = {"user_id": user_id, "message": "No anomalies found in the specified period."}
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 
 @advice_router.get("/get_anomaly_product")
-def get_anomaly_product(user_id: int = 12):
-    # Set the analyzer's user_id
-    analyzer.user_id = user_id
-    output_file_path = f'ml_services/output/user_{user_id}_top_product_anomaly.csv'
+async def get_anomaly_product(user_id: int = 12, month: int = Query(10, ge=1, le=12), year: Optional[int] = None):
+    result = await load_advice_result(user_id, month, year)
+    product_df = result.frame('anomalous_products')
+
+    if product_df is not None and not product_df.empty:
+        product = product_df['product_name'].iloc[0]
+        response = {"user_id": user_id, "advice_message": f"Top anomaly product: {product}"}
+    else:
+        response = {"user_id": user_id, "message": "No anomalies found in the specified period."}
 
-    # Check if the file exists
-    if os.path.exists(output_file_path):
-        product_df = pd.read_csv(output_file_path)
-        if not product_df.empty:
-            product = product_df['product_name'].iloc[0]
-            return {"user_id": user_id, "advice_message": f"Top anomaly product: {product}"}
-        else:
-            return {"user_id": user_id, "message": "No anomalies found in the specified period."}
+    # Products bought in unusual quantities or for the first time; a product that was always
+    # bought in the same quantity has an infinite z-score, which JSON cannot hold
+    product_anomalies = result.frame('product_anomalies')
+    if product_anomalies is not None and not product_anomalies.empty:
+        product_anomalies = product_anomalies[PRODUCT_ANOMALY_FIELDS].replace([np.inf, -np.inf], np.nan)
+        response["product_anomalies"] = product_anomalies.astype(object).where(
+            product_anomalies.notna(), None
+        ).to_dict(orient="records")
+    return response
 
 
 @advice_router.get("/get_expense_categories")
-def get_expense_categories(user_id: int = 12):
-    # Set the analyzer's user_id
-    analyzer.user_id = user_id
-    output_file_path = f'ml_services/output/user_{user_id}_total_expenses.csv'
-
-    # Check if the file exists
-    if os.path.exists(output_file_path):
-        total_expenses_df = pd.read_csv(output_file_path)
-
-        if not total_expenses_df.empty:
-            # Replace NaN and infinite values with a default (like 0 or empty string)
-            total_expenses_df = total_expenses_df.replace([float('inf'), -float('inf')], 0)
-            total_expenses_df = total_expenses_df.fillna(0)
-
-            # Convert the DataFrame to a list of dictionaries
-            expenses_list = total_expenses_df.to_dict(orient="records")
-            return {"user_id": user_id, "expense_categories": expenses_list}
-        else:
-            return {"user_id": user_id, "message": "No expenses found in the specified period."}
+async def get_expense_categories(user_id: int = 12, month: int = Query(10, ge=1, le=12), year: Optional[int] = None):
+    total_expenses_df = (await load_advice_result(user_id, month, year)).frame('total_expenses')
+
+    if total_expenses_df is not None and not total_expenses_df.empty:
+        # Replace NaN and infinite values with a default (like 0 or empty string)
+        total_expenses_df = total_expenses_df.replace([float('inf'), -float('inf')], 0)
+        total_expenses_df = total_expenses_df.fillna(0)
+
+        # Convert the DataFrame to a list of dictionaries
+        expenses_list = total_expenses_df.to_dict(orient="records")
+        return {"user_id": user_id, "expense_categories": expenses_list}
+    else:
+        return {"user_id": user_id, "message": "No expenses found in the specified period."}
+
 
 @advice_router.get("/get_discounted_categories")
-def get_discounted_categories(user_id: int = 2):
-    # Set the analyzer's user_id
-    user_transactions, categories = saving_categorizator.get_transactions_for_user(user_id=user_id, year=2024, month=10)
+def get_discounted_categories(user_id: int = 2, year: Optional[int] = None,
+                              month: Optional[int] = Query(None, ge=1, le=12), end_year: Optional[int] = None,
+                              end_month: Optional[int] = Query(None, ge=1, le=12)):
+    """
+    Sale amounts per category of a user's receipts from (year, month) to (end_year, end_month).
+    Without an end the single month is returned, and with a year but no month the whole year.
+    Without a year, the user's latest year with receipts is used, and also their latest month
+    if no month is given.
+    """
+    table = savings_table.get()
+    if year is None:
+        last_period = table.last_period(user_id)
+        if last_period is None:
+            raise HTTPException(status_code=404, detail=f"No receipts of user {user_id} found.")
+        year, month = last_period[0], month or last_period[1]
+
+    start = (year, month or 1)
+    if end_year is None and end_month is None:
+        end = (year, month or 12)
+    else:
+        end = (end_year or year, end_month or 12)
+    if period_ordinal(end) < period_ordinal(start):
+        raise HTTPException(status_code=400, detail="The end of the period range is before its start.")
+
+    monthly = table.for_user(user_id, start, end)
+    return {
+        "user_id": user_id,
+        "start": {"year": start[0], "month": start[1]},
+        "end": {"year": end[0], "month": end[1]},
+        "discounted_categories": table.savings_per_category(user_id, start, end),
+        "monthly": monthly[['year', 'month', 'category', 'sale_amount', 'receipt_count']].to_dict(orient="records"),
+    }
+
+
+@advice_router.get("/how_you_compare")
+def get_how_you_compare(user_id: int = 12, month: int = Query(10, ge=1, le=12), year: Optional[int] = None):
+    """
+    Percentile rank of the user's spend among all users in every category and subcategory
+    they spent in during the month. Primary categories have an empty subcategory.
+    """
+    snapshot = spending_snapshot.get()
+    live = get_live_spending(snapshot)
+    live.sync()
+    if not live.has_user(user_id):
+        raise HTTPException(status_code=404, detail=f"User {user_id} does not exist in the dataset.")
+
+    year = resolve_year(snapshot, year)
+    comparison = live.percentiles().compare(user_id, (year, month))
+    return {
+        "user_id": user_id,
+        "year": year,
+        "month": month,
+        "categories": comparison.to_dict(orient="records"),
+    }
+
+
+@advice_router.get("/spending_trend")
+def get_spending_trend(user_id: int = 12, month: int = Query(10, ge=1, le=12), year: Optional[int] = None,
+                       recent_months: int = Query(3, ge=1, le=12), prior_months: int = Query(12, ge=1, le=36),
+                       level: Literal['primary_category', 'subcategory'] = 'primary_category'):
+    """
+    The user's average monthly spend per category in the last `recent_months` months up to the
+    month against the `prior_months` months before them, with the relative change (None when
+    nothing was spent before).
+    """
+    snapshot = spending_snapshot.get()
+    live = get_live_spending(snapshot)
+    live.sync()
+    if not live.has_user(user_id):
+        raise HTTPException(status_code=404, detail=f"User {user_id} does not exist in the dataset.")
 
-    savings = saving_categorizator.get_savings_per_category(user_transactions, categories)
-    return {"user_id": user_id, "discounted_categories": savings}
\ No newline at end of file
+    year = resolve_year(snapshot, year)
+    trend = live.compare_windows(user_id, (year, month), recent_months, prior_months, level).drop(columns='customer_id')
+    return {
+        "user_id": user_id,
+        "year": year,
+        "month": month,
+        "recent_months": recent_months,
+        "prior_months": prior_months,
+        "categories": trend.astype(object).where(trend.notna(), None).to_dict(orient="records"),
+    }
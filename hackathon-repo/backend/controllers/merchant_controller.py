@@ -0,0 +1,41 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from ml_services.merchant_index import merchant_index, merchant_rollups, top_merchants_report
+
+merchant_router = APIRouter()
+
+@merchant_router.get("/merchants/top")
+def get_top_merchants(user_id: int = 12, year: Optional[int] = None, month: Optional[int] = Query(None, ge=1, le=12),
+                      limit: int = Query(5, ge=1, le=50)):
+    """
+    The merchants a user spent the most at in a month against the other customers of those
+    merchants. Defaults to the user's latest month with receipts (within `year` if given).
+    """
+    rollups = merchant_rollups.get()
+    if user_id not in rollups.user_rows:
+        raise HTTPException(status_code=404, detail=f"User {user_id} does not exist in the dataset.")
+
+    if year is not None and month is not None:
+        period = (year, month)
+    else:
+        period = rollups.last_period(user_id, year)
+        if period is None:
+            raise HTTPException(status_code=404, detail=f"No receipts of user {user_id} found in {year}.")
+        if month is not None:
+            period = (period[0], month)
+    return {
+        "user_id": user_id,
+        "year": period[0],
+        "month": period[1],
+        "merchants": top_merchants_report(user_id, period, limit),
+    }
+
+
+@merchant_router.get("/merchants/{ico}")
+def get_merchant(ico: int):
+    merchant = merchant_index.get().lookup(ico)
+    if merchant is None:
+        raise HTTPException(status_code=404, detail=f"No merchant with ICO {ico} found.")
+    return {"ico": ico, **merchant}
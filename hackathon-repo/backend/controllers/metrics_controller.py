@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from utils.metrics import CONTENT_TYPE, REGISTRY
+
+metrics_router = APIRouter()
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=REGISTRY.expose(), media_type=CONTENT_TYPE)
@@ -1,8 +1,58 @@
-from fastapi import APIRouter
+import asyncio
+from datetime import datetime
+from typing import List, Tuple
+
+import pandas as pd
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
+
+from ml_services.advice_engine import spending_snapshot
+from ml_services.incremental_aggregates import get_live_spending
+from services import spending_service
 
 receipt_router = APIRouter()
 
 
+class ReceiptItemIn(BaseModel):
+    category_item: str = "Unknown"
+    total_price: float
+
+
+class ReceiptIn(BaseModel):
+    receipt_uid: str
+    customer_id: int
+    issue_date: datetime
+    items: List[ReceiptItemIn] = Field(min_length=1)
+
+
+def ingest_receipt(receipt: ReceiptIn) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Records a receipt and applies it to the live spending the advice endpoints use. Returns
+    its prepared spending rows and the user's scores from January up to the month of the receipt.
+    """
+    live = get_live_spending(spending_snapshot.get())
+    try:
+        position = live.ingest(receipt.receipt_uid, receipt.customer_id, receipt.issue_date,
+                               [item.model_dump() for item in receipt.items])
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    rows = live.journal.read(after=position - 1, until=position)
+    return rows, live.scores(receipt.issue_date.year, receipt.issue_date.month).for_user(receipt.customer_id)
+
+
 @receipt_router.post("/receipts")
-def create_receipt(receipt_uid: str):
-    return {"message": f"Receipt <{receipt_uid}> created successfully"}
\ No newline at end of file
+async def create_receipt(receipt: ReceiptIn):
+    """
+    Records a receipt in the live spending of the advice endpoints and in the spending tables
+    of the /spending endpoints.
+    """
+    # In a thread, as the journal and the live spending are not async
+    rows, scores = await asyncio.to_thread(ingest_receipt, receipt)
+    await spending_service.add_receipt(rows)
+
+    # Replace NaN z-scores (too few users to compare with) by None for JSON
+    scores = scores.astype(object).where(scores.notna(), None)
+    return {
+        "message": f"Receipt <{receipt.receipt_uid}> created successfully",
+        "spending_scores": scores.to_dict(orient="records")
+    }
@@ -0,0 +1,31 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+
+from ml_services.cohort_scoring import calculate_total_expenses
+from services import spending_service
+
+spending_router = APIRouter()
+
+@spending_router.get("/spending/categories")
+async def get_spending_categories(user_id: int = 12, month: int = 10, year: Optional[int] = None):
+    """
+    Expenses and anomaly scores per category of a user, aggregated by the database.
+    """
+    year = await spending_service.resolve_year(year)
+    if year is None:
+        raise HTTPException(status_code=404, detail="No spending data has been loaded.")
+
+    user_spending = await spending_service.get_user_spending_scores(user_id, month, year)
+    if user_spending.empty:
+        raise HTTPException(status_code=404, detail=f"No spending of user {user_id} found in the specified period.")
+
+    anomalies = user_spending[user_spending['is_anomaly']].sort_values(by='final_z_score', ascending=False)
+    return {
+        "user_id": user_id,
+        "year": year,
+        "month": month,
+        "expense_categories": calculate_total_expenses(user_spending).to_dict(orient="records"),
+        "anomalies": anomalies[['primary_category', 'subcategory', 'total_subcat_spent', 'final_z_score',
+                                'anomaly_level']].to_dict(orient="records"),
+    }
@@ -0,0 +1,15 @@
+from typing import Optional
+
+from fastapi import APIRouter, Query
+
+from services.symbol_search import symbol_index
+
+stock_router = APIRouter()
+
+@stock_router.get("/stocks/search")
+async def search_stocks(q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=100),
+                        exchange: Optional[str] = None, asset_type: Optional[str] = None,
+                        status: Optional[str] = None):
+    results = symbol_index.get().search(q, limit=limit, exchange=exchange, asset_type=asset_type, status=status)
+
+    return {"query": q, "results": results}
@@ -1,8 +1,33 @@
-from fastapi import APIRouter
+from typing import List
+
+from fastapi import APIRouter, HTTPException, Query
 from services import user_service
 
 user_router = APIRouter()
 
+# Largest number of IDs accepted by one /users request
+MAX_USER_IDS = 1000
+
+def parse_user_ids(ids: List[str]) -> List[int]:
+    """
+    Accepts both repeated (?ids=1&ids=2) and comma-separated (?ids=1,2) IDs.
+    """
+    try:
+        user_ids = [int(value) for part in ids for value in part.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="User IDs must be integers.")
+    if len(user_ids) > MAX_USER_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_USER_IDS} user IDs can be requested at once.")
+    return user_ids
+
+@user_router.get("/users")
+async def get_users(ids: List[str] = Query(...)):
+    user_ids = parse_user_ids(ids)
+    users = await user_service.get_users(user_ids)
+    found = {user.id for user in users}
+
+    return {"users": users, "missing": [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]}
+
 @user_router.get("/users/{user_id}")
 async def get_user(user_id: int):
     user = await user_service.get_user(user_id)
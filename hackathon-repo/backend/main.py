@@ -1,10 +1,82 @@
-from fastapi import FastAPI
+import asyncio
+import time
+
+from fastapi import FastAPI, Request
 from controllers.receipt_controller import receipt_router
 from controllers.advice_controller import advice_router
 from controllers.user_controller import user_router
+from controllers.stock_controller import stock_router
+from controllers.spending_controller import spending_router
+from controllers.metrics_controller import metrics_router
+from controllers.merchant_controller import merchant_router
+from ml_services.advice_engine import publish_snapshot, resolve_year, spending_snapshot
+from ml_services.analysis_pool import analysis_pool
+from ml_services.incremental_aggregates import get_live_spending
+from ml_services.merchant_index import merchant_index, merchant_rollups
+from ml_services.receipt_item_index import receipt_item_index
+from ml_services.saving_categorizator import organizations_dataset, receipts_dataset, users_dataset
+from ml_services.savings_engine import savings_table
+from repositories.spending_repository import create_spending_tables
+from services.symbol_search import symbol_index
+from utils.environment_variables import PRELOAD_DATA
+from utils.metrics import HTTP_REQUEST_SECONDS
+
+
+def preload_data():
+    """
+    Loads the datasets the endpoints share, so that the first requests do not pay for it.
+    """
+    snapshot = spending_snapshot.get()
+    if analysis_pool.uses_processes and spending_snapshot.version is None:
+        # The analysis workers then attach one shared copy instead of each reading the CSV
+        publish_snapshot(snapshot)
+        spending_snapshot.expire()
+        snapshot = spending_snapshot.get()
+    # Resolving the year also builds the spending cube of the snapshot
+    resolve_year(snapshot)
+    get_live_spending(snapshot).percentiles()
+    users_dataset.get()
+    receipts_dataset.get()
+    organizations_dataset.get()
+    receipt_item_index.get()
+    savings_table.get()
+    merchant_index.get()
+    merchant_rollups.get()
+    symbol_index.get()
+
 
-app = FastAPI()
+async def warm_up():
+    # Ingested receipts are written to the spending tables, also before utils/init_spending.py loaded them
+    await create_spending_tables()
+    if PRELOAD_DATA:
+        # In a thread, so the loading does not block the event loop
+        await asyncio.to_thread(preload_data)
+        # The analysis workers load their own view of the snapshot
+        await analysis_pool.warm_up()
+
+
+app = FastAPI(on_startup=[warm_up], on_shutdown=[analysis_pool.shutdown])
 
 app.include_router(receipt_router)
 app.include_router(advice_router)
 app.include_router(user_router)
+app.include_router(stock_router)
+app.include_router(spending_router)
+app.include_router(merchant_router)
+app.include_router(metrics_router)
+
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    start = time.perf_counter()
+    # An exception escaping the app becomes a 500, which is recorded as such
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template rather than the raw path to keep the number of series bounded
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=getattr(route, "path", "unmatched"), status=status)
@@ -0,0 +1,356 @@
+import functools
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import pandas as pd
+
+from ml_services.cohort_scoring import calculate_total_expenses
+from ml_services.dataset_store import (COMPACT_COLUMNS, COMPACT_SOURCE_COLUMNS, append_rows, compact_spending_data,
+                                       dataset_version, read_dataset)
+from ml_services.incremental_aggregates import LiveScores, get_live_spending
+from ml_services.receipt_item_index import receipt_item_index
+from ml_services.receipt_journal import ReceiptJournal, receipt_journal
+from ml_services.results_store import ResultsStore, StoredResult, results_store
+from ml_services.shared_snapshot import DerivedCache, SharedDataset, publish
+from ml_services.spending_cube import build_spending_cube, get_spending_cube
+from ml_services.spending_percentiles import build_spending_percentiles, get_spending_percentiles
+from ml_services.time_series_analyzer import ANOMALY_REPORT_COLUMNS, find_product_anomalies, product_purchases
+from utils.environment_variables import DATA_DIR, SNAPSHOT_DIR
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+SPENDING_DATA_FILE = os.path.join(DATA_DIR, 'Merged_Spending_Data.csv')
+
+# The snapshot keeps the spending rows in the compact layout (see dataset_store.compact_spending_data)
+SNAPSHOT_COLUMNS = COMPACT_COLUMNS
+# Table published with a snapshot holding the journal position its rows include
+JOURNAL_TABLE = 'journal'
+
+
+@dataclass(frozen=True, eq=False)
+class SpendingSnapshot:
+    """
+    Read-only, preprocessed view of the spending dataset, with the rows in the compact layout.
+
+    The snapshot is built once and shared by every request. Nothing in this module mutates
+    `data`; all analysis works on filtered copies, so the snapshot can be used from many threads
+    at the same time without locking.
+
+    `tables` are the derived arrays published with the snapshot (see `derived_tables`), empty
+    when the data was read by this process. Everything computed from the snapshot is kept in
+    `derived`, so it is released together with the snapshot when a new version is attached.
+
+    The data holds the receipts of `journal` up to `journal_position`; the ones ingested later
+    are applied on top by the live spending (see incremental_aggregates). Without a journal the
+    snapshot is fixed.
+    """
+    data: pd.DataFrame
+    customer_ids: frozenset
+    version: str
+    tables: Dict[str, pd.DataFrame] = field(default_factory=dict)
+    derived: DerivedCache = field(default_factory=DerivedCache, repr=False)
+    journal: Optional[ReceiptJournal] = field(default=None, repr=False)
+    journal_position: int = 0
+
+
+@dataclass(frozen=True)
+class Advice:
+    """
+    Result of the anomaly analysis for a single user and period.
+    """
+    user_id: int
+    year: int
+    month: int
+    user_spending: pd.DataFrame
+    total_expenses: pd.DataFrame
+    biggest_anomaly: Optional[pd.DataFrame]
+    message: Optional[str]
+
+
+def build_snapshot(data: pd.DataFrame, version: str, tables: Optional[Dict[str, pd.DataFrame]] = None,
+                   journal: Optional[ReceiptJournal] = None, journal_position: int = 0) -> SpendingSnapshot:
+    """
+    Builds a snapshot from spending rows prepared by `dataset_store.prepare_spending_data`,
+    which are converted to the compact layout unless they already are in it.
+    """
+    if 'price_cents' not in data.columns:
+        data = compact_spending_data(data)
+    return SpendingSnapshot(
+        data=data,
+        customer_ids=frozenset(data['customer_id'].unique().tolist()),
+        version=version,
+        tables=tables or {},
+        journal=journal,
+        journal_position=journal_position
+    )
+
+
+def attach_snapshot(data: pd.DataFrame, version: str, tables: Dict[str, pd.DataFrame]) -> SpendingSnapshot:
+    """
+    Builds a snapshot from published rows, following the receipts ingested after they were published.
+    """
+    journal_position = int(tables[JOURNAL_TABLE]['position'].iloc[0]) if JOURNAL_TABLE in tables else 0
+    return build_snapshot(data, version, tables, receipt_journal.get(), journal_position)
+
+
+def derived_tables(data: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    The spending cube and the percentile arrays of prepared spending rows as tables, published
+    with the snapshot so that the workers attach them instead of building them each.
+    """
+    cube = build_spending_cube(data)
+    return {**cube.to_tables(), **build_spending_percentiles(cube).to_tables()}
+
+
+def publish_snapshot(snapshot: SpendingSnapshot, root: str = SNAPSHOT_DIR) -> str:
+    """
+    Publishes a snapshot with its cube and percentile tables as the current shared snapshot.
+    The tables already built for the snapshot are reused.
+    """
+    tables = {**get_spending_cube(snapshot).to_tables(), **get_spending_percentiles(snapshot).to_tables(),
+              JOURNAL_TABLE: pd.DataFrame({'position': [snapshot.journal_position]})}
+    return publish(snapshot.data, snapshot.version, root, tables=tables)
+
+
+def load_snapshot(file_path: str = SPENDING_DATA_FILE, journal: Optional[ReceiptJournal] = None) -> SpendingSnapshot:
+    """
+    Loads the spending dataset (from the columnar cache when available) with the receipts
+    ingested so far appended, and builds a snapshot following the later ones. The version is
+    the dataset's, followed by the journal position when receipts were appended.
+    """
+    journal = journal if journal is not None else receipt_journal.get()
+    journal_position = journal.last_position()
+    version = dataset_version(file_path)
+    data = compact_spending_data(read_dataset(file_path, columns=COMPACT_SOURCE_COLUMNS))
+    if journal_position:
+        version = f"{version}+{journal_position}"
+        data = append_rows(data, compact_spending_data(journal.read(until=journal_position)))
+    return build_snapshot(data, version, journal=journal, journal_position=journal_position)
+
+
+def resolve_year(snapshot: SpendingSnapshot, year: Optional[int] = None) -> int:
+    """
+    The year to analyze: the given one, or the latest year with spending.
+    """
+    return year if year is not None else get_live_spending(snapshot).last_period[0]
+
+
+def describe_biggest_anomaly(scores: LiveScores, user_spending: pd.DataFrame, user_id: int):
+    """
+    Returns the biggest anomaly of the user, extended with the comparison against other users,
+    together with the advice message. Returns (None, None) if the user has no anomalies.
+    """
+    anomalies = user_spending[user_spending['is_anomaly']]
+    if anomalies.empty:
+        return None, None
+
+    biggest_anomaly = anomalies.sort_values(by='final_z_score', key=abs, ascending=False).head(1).copy()
+    primary_category = biggest_anomaly['primary_category'].iloc[0]
+    subcategory = biggest_anomaly['subcategory'].iloc[0]
+    anomaly_level = biggest_anomaly['anomaly_level'].iloc[0]
+
+    if anomaly_level == 'subcategory' and subcategory != "Unknown" and pd.notna(subcategory):
+        avg_other_users_spend = scores.peer_average(user_id, primary_category, subcategory)
+        user_spend = biggest_anomaly['total_subcat_spent'].iloc[0]
+        category_name = subcategory
+    else:
+        avg_other_users_spend = scores.peer_average(user_id, primary_category)
+        user_spend = biggest_anomaly['total_main_spent'].iloc[0]
+        category_name = primary_category
+
+    if avg_other_users_spend != 0 and not pd.isna(avg_other_users_spend):
+        percent_difference = ((user_spend - avg_other_users_spend) / avg_other_users_spend) * 100
+    else:
+        percent_difference = None
+
+    if percent_difference is not None:
+        message = (f"Hi! In this month you spent {percent_difference:.2f}% more than other users in the "
+                   f"{category_name} category.")
+    else:
+        message = f"Hi! In this month your spending in the {category_name} category is unusually high."
+
+    biggest_anomaly['avg_other_users_spend'] = avg_other_users_spend
+    biggest_anomaly['percent_difference'] = percent_difference
+    biggest_anomaly['message'] = message
+
+    return biggest_anomaly, message
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='advice_engine', stage='compute_advice')
+def compute_advice(snapshot: SpendingSnapshot, user_id: int, month: int = 10,
+                   year: Optional[int] = None) -> Advice:
+    """
+    Runs the anomaly analysis for one user on the data from January up to the given month of
+    `year` (the latest year in the snapshot by default). The cohort-wide scores are computed once
+    per (snapshot, year, month); after that a request is a table lookup.
+
+    It never mutates the snapshot, and the live scores it reads are locked while they are
+    updated, so it can be called concurrently from any number of threads or workers.
+    """
+    live = get_live_spending(snapshot)
+    if not live.has_user(user_id):
+        raise ValueError(f"User {user_id} does not exist in the dataset.")
+
+    year = resolve_year(snapshot, year)
+    scores = live.scores(year, month)
+    user_spending = scores.for_user(user_id)
+    biggest_anomaly, message = describe_biggest_anomaly(scores, user_spending, user_id)
+
+    return Advice(
+        user_id=user_id,
+        year=year,
+        month=month,
+        user_spending=user_spending,
+        total_expenses=calculate_total_expenses(user_spending),
+        biggest_anomaly=biggest_anomaly,
+        message=message
+    )
+
+
+def compute_advice_batch(snapshot: SpendingSnapshot, user_ids: Optional[Iterable[int]] = None,
+                         month: int = 10, year: Optional[int] = None) -> Iterator[Tuple[int, Optional[Advice]]]:
+    """
+    Lazily computes the advice for many users (all users if `user_ids` is None) on top of one
+    cohort scoring pass. Yields (user_id, advice) pairs; advice is None for unknown users.
+    """
+    live = get_live_spending(snapshot)
+    live.sync()
+    year = resolve_year(snapshot, year)
+    live.scores(year, month)
+
+    if user_ids is None:
+        user_ids = sorted(snapshot.customer_ids | set(live.user_positions))
+
+    for user_id in user_ids:
+        if live.has_user(user_id):
+            yield user_id, compute_advice(snapshot, user_id, month, year)
+        else:
+            yield user_id, None
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='advice_engine', stage='find_anomalous_products')
+def find_anomalous_products(snapshot: SpendingSnapshot, advice: Advice) -> Optional[pd.DataFrame]:
+    """
+    Looks up the receipt items of the user's anomalous categories in the target month in the
+    local receipt item index and aggregates spending per product, most expensive first.
+    """
+    anomalies = advice.user_spending[advice.user_spending['is_anomaly']]
+    if anomalies.empty:
+        return None
+
+    data = snapshot.data
+    anomalous_transactions = data[
+        (data['customer_id'] == advice.user_id) &
+        (data['primary_category'].isin(anomalies['primary_category'])) &
+        (data['subcategory'].isin(anomalies['subcategory'])) &
+        (data['issue_date'].dt.year == advice.year) &
+        (data['issue_date'].dt.month == advice.month)
+        ]
+
+    product_spending = receipt_item_index.get().product_spending(anomalous_transactions['receipt_id'].unique())
+    if product_spending.empty:
+        return None
+
+    return product_spending
+
+
+def get_product_anomalies(snapshot: SpendingSnapshot, year: int, month: int) -> pd.DataFrame:
+    """
+    Product quantity anomalies of all users in `month` of `year`, against their purchases in the
+    months before, computed once per (snapshot, year, month) like the cohort scores.
+    """
+    def build() -> pd.DataFrame:
+        purchases = snapshot.derived.get(
+            'product_purchases', lambda: product_purchases(snapshot.data, receipt_item_index.get())
+        )
+        return find_product_anomalies(purchases, year, month)[['customer_id', *ANOMALY_REPORT_COLUMNS, 'message']]
+
+    return snapshot.derived.get(('product_anomalies', year, month), build)
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='advice_engine', stage='find_product_anomalies')
+def find_user_product_anomalies(snapshot: SpendingSnapshot, advice: Advice) -> Optional[pd.DataFrame]:
+    """
+    The products the user bought in the advice month in unusual quantities or for the first
+    time, most unusual first.
+    """
+    anomalies = get_product_anomalies(snapshot, advice.year, advice.month)
+    user_anomalies = anomalies[anomalies['customer_id'] == advice.user_id]
+    if user_anomalies.empty:
+        return None
+
+    return user_anomalies.drop(columns='customer_id').reset_index(drop=True)
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='advice_engine', stage='build_advice_result')
+def build_advice_result(snapshot: SpendingSnapshot, user_id: int, month: int, year: int) -> StoredResult:
+    """
+    Computes the advice and the product drilldown of a user in the form kept by the results store.
+    """
+    advice = compute_advice(snapshot, user_id, month, year)
+    anomalous_products = find_anomalous_products(snapshot, advice)
+    product_anomalies = find_user_product_anomalies(snapshot, advice)
+
+    frames = {
+        'total_expenses': advice.total_expenses,
+        'user_spending': advice.user_spending,
+    }
+    if advice.biggest_anomaly is not None:
+        frames['biggest_anomaly'] = advice.biggest_anomaly
+    if anomalous_products is not None:
+        frames['anomalous_products'] = anomalous_products
+    if product_anomalies is not None:
+        frames['product_anomalies'] = product_anomalies
+
+    return StoredResult(message=advice.message, frames=frames)
+
+
+def advice_period(year: int, month: int) -> str:
+    """
+    Period key of the results store.
+    """
+    return f"{year}-{month:02d}"
+
+
+def find_advice_result(snapshot: SpendingSnapshot, user_id: int, month: int, year: int,
+                       store: Optional[ResultsStore] = None) -> Optional[StoredResult]:
+    """
+    Returns the stored advice result of a user, or None if it was not computed yet.
+    """
+    store = store if store is not None else results_store.get()
+    return store.get(user_id, advice_period(year, month), get_live_spending(snapshot).result_version(user_id))
+
+
+def get_advice_result(snapshot: SpendingSnapshot, user_id: int, month: int = 10, year: Optional[int] = None,
+                      store: Optional[ResultsStore] = None) -> StoredResult:
+    """
+    Returns the stored advice result of a user, computing and storing it on first use.
+    Raises ValueError for users that are not in the dataset.
+    """
+    store = store if store is not None else results_store.get()
+    live = get_live_spending(snapshot)
+    live.sync()
+    year = resolve_year(snapshot, year)
+    result = find_advice_result(snapshot, user_id, month, year, store)
+    if result is None:
+        result = build_advice_result(snapshot, user_id, month, year)
+        version = live.result_version(user_id)
+        if version != snapshot.version:
+            # The user posted a receipt, their results of earlier positions are stale
+            store.delete_user_versions(user_id, version)
+        store.put(user_id, advice_period(year, month), version, result)
+    return result
+
+
+def drop_stale_results(snapshot: SpendingSnapshot) -> None:
+    """
+    Removes the stored results of other snapshot versions once a process switches to a new one.
+    """
+    results_store.get().delete_other_versions(snapshot.version)
+
+
+# The published shared snapshot when there is one, otherwise the dataset read by this process,
+# read again when the dataset file changes; ingested receipts are applied to either live
+spending_snapshot = SharedDataset(build=attach_snapshot, fallback=load_snapshot,
+                                  fallback_version=functools.partial(dataset_version, SPENDING_DATA_FILE),
+                                  on_change=drop_stale_results)
@@ -0,0 +1,138 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional
+
+from utils.environment_variables import ANALYSIS_QUEUE_SIZE, ANALYSIS_WORKERS
+from utils.metrics import ANALYSIS_POOL_REQUESTS, REGISTRY
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when every worker is busy and the queue of waiting analyses is full.
+    """
+
+
+class AnalysisPool:
+    """
+    Runs CPU-bound analyses outside of the event loop, in a bounded pool of worker processes.
+
+    At most `workers + queue_size` analyses are accepted at a time; further ones raise
+    PoolSaturated instead of piling up. Analyses are identified by a key, and a request for a
+    key that is already running waits for that run instead of starting another one, so
+    concurrent identical requests cost one computation.
+
+    The pool is created on first use. Worker processes are spawned rather than forked, so they
+    do not inherit the API process' threads and SQLite connections. What a task records in the
+    metrics of its worker is returned with its result and merged into the registry of the API
+    process, so /metrics covers the analyses that ran in the workers.
+    """
+
+    def __init__(self, workers: int = ANALYSIS_WORKERS, queue_size: int = ANALYSIS_QUEUE_SIZE):
+        self.workers = workers
+        self.capacity = max(workers, 1) + queue_size
+        self._executor: Optional[Executor] = None
+        self._running: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def uses_processes(self) -> bool:
+        return self.workers > 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.uses_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(thread_name_prefix='analysis')
+        return self._executor
+
+    async def run(self, key: Hashable, function: Callable, *args):
+        """
+        Runs `function(*args)` in the pool, or joins the running analysis with the same key.
+        The function and its arguments must be picklable (module-level functions).
+        """
+        task = key[0] if isinstance(key, tuple) else str(key)
+        future = self._running.get(key)
+        if future is not None:
+            ANALYSIS_POOL_REQUESTS.inc(task=task, result='coalesced')
+        else:
+            if len(self._running) >= self.capacity:
+                ANALYSIS_POOL_REQUESTS.inc(task=task, result='rejected')
+                raise PoolSaturated(f"{len(self._running)} analyses are already running or queued.")
+
+            ANALYSIS_POOL_REQUESTS.inc(task=task, result='submitted')
+            future = asyncio.ensure_future(self._submit(function, *args))
+            self._running[key] = future
+            future.add_done_callback(lambda _: self._running.pop(key, None))
+
+        # A cancelled request (client gone) must not cancel the run other requests wait for
+        return await asyncio.shield(future)
+
+    async def _submit(self, function: Callable, *args):
+        loop = asyncio.get_running_loop()
+        if not self.uses_processes:
+            return await loop.run_in_executor(self._get_executor(), function, *args)
+
+        result, error, metrics = await loop.run_in_executor(self._get_executor(), _report_metrics, function, *args)
+        REGISTRY.merge(metrics)
+        if error is not None:
+            raise error
+        return result
+
+    async def warm_up(self) -> None:
+        """
+        Starts every worker process and loads the data the analyses need in each of them, so
+        the first requests a worker gets do not pay for it.
+        """
+        if self.uses_processes:
+            # A task per worker: each one takes a task while the others are still loading
+            await asyncio.gather(*(self._submit(preload_worker) for _ in range(self.workers)))
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _report_metrics(function: Callable, *args):
+    """
+    Runs a task in a worker process and returns its result or error together with the metrics
+    it recorded in the worker.
+    """
+    try:
+        return function(*args), None, REGISTRY.drain()
+    except Exception as error:
+        return None, error, REGISTRY.drain()
+
+
+def preload_worker() -> None:
+    """
+    Worker task: loads the snapshot, its cube and the receipt items the advice analyses use.
+    """
+    from ml_services.advice_engine import resolve_year, spending_snapshot
+    from ml_services.receipt_item_index import receipt_item_index
+
+    resolve_year(spending_snapshot.get())
+    receipt_item_index.get()
+
+
+def advice_result(user_id: int, month: int, year: int, version: Optional[str] = None):
+    """
+    Worker task: the stored advice result of a user, computed and stored on first use.
+    `version` is the version of the user's results the request was resolved on; a worker that
+    has not seen it yet applies the new receipts and looks for a new snapshot first.
+    """
+    from ml_services.advice_engine import get_advice_result, spending_snapshot
+    from ml_services.incremental_aggregates import get_live_spending
+
+    snapshot = spending_snapshot.get()
+    live = get_live_spending(snapshot)
+    live.sync()
+    if version is not None and live.result_version(user_id) != version:
+        spending_snapshot.expire()
+        snapshot = spending_snapshot.get()
+    return get_advice_result(snapshot, user_id, month, year)
+
+
+analysis_pool = AnalysisPool()
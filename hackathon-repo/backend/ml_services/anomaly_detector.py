@@ -1,21 +1,19 @@
+import numpy as np
 import pandas as pd
-import requests
-from pprint import pprint
 import os
-import sys
-import io
 
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+from ml_services.cohort_scoring import ANOMALY_Z_SCORE_THRESHOLD
+from ml_services.dataset_store import read_dataset
+from ml_services.receipt_item_index import receipt_item_index
+from utils.metrics import instrument_stages
 
+@instrument_stages('get_transactions_for_user', 'get_sale_amount_for_receipt', 'get_savings_per_category')
 class UserTransactionAnalyzer:
     def __init__(self, users_file, receipts_file, organizations_file):
         # Load datasets
-        self.organizations_df = pd.read_csv(organizations_file)
-        self.receipts_df = pd.read_csv(receipts_file)
-        self.users_df = pd.read_csv(users_file)
-
-        # Ensure 'create_date' is in datetime format, with error handling
-        self.receipts_df['create_date'] = pd.to_datetime(self.receipts_df['create_date'], errors='coerce')
+        self.organizations_df = read_dataset(organizations_file)
+        self.receipts_df = read_dataset(receipts_file)
+        self.users_df = read_dataset(users_file)
 
     def get_transactions_for_user(self, user_id: int, year: int = None, month: int = None):
         """
@@ -24,7 +22,9 @@ class UserTransactionAnalyzer:
         # Filter by user_id
         user_transactions = self.receipts_df[self.receipts_df['customer_id'] == user_id]
 
-        # Filter by year and month if specified
+        # Filter by year and month if specified; a month without a year is in the user's latest year
+        if month and not year and not user_transactions.empty:
+            year = int(user_transactions['create_date'].dt.year.max())
         if year:
             user_transactions = user_transactions[user_transactions['create_date'].dt.year == year]
         if month:
@@ -39,60 +39,35 @@ class UserTransactionAnalyzer:
         return user_transactions, categories
 
     @staticmethod
-    def get_receipt_items(receipt_id):
-        """
-        Fetches receipt data from the API using the provided receipt ID and returns the receipt items.
+    def get_sale_amount_for_receipt(receipt_id):
         """
-        url = 'https://ekasa.financnasprava.sk/mdu/api/v1/opd/receipt/find'
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json;charset=UTF-8',
-            'User-Agent': 'Mozilla/5.0'
-        }
-        payload = {'receiptId': receipt_id}
-
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("receipt", {}).get("items", [])
-        except requests.exceptions.RequestException as e:
-            pprint(f"An error occurred while fetching receipt items: {e}")
-            return []
-
-    def get_sale_amount_for_receipt(self, receipt_id):
+        Calculates the total sale amount for a given receipt ID from the local receipt item index.
         """
-        Calculates the total sale amount for a given receipt ID by summing up the price of items.
-        """
-        items = self.get_receipt_items(receipt_id)
-        sale_amount = sum(
-            item.get('price', 0) * item.get('quantity', 1)
-            for item in items if item.get('itemType') == 'Z'
-        )
-        return sale_amount
+        return float(receipt_item_index.get().sale_amounts([receipt_id])[0])
 
     def get_savings_per_category(self, user_transactions, categories):
         """
-        Calculates the total savings per category for a user's transactions.
+        Calculates the total savings per category for a user's transactions, summing the sale
+        amounts of the distinct receipts of each category in one grouped pass.
         """
-        sale_amount_per_category = {}
+        receipts = user_transactions[['category', 'receipt_id']].drop_duplicates()
+        sale_amounts = pd.Series(receipt_item_index.get().sale_amounts(receipts['receipt_id']),
+                                 index=receipts['category'].to_numpy())
+        sale_amount_per_category = sale_amounts.groupby(level=0).sum()
 
-        for category in categories:
-            category_transactions = user_transactions[user_transactions['category'] == category]
-            total_sale_amount = sum(
-                self.get_sale_amount_for_receipt(receipt_id)
-                for receipt_id in category_transactions['receipt_id'].unique()
-            )
-            sale_amount_per_category[category] = total_sale_amount
-
-        return sale_amount_per_category
+        return {category: float(sale_amount_per_category.get(category, 0.0)) for category in categories}
 
 
+@instrument_stages('preprocess_data', 'calculate_user_spending', 'calculate_main_category_statistics',
+                   'calculate_subcategory_statistics', 'calculate_anomalies', 'calculate_total_expenses',
+                   'get_biggest_anomaly', 'identify_anomalous_products', 'analyze_anomalies',
+                   'save_all_data_to_csv')
 class SpendingAnalyzer:
-    def __init__(self, file_path, user_id, target_month=10):
-        self.data = pd.read_csv(file_path)
+    def __init__(self, file_path, user_id, target_month=10, target_year=None):
+        self.data = read_dataset(file_path)
         self.user_id = user_id
         self.target_month = target_month
+        self.target_year = target_year
         self.user_spending = None
 
         # self.preprocess_data()
@@ -110,18 +85,24 @@ class SpendingAnalyzer:
 
         # Ensure 'issue_date' is in datetime format
         self.data['issue_date'] = pd.to_datetime(self.data['issue_date'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
-        # Filter data up to the target month
-        self.data = self.data[self.data['issue_date'].dt.month <= self.target_month]
+        # Filter data from January up to the target month of the target year (the latest by default)
+        if self.target_year is None:
+            self.target_year = int(self.data['issue_date'].dt.year.max())
+        self.data = self.data[
+            (self.data['issue_date'].dt.year == self.target_year) &
+            (self.data['issue_date'].dt.month <= self.target_month)
+            ]
 
-        # Split the category into primary and subcategory
-        self.data[['primary_category', 'subcategory']] = self.data['category_item'].str.split('/', expand=True)
+        # Split the category into primary and subcategory, unless the dataset cache already did
+        if 'primary_category' not in self.data.columns:
+            self.data[['primary_category', 'subcategory']] = self.data['category_item'].str.split('/', expand=True)
 
         # Fill missing values and strip whitespace
         self.data['primary_category'] = self.data['primary_category'].fillna("Unknown").str.strip()
         self.data['subcategory'] = self.data['subcategory'].fillna("Unknown").str.strip()
 
         # Replace empty strings and variations of 'null' with 'Unknown'
-        self.data['subcategory'].replace(['', 'null', 'Null', 'NULL'], 'Unknown', inplace=True)
+        self.data['subcategory'] = self.data['subcategory'].replace(['', 'null', 'Null', 'NULL'], 'Unknown')
 
         # Ensure 'receipt_id' is present
         required_columns = ['customer_id', 'issue_date', 'total_price', 'category_item', 'receipt_id']
@@ -187,11 +168,12 @@ class SpendingAnalyzer:
         )
 
         # Calculate z-score for subcategories
-        self.user_category_spending['subcat_z_score'] = self.user_category_spending.apply(
-            lambda x: (x['total_subcat_spent'] - x['mean_subcat_spent']) / x['std_subcat_spent']
-            if x['subcategory'] != "Unknown" and x['std_subcat_spent'] != 0 else None,
-            axis=1
-        )
+        has_subcat_stats = (self.user_category_spending['subcategory'] != "Unknown") & \
+                           (self.user_category_spending['std_subcat_spent'] != 0)
+        self.user_category_spending['subcat_z_score'] = (
+            (self.user_category_spending['total_subcat_spent'] - self.user_category_spending['mean_subcat_spent'])
+            / self.user_category_spending['std_subcat_spent']
+        ).where(has_subcat_stats)
 
     def calculate_anomalies(self):
         """
@@ -200,23 +182,14 @@ class SpendingAnalyzer:
         self.user_spending = self.user_category_spending[
             self.user_category_spending['customer_id'] == self.user_id].copy()
 
-        # Determine whether the subcategory z-score is available
-        def get_final_z_score(row):
-            # Handle cases where subcat_z_score is None or NaN
-            if pd.notna(row['subcat_z_score']):
-                if abs(row['subcat_z_score']) >= abs(row['main_z_score']):
-                    row['final_z_score'] = row['subcat_z_score']
-                    row['anomaly_level'] = 'subcategory'
-                else:
-                    row['final_z_score'] = row['main_z_score']
-                    row['anomaly_level'] = 'main_category'
-            else:
-                row['final_z_score'] = row['main_z_score']
-                row['anomaly_level'] = 'main_category'
-            return row
+        # Use the subcategory z-score where it is available and stronger than the main one
+        subcat_z = self.user_spending['subcat_z_score']
+        main_z = self.user_spending['main_z_score']
+        use_subcat = subcat_z.notna() & (subcat_z.abs() >= main_z.abs())
 
-        self.user_spending = self.user_spending.apply(get_final_z_score, axis=1)
-        self.user_spending['is_anomaly'] = self.user_spending['final_z_score'] > 0.7
+        self.user_spending['final_z_score'] = np.where(use_subcat, subcat_z, main_z)
+        self.user_spending['anomaly_level'] = np.where(use_subcat, 'subcategory', 'main_category')
+        self.user_spending['is_anomaly'] = self.user_spending['final_z_score'] > ANOMALY_Z_SCORE_THRESHOLD
 
     def calculate_total_expenses(self):
         """
@@ -331,6 +304,7 @@ class SpendingAnalyzer:
             (self.data['customer_id'] == self.user_id) &
             (self.data['primary_category'].isin(anomalous_categories['primary_category'])) &
             (self.data['subcategory'].isin(anomalous_categories['subcategory'])) &
+            (self.data['issue_date'].dt.year == self.target_year) &
             (self.data['issue_date'].dt.month == self.target_month)
             ]
 
@@ -341,49 +315,13 @@ class SpendingAnalyzer:
             print("No receipt IDs found for anomalous transactions.")
             return None
 
-        # Initialize UserTransactionAnalyzer
-        uta = UserTransactionAnalyzer(
-            users_file='ml_services/data/Users.csv',
-            receipts_file='ml_services/data/Receipts_with_customer_id.csv',
-            organizations_file='ml_services/data/Organizations.csv'
-        )
+        # Aggregate spending by product from the local receipt item index, most expensive first
+        product_spending = receipt_item_index.get().product_spending(receipt_ids)
 
-        # Get product-level data for the receipts
-        product_spending_list = []
-
-        for receipt_id in receipt_ids:
-            items = uta.get_receipt_items(receipt_id)
-            if not items:
-                continue
-            for item in items:
-                product_name = item.get('name', 'Unknown')
-                price = item.get('price', 0)
-                quantity = item.get('quantity', 1)
-                total_price = price * quantity
-                product_spending_list.append({
-                    'product_name': product_name,
-                    'price': price,
-                    'quantity': quantity,
-                    'total_price': total_price,
-                    'receipt_id': receipt_id
-                })
-
-        # Convert to DataFrame
-        product_spending_df = pd.DataFrame(product_spending_list)
-
-        if product_spending_df.empty:
+        if product_spending.empty:
             print("No product-level data available for the anomalous transactions.")
             return None
 
-        # Aggregate spending by product
-        product_spending = product_spending_df.groupby('product_name').agg(
-            total_spent=('total_price', 'sum'),
-            quantity=('quantity', 'sum')
-        ).reset_index()
-
-        # Sort products by total spent
-        product_spending = product_spending.sort_values(by='total_spent', ascending=False)
-
         # Save to CSV
         product_spending.to_csv(f'ml_services/output/user_{self.user_id}_anomalous_products.csv', index=False)
 
@@ -451,8 +389,6 @@ class SpendingAnalyzer:
         print(f"All data saved to '{output_dir}' directory.")
 
 
-analyzer = SpendingAnalyzer(file_path='ml_services/data/Merged_Spending_Data.csv', user_id=1)
-
 if __name__ == '__main__':
     # Example usage
     analyzer = SpendingAnalyzer(file_path='ml_services/data/Merged_Spending_Data.csv', user_id=1)
@@ -0,0 +1,242 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from ml_services.spending_cube import SpendingCube, get_spending_cube
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+# Users whose final z-score is above this value are flagged as anomalous
+ANOMALY_Z_SCORE_THRESHOLD = 0.7
+
+SCORE_COLUMNS = [
+    'customer_id', 'primary_category', 'subcategory', 'total_subcat_spent',
+    'mean_subcat_spent', 'std_subcat_spent', 'total_main_spent', 'mean_main_spent',
+    'std_main_spent', 'main_z_score', 'subcat_z_score', 'final_z_score', 'anomaly_level', 'is_anomaly'
+]
+
+
+def _column_statistics(spend: np.ndarray, present: np.ndarray):
+    """
+    Column-wise sum, count, mean, sum of squared deviations from the mean and sample standard
+    deviation over the present cells only, matching pandas' groupby mean/std (NaN std for fewer
+    than two users).
+    """
+    values = np.where(present, spend, 0.0)
+    count = present.sum(axis=0)
+    total = values.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        squared_deviation = np.where(present, (spend - mean) ** 2, 0.0).sum(axis=0)
+        std = np.sqrt(squared_deviation / (count - 1))
+    std[count < 2] = np.nan
+
+    return total, count, mean, squared_deviation, std
+
+
+def calculate_total_expenses(user_spending: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calculates total expenses of a user for main categories and their subcategories
+    from the user's scored rows.
+    """
+    subcategory_totals = user_spending[['primary_category', 'subcategory', 'total_subcat_spent']].rename(
+        columns={'total_subcat_spent': 'total_price'}
+    )
+
+    main_category_totals = subcategory_totals.groupby('primary_category')['total_price'].sum().reset_index()
+    main_category_totals['subcategory'] = ''  # Empty subcategory to differentiate main category totals
+
+    combined_totals = pd.concat([main_category_totals, subcategory_totals], ignore_index=True)
+    return combined_totals.sort_values(by=['primary_category', 'subcategory']).reset_index(drop=True)
+
+
+@dataclass(frozen=True, eq=False)
+class CohortScores:
+    """
+    Anomaly scores of every user for every (category, subcategory) they spent in.
+
+    `table` holds one row per (customer_id, primary_category, subcategory), sorted by customer,
+    and `user_rows` maps a customer to its slice of the table, so a per-user lookup does not
+    scan or group the data again.
+    """
+    table: pd.DataFrame
+    user_rows: dict
+    user_index: dict
+    category_index: dict
+    subcategory_index: dict
+    main_spend: np.ndarray
+    main_present: np.ndarray
+    main_totals: np.ndarray
+    main_counts: np.ndarray
+    main_squared_deviation: np.ndarray
+    subcat_spend: np.ndarray
+    subcat_present: np.ndarray
+    subcat_totals: np.ndarray
+    subcat_counts: np.ndarray
+    subcat_squared_deviation: np.ndarray
+
+    def for_user(self, user_id: int) -> pd.DataFrame:
+        """
+        Returns the scored rows of a single user (empty if the user has no spending).
+        """
+        start, stop = self.user_rows.get(user_id, (0, 0))
+        return self.table.iloc[start:stop]
+
+    def peer_average(self, user_id: int, primary_category: str, subcategory: Optional[str] = None) -> float:
+        """
+        Average spend of all other users who spent in the category (or subcategory if given).
+        """
+        if subcategory is None:
+            column = self.category_index.get(primary_category)
+            spend, present, totals, counts = self.main_spend, self.main_present, self.main_totals, self.main_counts
+        else:
+            column = self.subcategory_index.get((primary_category, subcategory))
+            spend, present, totals, counts = (self.subcat_spend, self.subcat_present,
+                                              self.subcat_totals, self.subcat_counts)
+        if column is None:
+            return np.nan
+
+        total, count = totals[column], counts[column]
+        row = self.user_index.get(user_id)
+        if row is not None and present[row, column]:
+            total -= spend[row, column]
+            count -= 1
+
+        return total / count if count else np.nan
+
+
+def score_cohort(data: pd.DataFrame) -> CohortScores:
+    """
+    Scores all users in one pass. Builds a users x (category, subcategory) spend matrix and
+    computes the main and subcategory z-scores with NumPy instead of per-row lambdas.
+    """
+    user_codes, users = pd.factorize(data['customer_id'], sort=True)
+    pair_codes, pairs = pd.factorize(
+        pd.MultiIndex.from_arrays([data['primary_category'], data['subcategory']]), sort=True
+    )
+    n_users, n_pairs = len(users), len(pairs)
+    prices = data['total_price'].to_numpy(dtype=np.float64)
+
+    # Users x (category, subcategory) spend matrix
+    cells = user_codes * n_pairs + pair_codes
+    subcat_spend = np.bincount(cells, weights=prices, minlength=n_users * n_pairs).reshape(n_users, n_pairs)
+    subcat_present = np.bincount(cells, minlength=n_users * n_pairs).reshape(n_users, n_pairs) > 0
+
+    return score_spend(users.to_numpy(), pairs, subcat_spend, subcat_present)
+
+
+def score_rows(customer_ids: np.ndarray, primary_categories: np.ndarray, subcategories: np.ndarray,
+               total_subcat_spent: np.ndarray, mean_subcat: np.ndarray, std_subcat: np.ndarray,
+               total_main_spent: np.ndarray, mean_main: np.ndarray, std_main: np.ndarray) -> pd.DataFrame:
+    """
+    Scored rows from the spend of (user, category, subcategory) rows and the mean and standard
+    deviation of their subcategory and primary category over all users.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        main_z_score = (total_main_spent - mean_main) / std_main
+        subcat_z_score = (total_subcat_spent - mean_subcat) / std_subcat
+    subcat_z_score[std_subcat == 0] = np.nan
+
+    use_subcat = ~np.isnan(subcat_z_score) & (np.abs(subcat_z_score) >= np.abs(main_z_score))
+    final_z_score = np.where(use_subcat, subcat_z_score, main_z_score)
+
+    return pd.DataFrame({
+        'customer_id': customer_ids,
+        'primary_category': primary_categories,
+        'subcategory': subcategories,
+        'total_subcat_spent': total_subcat_spent,
+        'mean_subcat_spent': mean_subcat,
+        'std_subcat_spent': std_subcat,
+        'total_main_spent': total_main_spent,
+        'mean_main_spent': mean_main,
+        'std_main_spent': std_main,
+        'main_z_score': main_z_score,
+        'subcat_z_score': subcat_z_score,
+        'final_z_score': final_z_score,
+        'anomaly_level': np.where(use_subcat, 'subcategory', 'main_category'),
+        'is_anomaly': final_z_score > ANOMALY_Z_SCORE_THRESHOLD,
+    }, columns=SCORE_COLUMNS)
+
+
+def score_spend(users: np.ndarray, pairs: pd.MultiIndex, subcat_spend: np.ndarray,
+                subcat_present: np.ndarray) -> CohortScores:
+    """
+    Scores a users x (category, subcategory) spend matrix. `pairs` must be sorted, so that the
+    subcategories of each primary category are adjacent columns.
+    """
+    pair_categories = pairs.get_level_values(0)
+    pair_subcategories = pairs.get_level_values(1)
+    pair_main_codes, categories = pd.factorize(pair_categories, sort=True)
+    n_users = len(users)
+
+    # Users x category spend matrix, summed over the adjacent subcategory columns
+    category_starts = np.searchsorted(pair_main_codes, np.arange(len(categories)))
+    if len(categories):
+        main_spend = np.add.reduceat(subcat_spend, category_starts, axis=1)
+        main_present = np.add.reduceat(subcat_present.astype(np.int64), category_starts, axis=1) > 0
+    else:
+        main_spend = np.zeros((n_users, 0))
+        main_present = np.zeros((n_users, 0), dtype=bool)
+
+    main_totals, main_counts, mean_main, main_squared_deviation, std_main = _column_statistics(
+        main_spend, main_present
+    )
+
+    # "Unknown" subcategories are not compared against other users
+    known_subcategory = np.asarray(pair_subcategories != "Unknown")
+    _, _, mean_subcat, subcat_squared_deviation, std_subcat = _column_statistics(
+        subcat_spend, subcat_present & known_subcategory
+    )
+    mean_subcat[~known_subcategory] = np.nan
+    std_subcat[~known_subcategory] = np.nan
+
+    # One row per present (user, category, subcategory), in customer/category order
+    rows, columns = np.nonzero(subcat_present)
+    main_columns = pair_main_codes[columns]
+
+    table = score_rows(
+        users[rows], np.asarray(pair_categories)[columns], np.asarray(pair_subcategories)[columns],
+        subcat_spend[rows, columns], mean_subcat[columns], std_subcat[columns],
+        main_spend[rows, main_columns], mean_main[main_columns], std_main[main_columns]
+    )
+
+    # Rows are grouped by user, so each user owns one contiguous slice
+    boundaries = np.searchsorted(rows, np.arange(n_users + 1))
+    user_ids = users.tolist()
+    user_rows = {user_ids[i]: (int(boundaries[i]), int(boundaries[i + 1])) for i in range(n_users)}
+
+    return CohortScores(
+        table=table,
+        user_rows=user_rows,
+        user_index={user_id: i for i, user_id in enumerate(user_ids)},
+        category_index={category: i for i, category in enumerate(categories)},
+        subcategory_index={pair: i for i, pair in enumerate(pairs)},
+        main_spend=main_spend,
+        main_present=main_present,
+        main_totals=main_totals,
+        main_counts=main_counts,
+        main_squared_deviation=main_squared_deviation,
+        subcat_spend=subcat_spend,
+        subcat_present=subcat_present,
+        subcat_totals=np.where(subcat_present, subcat_spend, 0.0).sum(axis=0),
+        subcat_counts=subcat_present.sum(axis=0),
+        subcat_squared_deviation=subcat_squared_deviation,
+    )
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='cohort_scoring', stage='score_window')
+def score_window(cube: SpendingCube, year: int, month: int) -> CohortScores:
+    spend, count, _ = cube.window((year, 1), (year, month))
+    return score_spend(cube.users, cube.pairs, spend, count > 0)
+
+
+def get_cohort_scores(snapshot, year: int, month: int) -> CohortScores:
+    """
+    Scores of all users on a snapshot for the spending from January up to the given month of
+    `year`, computed once per (snapshot, year, month) from the spending cube and reused by every
+    later request. They are kept with the snapshot and dropped together with it.
+    """
+    return snapshot.derived.get(('cohort_scores', year, month),
+                                lambda: score_window(get_spending_cube(snapshot), year, month))
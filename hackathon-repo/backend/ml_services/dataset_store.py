@@ -0,0 +1,224 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from utils.environment_variables import DATA_DIR
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - the CSV files are used directly without pyarrow
+    pa = None
+    feather = None
+
+CACHE_DIR_NAME = 'cache'
+
+DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+
+# Columns of prepared spending rows kept by the compact layout, and the layout's columns
+COMPACT_SOURCE_COLUMNS = ['customer_id', 'receipt_id', 'total_price', 'issue_date', 'primary_category', 'subcategory']
+COMPACT_COLUMNS = ['customer_id', 'receipt_id', 'price_cents', 'issue_date', 'primary_category', 'subcategory']
+
+
+def split_category(category: pd.Series) -> pd.DataFrame:
+    """
+    Splits 'Primary/Subcategory' strings into two dictionary-encoded columns.
+    Missing parts and variations of 'null' become "Unknown".
+    """
+    # Object columns also when a part is missing in every row (or there are no rows)
+    parts = category.str.split('/', n=1, expand=True).reindex(columns=[0, 1]).astype(object)
+    primary_category = parts[0].fillna("Unknown").str.strip()
+    subcategory = parts[1].fillna("Unknown").str.strip().replace(['', 'null', 'Null', 'NULL'], 'Unknown')
+
+    return pd.DataFrame({
+        'primary_category': primary_category.astype('category'),
+        'subcategory': subcategory.astype('category'),
+    }, index=category.index)
+
+
+def prepare_spending_data(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parses 'issue_date', adds the month and splits 'category_item' into primary category and subcategory.
+    """
+    required_columns = ['customer_id', 'issue_date', 'total_price', 'category_item', 'receipt_id']
+    missing_columns = set(required_columns) - set(data.columns)
+    if missing_columns:
+        raise ValueError(f"Missing columns in data: {missing_columns}")
+
+    data = data.copy()
+    data['issue_date'] = pd.to_datetime(data['issue_date'], format=DATE_FORMAT, errors='coerce')
+    data['month'] = data['issue_date'].dt.month
+    data[['primary_category', 'subcategory']] = split_category(data['category_item'])
+    data['category_item'] = data['category_item'].astype('category')
+    data['receipt_id'] = data['receipt_id'].astype('category')
+
+    return data
+
+
+def prepare_receipts_data(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parses the receipt timestamps and dictionary-encodes the category.
+    """
+    data = data.copy()
+    data['issue_date'] = pd.to_datetime(data['issue_date'], format=DATE_FORMAT, errors='coerce')
+    data['create_date'] = pd.to_datetime(data['create_date'], format=DATE_FORMAT, errors='coerce')
+    data['category'] = data['category'].astype('category')
+
+    return data
+
+
+def prepare_timestamped_data(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parses the audit timestamp columns present in most exported tables.
+    """
+    data = data.copy()
+    for column in ('created_date', 'last_modified_date'):
+        if column in data.columns:
+            data[column] = pd.to_datetime(data[column], errors='coerce')
+
+    return data
+
+
+def compact_spending_data(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prepared spending rows in the compact layout the advice snapshot keeps in memory: int32
+    customer ids, receipt ids and categories dictionary-encoded (integer keys into one
+    vocabulary per column), prices as int32 cents and no month column, which the issue date
+    gives. The prices of the dataset have two decimals, so the cents are exact.
+    """
+    return pd.DataFrame({
+        'customer_id': data['customer_id'].to_numpy(dtype=np.int32),
+        'receipt_id': data['receipt_id'].astype('category'),
+        'price_cents': np.rint(data['total_price'].to_numpy(dtype=np.float64) * 100).astype(np.int32),
+        'issue_date': data['issue_date'],
+        'primary_category': data['primary_category'].astype('category'),
+        'subcategory': data['subcategory'].astype('category'),
+    }, index=data.index)
+
+
+def spending_prices(data: pd.DataFrame) -> np.ndarray:
+    """
+    Item prices of prepared or compact spending rows, as float64. Dividing the cents gives the
+    same doubles as parsing the prices from the CSV.
+    """
+    if 'price_cents' in data.columns:
+        return data['price_cents'].to_numpy(dtype=np.float64) / 100
+    return data['total_price'].to_numpy(dtype=np.float64)
+
+
+def memory_report(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Memory held by every column of a data frame, dictionaries and strings included, with the
+    total in the last row.
+    """
+    usage = data.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({
+        'column': usage.index,
+        'dtype': [str(data[name].dtype) for name in usage.index],
+        'bytes': usage.to_numpy(),
+    })
+    total = pd.DataFrame({'column': ['total'], 'dtype': [''], 'bytes': [int(usage.sum())]})
+    return pd.concat([report, total], ignore_index=True)
+
+
+# CSV file name -> function turning the raw CSV into typed columns
+DATASETS: Dict[str, Callable[[pd.DataFrame], pd.DataFrame]] = {
+    'Merged_Spending_Data.csv': prepare_spending_data,
+    'Receipts_with_customer_id.csv': prepare_receipts_data,
+    'Organizations.csv': prepare_timestamped_data,
+    'Users.csv': prepare_timestamped_data,
+}
+
+
+def cache_path(csv_path: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Location of the Arrow IPC copy of a CSV dataset, by default a 'cache' directory next to the CSV.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(csv_path), CACHE_DIR_NAME)
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f'{name}.arrow')
+
+
+def dataset_version(csv_path: str) -> str:
+    """
+    Version string of a dataset, changes whenever the source CSV is replaced or modified.
+    """
+    stat = os.stat(csv_path)
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def read_csv_dataset(csv_path: str) -> pd.DataFrame:
+    """
+    Reads a CSV dataset and converts it into typed columns.
+    """
+    prepare = DATASETS.get(os.path.basename(csv_path))
+    data = pd.read_csv(csv_path)
+    return prepare(data) if prepare is not None else data
+
+
+def convert_dataset(csv_path: str, cache_dir: Optional[str] = None) -> Optional[str]:
+    """
+    Writes the typed columns of a CSV dataset to an uncompressed Arrow IPC file, which can be
+    memory-mapped and read column by column. The file is replaced atomically.
+    """
+    if feather is None:
+        return None
+
+    target = cache_path(csv_path, cache_dir)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = f'{target}.{os.getpid()}.tmp'
+
+    table = pa.Table.from_pandas(read_csv_dataset(csv_path), preserve_index=False)
+    feather.write_feather(table, temporary, compression='uncompressed')
+    os.replace(temporary, target)
+
+    return target
+
+
+def convert_datasets(data_dir: str = DATA_DIR, cache_dir: Optional[str] = None) -> List[str]:
+    """
+    Converts all known datasets in the data directory. Returns the written files.
+    """
+    written = []
+    for file_name in DATASETS:
+        target = convert_dataset(os.path.join(data_dir, file_name), cache_dir)
+        if target is not None:
+            written.append(target)
+
+    return written
+
+
+def read_dataset(csv_path: str, columns: Optional[List[str]] = None,
+                 cache_dir: Optional[str] = None) -> pd.DataFrame:
+    """
+    Loads a dataset with typed columns, reading only the requested columns.
+
+    The memory-mapped Arrow copy is used when it is at least as new as the CSV; otherwise the
+    CSV is parsed as before.
+    """
+    cached = cache_path(csv_path, cache_dir)
+    if feather is not None and os.path.exists(cached) and \
+            os.path.getmtime(cached) >= os.path.getmtime(csv_path):
+        return feather.read_table(cached, columns=columns, memory_map=True).to_pandas()
+
+    data = read_csv_dataset(csv_path)
+    return data[columns] if columns is not None else data
+
+
+def append_rows(data: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prepared rows appended to prepared data; categorical columns keep one merged dictionary.
+    """
+    combined = pd.concat([data, rows[data.columns]], ignore_index=True)
+    for name in data.columns:
+        if isinstance(data[name].dtype, pd.CategoricalDtype):
+            combined[name] = union_categoricals([data[name], rows[name].astype('category')], ignore_order=True)
+    return combined
+
+
+if __name__ == '__main__':
+    for path in convert_datasets():
+        print(f"Written {path}")
@@ -0,0 +1,118 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from utils.environment_variables import DATA_DIR
+
+
+class FakeEkasaServer:
+    """
+    Stand-in for the eKasa receipt API, for tests and offline development.
+
+    Answers POST requests with a {'receiptId': ...} body like the real service, using the given
+    receipts. Unknown receipts get a 404. The first `failures` requests of every receipt get a
+    503, to exercise the retries. Every request is counted in `requests_by_receipt`.
+
+    Usage:
+        with FakeEkasaServer({'O-1': [{'name': 'Milk', 'price': 1.2, 'quantity': 2, 'itemType': 'K'}]}) as server:
+            store = ReceiptItemStore(db_path,
+                                     fetch_many=lambda ids: fetch_receipt_items_concurrently(ids, url=server.url))
+    """
+
+    def __init__(self, receipts: Dict[str, List[dict]], host: str = '127.0.0.1', port: int = 0, failures: int = 0):
+        self.receipts = receipts
+        self.failures = failures
+        self.requests_by_receipt: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/mdu/api/v1/opd/receipt/find'
+
+    @property
+    def request_count(self) -> int:
+        with self._lock:
+            return sum(self.requests_by_receipt.values())
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    receipt_id = json.loads(self.rfile.read(length) or b'{}').get('receiptId')
+                except ValueError:
+                    receipt_id = None
+
+                with server._lock:
+                    attempt = server.requests_by_receipt[receipt_id] = server.requests_by_receipt.get(receipt_id, 0) + 1
+
+                if attempt <= server.failures:
+                    status, body = 503, {'receipt': None}
+                elif receipt_id in server.receipts:
+                    status, body = 200, {'receipt': {'receiptId': receipt_id, 'items': server.receipts[receipt_id]}}
+                else:
+                    status, body = 404, {'receipt': None}
+
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'FakeEkasaServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'FakeEkasaServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def receipts_from_local_data(data_dir: str = DATA_DIR) -> Dict[str, List[dict]]:
+    """
+    Builds eKasa-like receipt items from the exported Receipts, ProductItems and Products tables.
+    """
+    receipts = pd.read_csv(f'{data_dir}/Receipts.csv', usecols=['id', 'receipt_id'])
+    product_items = pd.read_csv(f'{data_dir}/ProductItems.csv', usecols=['fs_receipt_id', 'product_id', 'quantity'])
+    products = pd.read_csv(f'{data_dir}/Products.csv', usecols=['id', 'name', 'item_type', 'price'])
+
+    items = product_items.merge(products, left_on='product_id', right_on='id') \
+        .merge(receipts, left_on='fs_receipt_id', right_on='id', suffixes=('_product', '_receipt'))
+
+    return {
+        receipt_id: [
+            {'name': row.name, 'price': row.price, 'quantity': row.quantity, 'itemType': row.item_type}
+            for row in group.itertuples()
+        ]
+        for receipt_id, group in items.groupby('receipt_id')
+    }
+
+
+if __name__ == '__main__':
+    # Serves the local receipts, point EKASA_RECEIPT_URL at the printed address
+    with FakeEkasaServer(receipts_from_local_data(), port=8081) as fake_server:
+        print(f"Fake eKasa API listening on {fake_server.url}")
+        threading.Event().wait()
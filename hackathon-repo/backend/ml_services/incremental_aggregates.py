@@ -0,0 +1,415 @@
+import math
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ml_services.cohort_scoring import CohortScores, get_cohort_scores, score_rows
+from ml_services.spending_cube import Period, get_spending_cube, ordinal_period, period_ordinal, spend_change
+from ml_services.spending_percentiles import SpendingPercentiles, get_spending_percentiles, rank_spend
+
+Pair = Tuple[str, str]
+
+
+@dataclass
+class RunningStats:
+    """
+    Sum, mean and variance of a changing set of values, updated in O(1) with Welford's algorithm.
+    """
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    total: float = 0.0
+
+    @classmethod
+    def of(cls, count: int, total: float, m2: float) -> 'RunningStats':
+        return cls(count=int(count), mean=total / count if count else 0.0, m2=float(m2), total=float(total))
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value: float) -> None:
+        if self.count <= 1:
+            self.count, self.mean, self.m2, self.total = 0, 0.0, 0.0, 0.0
+            return
+        old_mean = self.mean
+        self.mean = (self.count * old_mean - value) / (self.count - 1)
+        self.m2 = max(self.m2 - (value - old_mean) * (value - self.mean), 0.0)
+        self.total -= value
+        self.count -= 1
+
+    def replace(self, old_value: Optional[float], new_value: float) -> None:
+        """
+        Replaces a value by a new one, or adds the new one if `old_value` is None.
+        """
+        if old_value is not None:
+            self.remove(old_value)
+        self.add(new_value)
+
+    @property
+    def std(self) -> float:
+        """
+        Sample standard deviation, NaN for fewer than two values (like pandas).
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+
+class LiveScores:
+    """
+    The cohort scores of one window (January up to a month of a year) with the receipts ingested
+    after the snapshot added.
+
+    The scores of the snapshot are left as they are. The spend of the users who ingested receipts
+    is kept here, and the sum, mean and variance of every category and subcategory they touched
+    are running statistics, updated with the user's old and new spend. Adding a receipt costs
+    O(items), and a user's rows are scored on request against the current statistics.
+    """
+
+    def __init__(self, base: CohortScores):
+        self.base = base
+        self.user_subcat_spend: Dict[int, Dict[Pair, float]] = {}
+        self.user_main_spend: Dict[int, Dict[str, float]] = {}
+        self.subcat_stats: Dict[Pair, RunningStats] = {}
+        self.main_stats: Dict[str, RunningStats] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.user_subcat_spend)
+
+    def _subcat_stats(self, pair: Pair) -> RunningStats:
+        stats = self.subcat_stats.get(pair)
+        if stats is None:
+            column = self.base.subcategory_index.get(pair)
+            stats = self.subcat_stats[pair] = RunningStats() if column is None else RunningStats.of(
+                self.base.subcat_counts[column], self.base.subcat_totals[column],
+                self.base.subcat_squared_deviation[column]
+            )
+        return stats
+
+    def _main_stats(self, primary_category: str) -> RunningStats:
+        stats = self.main_stats.get(primary_category)
+        if stats is None:
+            column = self.base.category_index.get(primary_category)
+            stats = self.main_stats[primary_category] = RunningStats() if column is None else RunningStats.of(
+                self.base.main_counts[column], self.base.main_totals[column],
+                self.base.main_squared_deviation[column]
+            )
+        return stats
+
+    def _spend_of(self, user_id: int) -> Tuple[Dict[Pair, float], Dict[str, float]]:
+        """
+        The current spend of a user per (category, subcategory) and per category.
+        """
+        if user_id in self.user_subcat_spend:
+            return self.user_subcat_spend[user_id], self.user_main_spend[user_id]
+
+        rows = self.base.for_user(user_id)
+        subcat_spend = dict(zip(zip(rows['primary_category'], rows['subcategory']), rows['total_subcat_spent']))
+        main_spend = dict(zip(rows['primary_category'], rows['total_main_spent']))
+        return subcat_spend, main_spend
+
+    def add(self, user_id: int, primary_category: str, subcategory: str, amount: float) -> None:
+        with self._lock:
+            if user_id not in self.user_subcat_spend:
+                subcat_spend, main_spend = self._spend_of(user_id)
+                self.user_subcat_spend[user_id], self.user_main_spend[user_id] = subcat_spend, main_spend
+            subcat_spend, main_spend = self.user_subcat_spend[user_id], self.user_main_spend[user_id]
+
+            pair = (primary_category, subcategory)
+            old_subcat, old_main = subcat_spend.get(pair), main_spend.get(primary_category)
+            subcat_spend[pair] = (old_subcat or 0.0) + amount
+            main_spend[primary_category] = (old_main or 0.0) + amount
+            self._subcat_stats(pair).replace(old_subcat, subcat_spend[pair])
+            self._main_stats(primary_category).replace(old_main, main_spend[primary_category])
+
+    def for_user(self, user_id: int) -> pd.DataFrame:
+        """
+        Returns the scored rows of a single user (empty if the user has no spending).
+        """
+        with self._lock:
+            if not self.changed:
+                return self.base.for_user(user_id)
+
+            subcat_spend, main_spend = self._spend_of(user_id)
+            pairs = sorted(subcat_spend)
+            subcat_stats = [self._subcat_stats(pair) for pair in pairs]
+            main_stats = [self._main_stats(primary_category) for primary_category, _ in pairs]
+            # "Unknown" subcategories are not compared against other users
+            known = np.array([subcategory != "Unknown" for _, subcategory in pairs], dtype=bool)
+
+            return score_rows(
+                np.full(len(pairs), user_id, dtype=np.int64),
+                np.array([primary_category for primary_category, _ in pairs], dtype=object),
+                np.array([subcategory for _, subcategory in pairs], dtype=object),
+                np.array([subcat_spend[pair] for pair in pairs], dtype=np.float64),
+                np.where(known, [stats.mean for stats in subcat_stats], np.nan),
+                np.where(known, [stats.std for stats in subcat_stats], np.nan),
+                np.array([main_spend[primary_category] for primary_category, _ in pairs], dtype=np.float64),
+                np.array([stats.mean for stats in main_stats], dtype=np.float64),
+                np.array([stats.std for stats in main_stats], dtype=np.float64),
+            )
+
+    def peer_average(self, user_id: int, primary_category: str, subcategory: Optional[str] = None) -> float:
+        """
+        Average spend of all other users who spent in the category (or subcategory if given).
+        """
+        with self._lock:
+            if not self.changed:
+                return self.base.peer_average(user_id, primary_category, subcategory)
+
+            subcat_spend, main_spend = self._spend_of(user_id)
+            if subcategory is None:
+                stats, own = self._main_stats(primary_category), main_spend.get(primary_category)
+            else:
+                stats, own = self._subcat_stats((primary_category, subcategory)), subcat_spend.get(
+                    (primary_category, subcategory))
+
+            total, count = stats.total, stats.count
+            if own is not None:
+                total -= own
+                count -= 1
+            return total / count if count else np.nan
+
+
+class LivePercentiles:
+    """
+    The spending percentiles of the snapshot with the receipts ingested after it added.
+
+    The spends of the (category, month) groups a receipt touches are copied out of the snapshot
+    arrays once and kept sorted by replacing the user's old spend with the new one.
+    """
+
+    def __init__(self, base: SpendingPercentiles):
+        self.base = base
+        self.column_index = {label: column for column, label in
+                             enumerate(zip(base.labels['primary_category'], base.labels['subcategory']))}
+        self.user_cells: Dict[Tuple[int, int], Dict[Pair, float]] = {}
+        self.group_spends: Dict[Tuple[int, Pair], np.ndarray] = {}
+        self._lock = threading.RLock()
+
+    def _base_cells(self, user_id: int, ordinal: int) -> Dict[Pair, float]:
+        columns, spends = self.base.user_cells(user_id, ordinal_period(ordinal))
+        labels = self.base.labels.iloc[columns]
+        return dict(zip(zip(labels['primary_category'], labels['subcategory']), spends.tolist()))
+
+    def _spends(self, ordinal: int, label: Pair) -> np.ndarray:
+        spends = self.group_spends.get((ordinal, label))
+        if spends is None:
+            column = self.column_index.get(label)
+            spends = self.base.column_spends(ordinal_period(ordinal), column) if column is not None \
+                else np.empty(0)
+        return spends
+
+    def add(self, user_id: int, primary_category: str, subcategory: str, ordinal: int, amount: float) -> None:
+        with self._lock:
+            cells = self.user_cells.get((user_id, ordinal))
+            if cells is None:
+                cells = self.user_cells[(user_id, ordinal)] = self._base_cells(user_id, ordinal)
+
+            # The primary category, and the subcategory unless it is "Unknown"
+            labels = [(primary_category, '')] + ([(primary_category, subcategory)] if subcategory != "Unknown" else [])
+            for label in labels:
+                old_spend = cells.get(label)
+                new_spend = cells[label] = (old_spend or 0.0) + amount
+                spends = self._spends(ordinal, label)
+                if old_spend is not None:
+                    spends = np.delete(spends, np.searchsorted(spends, old_spend))
+                self.group_spends[(ordinal, label)] = np.insert(spends, np.searchsorted(spends, new_spend), new_spend)
+
+    def compare(self, user_id: int, period: Period) -> pd.DataFrame:
+        """
+        Percentile rank of the user's spend in every category and subcategory they bought in
+        during the month, see SpendingPercentiles.compare.
+        """
+        ordinal = period_ordinal(period)
+        with self._lock:
+            if not self.user_cells:
+                return self.base.compare(user_id, period)
+
+            cells = self.user_cells.get((user_id, ordinal))
+            if cells is None:
+                cells = self._base_cells(user_id, ordinal)
+            # Subcategories first, then primary categories, like the snapshot's columns
+            labels = sorted(cells, key=lambda label: (label[1] == '', label))
+            return rank_spend(
+                pd.DataFrame(labels, columns=['primary_category', 'subcategory'], dtype=object),
+                np.array([cells[label] for label in labels], dtype=np.float64),
+                [self._spends(ordinal, label) for label in labels]
+            )
+
+
+class LiveSpending:
+    """
+    The spending of a snapshot with the receipts ingested after it applied on top.
+
+    The receipts come from the snapshot's receipt journal, which all processes share. `sync`
+    applies the receipts after the last applied position to the scores and percentiles built so
+    far, in O(items), so every process follows the receipts ingested by any of them without
+    reloading the snapshot. Publishing a new snapshot folds the receipts into the arrays again.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.journal = snapshot.journal
+        self.position = snapshot.journal_position
+        # The latest receipt of every user, also of those already in the snapshot (see result_version)
+        self.user_positions: Dict[int, int] = \
+            self.journal.user_positions(until=self.position) if self.journal is not None else {}
+        # Spend per (user, primary category, subcategory, period ordinal) of the applied receipts
+        self.cells: Dict[Tuple[int, str, str, int], float] = {}
+        self.last_ordinal: Optional[int] = None
+        self._scores: Dict[Tuple[int, int], LiveScores] = {}
+        self._percentiles: Optional[LivePercentiles] = None
+        self._lock = threading.RLock()
+
+    def sync(self) -> None:
+        """
+        Applies the receipts ingested (by any process) since the last sync.
+        """
+        if self.journal is None:
+            return
+        with self._lock:
+            rows = self.journal.read(after=self.position)
+            if not rows.empty:
+                self.apply(rows)
+
+    def apply(self, rows: pd.DataFrame) -> None:
+        """
+        Applies prepared journal rows, in journal order.
+        """
+        with self._lock:
+            for position, user_id, primary_category, subcategory, issue_date, amount in rows[
+                ['position', 'customer_id', 'primary_category', 'subcategory', 'issue_date', 'total_price']
+            ].itertuples(index=False):
+                self.user_positions[user_id] = position
+                self.position = max(self.position, position)
+                if pd.isna(issue_date):
+                    continue
+
+                ordinal = period_ordinal((issue_date.year, issue_date.month))
+                key = (user_id, primary_category, subcategory, ordinal)
+                self.cells[key] = self.cells.get(key, 0.0) + amount
+                self.last_ordinal = max(self.last_ordinal if self.last_ordinal is not None else ordinal, ordinal)
+                for (year, month), scores in self._scores.items():
+                    if period_ordinal((year, 1)) <= ordinal <= period_ordinal((year, month)):
+                        scores.add(user_id, primary_category, subcategory, amount)
+                if self._percentiles is not None:
+                    self._percentiles.add(user_id, primary_category, subcategory, ordinal, amount)
+
+    def ingest(self, receipt_id: str, user_id: int, issue_date: datetime, items: List[dict]) -> int:
+        """
+        Records a receipt in the journal and applies it together with the receipts other
+        processes ingested meanwhile, and returns its position in the journal. Raises ValueError
+        if the receipt was already ingested.
+        """
+        if self.journal is None:
+            raise ValueError("The snapshot has no receipt journal to ingest into.")
+        position = self.journal.append(receipt_id, user_id, issue_date, items)
+        self.sync()
+        return position
+
+    def has_user(self, user_id: int) -> bool:
+        return user_id in self.snapshot.customer_ids or user_id in self.user_positions
+
+    @property
+    def last_period(self) -> Period:
+        """
+        The latest month with spending, in the snapshot or in the applied receipts.
+        """
+        last_period = get_spending_cube(self.snapshot).last_period
+        if self.last_ordinal is not None and self.last_ordinal > period_ordinal(last_period):
+            return ordinal_period(self.last_ordinal)
+        return last_period
+
+    def result_version(self, user_id: int) -> str:
+        """
+        Version under which the stored results of a user are kept: the snapshot's, followed by
+        the position of the user's latest receipt if they ingested any, so their results are
+        recomputed when they post a receipt while the results of other users are kept.
+        """
+        position = self.user_positions.get(user_id)
+        return self.snapshot.version if position is None else f"{self.snapshot.version}/{position}"
+
+    def scores(self, year: int, month: int) -> LiveScores:
+        """
+        The cohort scores from January up to `month` of `year`, with the applied receipts.
+        """
+        scores = self._scores.get((year, month))
+        if scores is None:
+            base = get_cohort_scores(self.snapshot, year, month)
+            with self._lock:
+                scores = self._scores.get((year, month))
+                if scores is None:
+                    scores = LiveScores(base)
+                    for (user_id, primary_category, subcategory, ordinal), amount in self.cells.items():
+                        if period_ordinal((year, 1)) <= ordinal <= period_ordinal((year, month)):
+                            scores.add(user_id, primary_category, subcategory, amount)
+                    self._scores[(year, month)] = scores
+        return scores
+
+    def compare_windows(self, user_id: int, end: Period, recent_months: int = 3, prior_months: int = 12,
+                        level: str = 'primary_category') -> pd.DataFrame:
+        """
+        The user's average monthly spend in the last `recent_months` months up to `end` against
+        the `prior_months` months before them (see SpendingCube.compare_windows), with the
+        applied receipts.
+        """
+        comparison = get_spending_cube(self.snapshot).compare_windows(end, recent_months, prior_months, level, user_id)
+        keys = ['primary_category'] if level == 'primary_category' else ['primary_category', 'subcategory']
+        end_ordinal = period_ordinal(end)
+        recent_start = end_ordinal - recent_months + 1
+        with self._lock:
+            applied = [((primary_category, subcategory)[:len(keys)], ordinal >= recent_start, amount)
+                       for (cell_user, primary_category, subcategory, ordinal), amount in self.cells.items()
+                       if cell_user == user_id and recent_start - prior_months <= ordinal <= end_ordinal]
+        if not applied:
+            return comparison
+
+        # Total spend per label in the recent and the prior months
+        averages = comparison[[*keys, 'recent_monthly_spent', 'prior_monthly_spent']]
+        spent = {tuple(labels): [recent * recent_months, prior * prior_months]
+                 for *labels, recent, prior in averages.itertuples(index=False)}
+        for labels, recent, amount in applied:
+            spent.setdefault(labels, [0.0, 0.0])[0 if recent else 1] += amount
+
+        labels = sorted(spent)
+        recent_average = np.array([spent[label][0] for label in labels]) / recent_months
+        prior_average = np.array([spent[label][1] for label in labels]) / prior_months
+        comparison = pd.DataFrame(labels, columns=keys, dtype=object)
+        comparison.insert(0, 'customer_id', user_id)
+        comparison['recent_monthly_spent'] = recent_average
+        comparison['prior_monthly_spent'] = prior_average
+        comparison['change_ratio'] = spend_change(recent_average, prior_average)
+        return comparison
+
+    def percentiles(self) -> LivePercentiles:
+        """
+        The spending percentiles with the applied receipts.
+        """
+        percentiles = self._percentiles
+        if percentiles is None:
+            base = get_spending_percentiles(self.snapshot)
+            with self._lock:
+                percentiles = self._percentiles
+                if percentiles is None:
+                    percentiles = LivePercentiles(base)
+                    for (user_id, primary_category, subcategory, ordinal), amount in self.cells.items():
+                        percentiles.add(user_id, primary_category, subcategory, ordinal, amount)
+                    self._percentiles = percentiles
+        return percentiles
+
+
+def get_live_spending(snapshot) -> LiveSpending:
+    """
+    The live spending of a snapshot, created once per snapshot and dropped together with it.
+    Call `sync` on it to pick up the receipts ingested since.
+    """
+    return snapshot.derived.get('live_spending', lambda: LiveSpending(snapshot))
@@ -0,0 +1,158 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from ml_services.dataset_store import read_dataset
+from ml_services.saving_categorizator import (ORGANIZATION_COLUMNS, ORGANIZATIONS_FILE, organizations_dataset,
+                                              receipts_dataset)
+from ml_services.shared_snapshot import Derived
+from ml_services.spending_cube import Period, ordinal_period, period_ordinal
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+MERCHANT_COLUMNS = ['customer_id', 'year', 'month', 'ico', 'total_spent', 'receipt_count']
+
+
+class MerchantIndex:
+    """
+    Hash index from a merchant's ICO to its organization (id, name and category).
+
+    Organizations.csv lists a few merchants more than once and some without an ICO; the first
+    row of every ICO is kept and rows without one are skipped.
+    """
+
+    def __init__(self, organizations: pd.DataFrame):
+        organizations = organizations[organizations['ico'].notna()].sort_values('id')
+        organizations = organizations.drop_duplicates(subset='ico')
+        self.merchants: Dict[int, dict] = {
+            int(ico): {'organization_id': int(organization_id), 'name': name,
+                       'category': category if isinstance(category, str) else None}
+            for ico, organization_id, name, category in zip(
+                organizations['ico'], organizations['id'], organizations['name'], organizations['category']
+            )
+        }
+
+    @classmethod
+    def from_csv(cls, file_path: str = ORGANIZATIONS_FILE) -> 'MerchantIndex':
+        return cls(read_dataset(file_path, columns=ORGANIZATION_COLUMNS))
+
+    def lookup(self, ico: int) -> Optional[dict]:
+        return self.merchants.get(int(ico))
+
+    def describe(self, ico: int) -> dict:
+        """
+        The organization of a merchant, with its ICO as the name when it is not in the index.
+        """
+        merchant = self.lookup(ico)
+        if merchant is None:
+            return {'ico': int(ico), 'organization_id': None, 'name': str(ico), 'category': None}
+        return {'ico': int(ico), **merchant}
+
+
+@dataclass(frozen=True, eq=False)
+class MerchantRollups:
+    """
+    Spending per (customer_id, year, month, merchant ICO) of all users, sorted by customer and
+    period, and the cohort totals per (period, merchant) over all customers.
+
+    `user_rows` maps a customer to its slice of `table` and `ordinals` holds the period ordinal
+    of every row, so the rows of a user and month are found by binary search. `cohort` is
+    indexed by (period ordinal, ico), so the peer figures of a user's merchants are one lookup.
+    """
+    table: pd.DataFrame
+    user_rows: dict
+    ordinals: np.ndarray
+    cohort: pd.DataFrame
+
+    def last_period(self, user_id: int, year: Optional[int] = None) -> Optional[Period]:
+        """
+        The latest month with receipts of the user, within `year` if given.
+        """
+        start, stop = self.user_rows.get(user_id, (0, 0))
+        ordinals = self.ordinals[start:stop]
+        if year is not None:
+            ordinals = ordinals[(ordinals >= period_ordinal((year, 1))) & (ordinals <= period_ordinal((year, 12)))]
+        return ordinal_period(ordinals.max()) if len(ordinals) else None
+
+    def for_user(self, user_id: int, period: Period) -> pd.DataFrame:
+        start, stop = self.user_rows.get(user_id, (0, 0))
+        ordinals = self.ordinals[start:stop]
+        ordinal = period_ordinal(period)
+        first = start + np.searchsorted(ordinals, ordinal, side='left')
+        last = start + np.searchsorted(ordinals, ordinal, side='right')
+        return self.table.iloc[first:last]
+
+    def top_merchants(self, user_id: int, period: Period, limit: int = 5) -> pd.DataFrame:
+        """
+        The merchants a user spent the most at in a month, with the average spend at the same
+        merchant of the other customers who shopped there that month.
+        """
+        user_rows = self.for_user(user_id, period).nlargest(limit, 'total_spent')
+        cohort = self.cohort.reindex(
+            pd.MultiIndex.from_arrays([np.full(len(user_rows), period_ordinal(period)), user_rows['ico'].to_numpy()])
+        )
+
+        peer_customers = cohort['customer_count'].to_numpy() - 1
+        peer_total = cohort['total_spent'].to_numpy() - user_rows['total_spent'].to_numpy()
+        user_month_total = self.for_user(user_id, period)['total_spent'].sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            peer_average = np.where(peer_customers > 0, peer_total / peer_customers, np.nan)
+            share = user_rows['total_spent'].to_numpy() / user_month_total
+
+        return pd.DataFrame({
+            'ico': user_rows['ico'].to_numpy(),
+            'total_spent': user_rows['total_spent'].to_numpy(),
+            'receipt_count': user_rows['receipt_count'].to_numpy(),
+            'share_of_month': share,
+            'peer_customers': peer_customers,
+            'peer_average_spent': peer_average,
+        })
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='merchant_index', stage='build_merchant_rollups')
+def build_merchant_rollups(receipts: pd.DataFrame) -> MerchantRollups:
+    """
+    Rolls the receipts up per customer, month (of the issue date) and merchant, and the result
+    per month and merchant over all customers, in one grouped pass each.
+    """
+    receipts = receipts.loc[receipts['issue_date'].notna(), ['customer_id', 'issue_date', 'ico', 'total_price']]
+    table = pd.DataFrame({
+        'customer_id': receipts['customer_id'].to_numpy(),
+        'year': receipts['issue_date'].dt.year.to_numpy(),
+        'month': receipts['issue_date'].dt.month.to_numpy(),
+        'ico': receipts['ico'].to_numpy(dtype=np.int64),
+        'total_price': receipts['total_price'].to_numpy(dtype=np.float64),
+    }).groupby(['customer_id', 'year', 'month', 'ico'], sort=True).agg(
+        total_spent=('total_price', 'sum'),
+        receipt_count=('total_price', 'size')
+    ).reset_index()[MERCHANT_COLUMNS]
+
+    ordinals = (table['year'] * 12 + table['month'] - 1).to_numpy(dtype=np.int64)
+    cohort = table.assign(ordinal=ordinals).groupby(['ordinal', 'ico']).agg(
+        total_spent=('total_spent', 'sum'),
+        receipt_count=('receipt_count', 'sum'),
+        customer_count=('customer_id', 'size')
+    ).sort_index()
+
+    users, starts = np.unique(table['customer_id'].to_numpy(), return_index=True)
+    stops = np.r_[starts[1:], len(table)]
+    user_rows = {user_id: (int(start), int(stop)) for user_id, start, stop in zip(users.tolist(), starts, stops)}
+
+    return MerchantRollups(table=table, user_rows=user_rows, ordinals=ordinals, cohort=cohort)
+
+
+def top_merchants_report(user_id: int, period: Period, limit: int = 5) -> List[dict]:
+    """
+    The top merchants of a user in a month against their peers, with the organization details.
+    """
+    index = merchant_index.get()
+    top = merchant_rollups.get().top_merchants(user_id, period, limit)
+    top = top.astype(object).where(top.notna(), None)
+    return [{**index.describe(row['ico']), **{key: value for key, value in row.items() if key != 'ico'}}
+            for row in top.to_dict(orient='records')]
+
+
+# Rebuilt when a new version of the organizations or receipts is published
+merchant_index = Derived(organizations_dataset, MerchantIndex)
+merchant_rollups = Derived(receipts_dataset, build_merchant_rollups)
@@ -0,0 +1,101 @@
+import asyncio
+import random
+import time
+from pprint import pprint
+from typing import Dict, Iterable, List, Optional
+
+import aiohttp
+
+from utils.environment_variables import EKASA_RECEIPT_URL
+from utils.metrics import OUTBOUND_REQUEST_SECONDS
+
+EKASA_HEADERS = {
+    'Accept': 'application/json, text/plain, */*',
+    'Content-Type': 'application/json;charset=UTF-8',
+    'User-Agent': 'Mozilla/5.0'
+}
+
+
+def parse_receipt_items(data: dict) -> Optional[List[dict]]:
+    """
+    Extracts the items from an eKasa receipt response. Returns None if the response holds no receipt.
+    """
+    receipt = data.get("receipt")
+    if not receipt:
+        return None
+    return receipt.get("items") or []
+
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _observe_call(start: float, outcome: str) -> None:
+    OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - start, service='ekasa', outcome=outcome)
+
+
+async def _fetch_one(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, receipt_id: str,
+                     url: str, retries: int, backoff: float) -> Optional[List[dict]]:
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            async with semaphore:
+                # Time the call itself, not the wait for the semaphore
+                start = time.perf_counter()
+                async with session.post(url, json={'receiptId': receipt_id}) as response:
+                    if response.status in RETRY_STATUSES and attempt < retries:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status)
+                    response.raise_for_status()
+                    items = parse_receipt_items(await response.json(content_type=None))
+            _observe_call(start, 'ok' if items is not None else 'no_receipt')
+            return items
+        except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+            if not retryable or attempt == retries:
+                _observe_call(start, 'failed')
+                pprint(f"An error occurred while fetching receipt items for {receipt_id}: {e}")
+                return None
+            _observe_call(start, 'retried')
+        except (aiohttp.ClientError, ValueError) as e:
+            _observe_call(start, 'failed')
+            pprint(f"An error occurred while fetching receipt items for {receipt_id}: {e}")
+            return None
+
+        # Exponential backoff with jitter, outside of the semaphore so other requests can proceed
+        await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+    return None
+
+
+async def fetch_receipt_items_batch(receipt_ids: Iterable[str], url: str = EKASA_RECEIPT_URL,
+                                    concurrency: int = 10, timeout: float = 10, retries: int = 2,
+                                    backoff: float = 0.25) -> Dict[str, Optional[List[dict]]]:
+    """
+    Fetches the items of many receipts concurrently over one pooled session.
+
+    Repeated IDs are requested once, at most `concurrency` requests are in flight and every request
+    is limited to `timeout` seconds. Transient failures are retried with exponential backoff.
+    Returns receipt ID -> items, or None for receipts that could not be fetched.
+    """
+    unique_ids = list(dict.fromkeys(receipt_ids))
+    if not unique_ids:
+        return {}
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(headers=EKASA_HEADERS, connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        results = await asyncio.gather(*(
+            _fetch_one(session, semaphore, receipt_id, url, retries, backoff) for receipt_id in unique_ids
+        ))
+
+    return dict(zip(unique_ids, results))
+
+
+def fetch_receipt_items_concurrently(receipt_ids: Iterable[str], **kwargs) -> Dict[str, Optional[List[dict]]]:
+    """
+    Synchronous wrapper around `fetch_receipt_items_batch` for the pandas code paths, which run
+    in worker threads without an event loop.
+    """
+    return asyncio.run(fetch_receipt_items_batch(receipt_ids, **kwargs))
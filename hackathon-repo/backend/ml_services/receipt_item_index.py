@@ -0,0 +1,128 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from utils.environment_variables import DATA_DIR
+from utils.lazy import Lazy
+
+RECEIPTS_FILE = f'{DATA_DIR}/Receipts.csv'
+PRODUCT_ITEMS_FILE = f'{DATA_DIR}/ProductItems.csv'
+PRODUCTS_FILE = f'{DATA_DIR}/Products.csv'
+
+# Item type of the discount lines of a receipt
+SALE_ITEM_TYPE = 'Z'
+
+
+class ReceiptItemIndex:
+    """
+    Local index from receipts to the items bought on them, built from the shipped
+    Receipts.csv, ProductItems.csv and Products.csv instead of asking the eKasa API.
+
+    Receipts and products are numbered by their row. The item rows are sorted by receipt, and
+    `offsets[r]:offsets[r + 1]` is the slice of items of receipt `r` (CSR layout), so the items
+    of any set of receipts are gathered with array operations.
+
+    Discounts are products of item type 'Z' with a negative price. They are linked to the item
+    they reduce through `ProductItems.discount_id`, and count once per unit of that item; items
+    of a 'Z' product themselves are counted as sale lines too. The sale amount of every receipt
+    is summed once when the index is built.
+    """
+
+    def __init__(self, receipts: pd.DataFrame, items: pd.DataFrame, products: pd.DataFrame):
+        self.receipt_ids = pd.Index(receipts['receipt_id'].astype(str))
+        self.product_names = products['name'].astype(str).str.strip().to_numpy()
+        self.product_categories = products['category'].to_numpy()
+
+        receipt_rows = pd.Index(receipts['id']).get_indexer(items['fs_receipt_id'])
+        product_rows = pd.Index(products['id']).get_indexer(items['product_id'])
+        known = (receipt_rows >= 0) & (product_rows >= 0)
+        order = np.argsort(receipt_rows[known], kind='stable')
+
+        self.item_receipts = receipt_rows[known][order]
+        self.item_products = product_rows[known][order]
+        self.item_quantities = items['quantity'].to_numpy(dtype=np.float64)[known][order]
+        self.item_prices = products['price'].to_numpy(dtype=np.float64)[self.item_products]
+        self.item_totals = self.item_prices * self.item_quantities
+        self.item_is_sale = (products['item_type'].to_numpy() == SALE_ITEM_TYPE)[self.item_products]
+
+        if 'discount_id' in items.columns:
+            discount_ids = items['discount_id'].fillna(-1).to_numpy(dtype=np.int64)
+            discount_rows = pd.Index(products['id']).get_indexer(discount_ids)[known][order]
+        else:
+            discount_rows = np.full(len(self.item_receipts), -1)
+        discount_prices = np.where(discount_rows >= 0, products['price'].to_numpy(dtype=np.float64)[discount_rows], 0.0)
+        self.item_discounts = discount_prices * self.item_quantities
+        self.item_sale_amounts = np.where(self.item_is_sale, self.item_totals, 0.0) + self.item_discounts
+
+        self.offsets = np.searchsorted(self.item_receipts, np.arange(len(self.receipt_ids) + 1))
+        self.receipt_sale_amounts = np.bincount(self.item_receipts, weights=self.item_sale_amounts,
+                                                minlength=len(self.receipt_ids))
+
+    @classmethod
+    def from_csv(cls, receipts_file: str = RECEIPTS_FILE, product_items_file: str = PRODUCT_ITEMS_FILE,
+                 products_file: str = PRODUCTS_FILE) -> 'ReceiptItemIndex':
+        receipts = pd.read_csv(receipts_file, usecols=['id', 'receipt_id'])
+        # The same fiscal receipt may be listed more than once; its items belong to the first row
+        receipts = receipts.drop_duplicates(subset='receipt_id')
+        items = pd.read_csv(product_items_file, usecols=['quantity', 'product_id', 'fs_receipt_id', 'discount_id'])
+        # Products.csv holds the category of a product, ProductCategories.csv lists many
+        # candidate categories per product, so it is not used for the join
+        products = pd.read_csv(products_file, usecols=['id', 'name', 'item_type', 'price', 'category'])
+        return cls(receipts, items, products)
+
+    def receipt_rows(self, receipt_ids: Iterable[str]) -> np.ndarray:
+        """
+        Rows of the given receipts in the index, -1 for receipts it does not know.
+        """
+        return self.receipt_ids.get_indexer(pd.Index(receipt_ids).astype(str))
+
+    def item_rows(self, receipt_ids: Iterable[str]) -> np.ndarray:
+        """
+        Positions of the item rows of all given receipts, in one gather over the CSR offsets.
+        """
+        rows = self.receipt_rows(receipt_ids)
+        rows = rows[rows >= 0]
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        # Position of every item within its receipt, added to the start of the receipt's slice
+        first = np.cumsum(lengths) - lengths
+        return np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+
+    def items(self, receipt_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        The items bought on the given receipts, one row per receipt line.
+        """
+        positions = self.item_rows(receipt_ids)
+        products = self.item_products[positions]
+        return pd.DataFrame({
+            'receipt_id': self.receipt_ids.to_numpy()[self.item_receipts[positions]],
+            'product_name': self.product_names[products],
+            'category': self.product_categories[products],
+            'price': self.item_prices[positions],
+            'quantity': self.item_quantities[positions],
+            'total_price': self.item_totals[positions],
+            'discount': self.item_discounts[positions],
+            'is_sale': self.item_is_sale[positions],
+        })
+
+    def product_spending(self, receipt_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        Spending and quantity per product over the given receipts, most expensive first.
+        """
+        product_spending = self.items(receipt_ids).groupby('product_name').agg(
+            total_spent=('total_price', 'sum'),
+            quantity=('quantity', 'sum')
+        ).reset_index()
+        return product_spending.sort_values(by='total_spent', ascending=False)
+
+    def sale_amounts(self, receipt_ids: Iterable[str]) -> np.ndarray:
+        """
+        Sum of the discounts and sale lines (price times quantity) of each given receipt, 0 for
+        unknown ones.
+        """
+        rows = self.receipt_rows(receipt_ids)
+        return np.where(rows >= 0, self.receipt_sale_amounts[rows], 0.0)
+
+
+receipt_item_index = Lazy(ReceiptItemIndex.from_csv)
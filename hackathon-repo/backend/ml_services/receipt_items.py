@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from cachetools import LRUCache, TTLCache
+
+from ml_services.receipt_fetcher import fetch_receipt_items_concurrently
+from utils.environment_variables import RECEIPT_ITEMS_DB
+from utils.lazy import Lazy
+from utils.metrics import CACHE_LOOKUPS
+
+
+class ReceiptItemStore:
+    """
+    Read-through cache of receipt items keyed by receipt ID.
+
+    A fiscal receipt never changes, so a successfully fetched receipt is kept forever: first in an
+    in-process LRU, then in a local SQLite file shared by all processes. Failed lookups are
+    remembered for `negative_ttl` seconds so a broken receipt is not requested on every call.
+    """
+
+    def __init__(self, db_path: str = RECEIPT_ITEMS_DB,
+                 fetch_many: Callable[[List[str]], Dict[str, Optional[List[dict]]]] = fetch_receipt_items_concurrently,
+                 memory_size: int = 4096, negative_ttl: float = 300):
+        self.db_path = db_path
+        self.fetch_many = fetch_many
+        self._memory = LRUCache(maxsize=memory_size)
+        self._failed = TTLCache(maxsize=memory_size, ttl=negative_ttl)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS receipt_items ("
+                "receipt_id TEXT PRIMARY KEY, items TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, so each thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def _load(self, receipt_ids: List[str]) -> Dict[str, List[dict]]:
+        found = {}
+        connection = self._connection()
+        # Stay well below SQLite's limit of bound parameters per statement
+        for start in range(0, len(receipt_ids), 500):
+            chunk = receipt_ids[start:start + 500]
+            rows = connection.execute(
+                f"SELECT receipt_id, items FROM receipt_items WHERE receipt_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            found.update((receipt_id, json.loads(items)) for receipt_id, items in rows)
+        return found
+
+    def _save(self, fetched: Dict[str, List[dict]]) -> None:
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO receipt_items (receipt_id, items, fetched_at) VALUES (?, ?, ?)",
+                [(receipt_id, json.dumps(items), time.time()) for receipt_id, items in fetched.items()]
+            )
+
+    def _remember(self, items_by_receipt: Dict[str, List[dict]]) -> None:
+        with self._lock:
+            for receipt_id, items in items_by_receipt.items():
+                self._memory[receipt_id] = items
+
+    def cached(self, receipt_ids: Iterable[str]):
+        """
+        Looks receipts up in memory and on disk without fetching.
+        Returns the found items and the IDs that still have to be fetched.
+        """
+        found, missing = {}, []
+        negative = 0
+        with self._lock:
+            for receipt_id in dict.fromkeys(receipt_ids):
+                if receipt_id in self._memory:
+                    found[receipt_id] = self._memory[receipt_id]
+                elif receipt_id in self._failed:
+                    found[receipt_id] = []
+                    negative += 1
+                else:
+                    missing.append(receipt_id)
+
+        stored = {}
+        if missing:
+            stored = self._load(missing)
+            self._remember(stored)
+            found.update(stored)
+            missing = [receipt_id for receipt_id in missing if receipt_id not in stored]
+
+        CACHE_LOOKUPS.inc(len(found) - negative - len(stored), cache='receipt_items', result='memory')
+        CACHE_LOOKUPS.inc(len(stored), cache='receipt_items', result='disk')
+        CACHE_LOOKUPS.inc(negative, cache='receipt_items', result='negative')
+        CACHE_LOOKUPS.inc(len(missing), cache='receipt_items', result='miss')
+        return found, missing
+
+    def store(self, fetched: Dict[str, Optional[List[dict]]]) -> None:
+        """
+        Records fetch results. Receipts that could not be fetched (None) are cached negatively.
+        """
+        succeeded = {receipt_id: items for receipt_id, items in fetched.items() if items is not None}
+        if succeeded:
+            self._save(succeeded)
+            self._remember(succeeded)
+
+        with self._lock:
+            for receipt_id, items in fetched.items():
+                if items is None:
+                    self._failed[receipt_id] = True
+
+    def get_many(self, receipt_ids: Iterable[str]) -> Dict[str, List[dict]]:
+        """
+        Returns the items of every receipt, fetching only the ones not cached yet in one batch.
+        """
+        found, missing = self.cached(receipt_ids)
+        if missing:
+            fetched = self.fetch_many(missing)
+            self.store(fetched)
+            found.update((receipt_id, items or []) for receipt_id, items in fetched.items())
+        return found
+
+    def get(self, receipt_id: str) -> List[dict]:
+        """
+        Returns the items of a receipt, an empty list if it could not be fetched.
+        """
+        return self.get_many([receipt_id])[receipt_id]
+
+
+receipt_item_store = Lazy(ReceiptItemStore)
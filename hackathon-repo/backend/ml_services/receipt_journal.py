@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from ml_services.dataset_store import DATE_FORMAT, prepare_spending_data
+from utils.environment_variables import INGESTED_RECEIPTS_DB
+from utils.lazy import Lazy
+
+# Columns of the journal rows before preparation, in the layout of the spending dataset
+JOURNAL_COLUMNS = ['position', 'customer_id', 'receipt_id', 'total_price', 'category_item', 'issue_date']
+
+
+class ReceiptJournal:
+    """
+    The receipts posted to the API, in a SQLite file shared by all processes.
+
+    Every receipt gets the next position in the journal. Receipt ids are unique in the table, so a
+    receipt posted twice is rejected by the database, also when the two posts reach different
+    worker processes. Processes follow the journal by reading the receipts after the last
+    position they applied (see incremental_aggregates).
+    """
+
+    def __init__(self, db_path: str = INGESTED_RECEIPTS_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS receipts ("
+                "position INTEGER PRIMARY KEY AUTOINCREMENT, receipt_id TEXT NOT NULL UNIQUE, "
+                "customer_id INTEGER NOT NULL, issue_date TEXT NOT NULL, ingested_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS receipt_items ("
+                "position INTEGER NOT NULL REFERENCES receipts (position), "
+                "category_item TEXT NOT NULL, total_price REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_receipt_items_position ON receipt_items (position)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, so each thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def append(self, receipt_id: str, user_id: int, issue_date: datetime, items: List[dict]) -> int:
+        """
+        Records a receipt with its items ('category_item' and 'total_price') and returns its
+        position. Raises ValueError if the receipt was already ingested.
+        """
+        try:
+            with self._connection() as connection:
+                position = connection.execute(
+                    "INSERT INTO receipts (receipt_id, customer_id, issue_date, ingested_at) VALUES (?, ?, ?, ?)",
+                    (receipt_id, user_id, issue_date.strftime(DATE_FORMAT), time.time())
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO receipt_items (position, category_item, total_price) VALUES (?, ?, ?)",
+                    [(position, item['category_item'], item['total_price']) for item in items]
+                )
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Receipt {receipt_id} was already ingested.")
+        return position
+
+    def last_position(self) -> int:
+        """
+        Position of the latest receipt, 0 for an empty journal.
+        """
+        return self._connection().execute("SELECT COALESCE(MAX(position), 0) FROM receipts").fetchone()[0]
+
+    def read(self, after: int = 0, until: Optional[int] = None) -> pd.DataFrame:
+        """
+        The prepared spending rows of the receipts with a position in (after, until], in
+        journal order, with their position.
+        """
+        rows = self._connection().execute(
+            "SELECT r.position, r.customer_id, r.receipt_id, i.total_price, i.category_item, r.issue_date "
+            "FROM receipts r JOIN receipt_items i ON i.position = r.position "
+            "WHERE r.position > ? AND r.position <= ? ORDER BY r.position, i.rowid",
+            (after, until if until is not None else 2 ** 63 - 1)
+        ).fetchall()
+        rows = pd.DataFrame(rows, columns=JOURNAL_COLUMNS).astype(
+            {'position': 'int64', 'customer_id': 'int64', 'total_price': 'float64'}
+        )
+        return prepare_spending_data(rows)
+
+    def user_positions(self, until: Optional[int] = None) -> Dict[int, int]:
+        """
+        Position of the latest receipt of every user who ingested one, up to `until`.
+        """
+        rows = self._connection().execute(
+            "SELECT customer_id, MAX(position) FROM receipts WHERE position <= ? GROUP BY customer_id",
+            (until if until is not None else 2 ** 63 - 1,)
+        ).fetchall()
+        return dict(rows)
+
+
+receipt_journal = Lazy(ReceiptJournal)
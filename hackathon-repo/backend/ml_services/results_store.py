@@ -0,0 +1,154 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import pandas as pd
+from cachetools import LRUCache
+
+from utils.environment_variables import RESULTS_DB
+from utils.lazy import Lazy
+from utils.metrics import CACHE_LOOKUPS
+
+
+@dataclass(frozen=True)
+class StoredResult:
+    """
+    Analysis results of one user for one period: the advice message and named result tables.
+    """
+    message: Optional[str]
+    frames: Dict[str, pd.DataFrame] = field(default_factory=dict)
+
+    def frame(self, name: str) -> Optional[pd.DataFrame]:
+        return self.frames.get(name)
+
+
+# The 'table' orient embeds the schema, so a stored frame is read back with the dtypes it was
+# written with (a float column of whole numbers stays float)
+FRAME_ORIENT = 'table'
+
+
+def _serialize(result: StoredResult) -> str:
+    return json.dumps({
+        'message': result.message,
+        'frames': {name: frame.to_json(orient=FRAME_ORIENT, index=False) for name, frame in result.frames.items()},
+    })
+
+
+def _deserialize(payload: str) -> StoredResult:
+    data = json.loads(payload)
+    return StoredResult(
+        message=data['message'],
+        frames={name: pd.read_json(io.StringIO(frame), orient=FRAME_ORIENT)
+                for name, frame in data['frames'].items()},
+    )
+
+
+class ResultsStore:
+    """
+    Analysis results keyed by (user_id, period, dataset_version).
+
+    Reads are served from a bounded in-memory LRU and fall back to a single SQLite file, which keeps
+    the results across restarts and shares them between worker processes. Because the dataset
+    version is part of the key, results of an older dataset are never returned for a newer one.
+    """
+
+    def __init__(self, db_path: str = RESULTS_DB, memory_size: int = 1024):
+        self.db_path = db_path
+        self._memory = LRUCache(maxsize=memory_size)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "user_id INTEGER NOT NULL, period TEXT NOT NULL, dataset_version TEXT NOT NULL, "
+                "payload TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (user_id, period, dataset_version))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, so each thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def get(self, user_id: int, period: str, dataset_version: str) -> Optional[StoredResult]:
+        """
+        Returns the stored result or None if it was not computed yet.
+        """
+        key = (user_id, period, dataset_version)
+        with self._lock:
+            result = self._memory.get(key)
+        if result is not None:
+            CACHE_LOOKUPS.inc(cache='results', result='memory')
+            return result
+
+        row = self._connection().execute(
+            "SELECT payload FROM results WHERE user_id = ? AND period = ? AND dataset_version = ?", key
+        ).fetchone()
+        if row is None:
+            CACHE_LOOKUPS.inc(cache='results', result='miss')
+            return None
+
+        CACHE_LOOKUPS.inc(cache='results', result='disk')
+        result = _deserialize(row[0])
+        with self._lock:
+            self._memory[key] = result
+        return result
+
+    def put(self, user_id: int, period: str, dataset_version: str, result: StoredResult) -> None:
+        """
+        Stores a result, replacing an earlier one with the same key.
+        """
+        key = (user_id, period, dataset_version)
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results (user_id, period, dataset_version, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (*key, _serialize(result), time.time())
+            )
+        with self._lock:
+            self._memory[key] = result
+
+    def delete_other_versions(self, dataset_version: str) -> int:
+        """
+        Removes results computed on other dataset versions, keeping those of users versioned on
+        top of `dataset_version` (`<dataset_version>/...`). Returns the number of removed rows.
+        """
+        prefix = f"{dataset_version}/"
+        with self._connection() as connection:
+            removed = connection.execute(
+                "DELETE FROM results WHERE dataset_version != ? AND substr(dataset_version, 1, ?) != ?",
+                (dataset_version, len(prefix), prefix)
+            ).rowcount
+        self._forget(lambda key: key[2] != dataset_version and not key[2].startswith(prefix))
+        return removed
+
+    def delete_user_versions(self, user_id: int, dataset_version: str) -> int:
+        """
+        Removes the results of a user computed on other versions. Returns the number of removed rows.
+        """
+        with self._connection() as connection:
+            removed = connection.execute(
+                "DELETE FROM results WHERE user_id = ? AND dataset_version != ?", (user_id, dataset_version)
+            ).rowcount
+        self._forget(lambda key: key[0] == user_id and key[2] != dataset_version)
+        return removed
+
+    def _forget(self, predicate) -> None:
+        with self._lock:
+            for key in [key for key in self._memory if predicate(key)]:
+                del self._memory[key]
+
+
+# Created on first use, so importing the module does not touch the disk
+results_store = Lazy(ResultsStore)
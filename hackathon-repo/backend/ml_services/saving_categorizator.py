@@ -1,23 +1,54 @@
 import pandas as pd
-import requests
-from pprint import pprint
 
+from ml_services.receipt_item_index import receipt_item_index
+from ml_services.shared_snapshot import SharedDataset, shared_dataset
+from utils.environment_variables import DATA_DIR
+from utils.lazy import Lazy
+from utils.metrics import instrument_stages
 
+USERS_FILE = f'{DATA_DIR}/Users.csv'
+RECEIPTS_FILE = f'{DATA_DIR}/Receipts_with_customer_id.csv'
+ORGANIZATIONS_FILE = f'{DATA_DIR}/Organizations.csv'
+
+# The columns the analyses read; only these are loaded and published
+RECEIPT_COLUMNS = ['customer_id', 'receipt_id', 'ico', 'issue_date', 'create_date', 'total_price', 'category']
+ORGANIZATION_COLUMNS = ['id', 'name', 'ico', 'category']
+
+# CSV file -> columns of the datasets shared by the workers (None for all columns)
+SHARED_DATASETS = {
+    USERS_FILE: None,
+    RECEIPTS_FILE: RECEIPT_COLUMNS,
+    ORGANIZATIONS_FILE: ORGANIZATION_COLUMNS,
+}
+
+
+@instrument_stages('get_transactions_for_user', 'get_sale_amount_for_receipt', 'get_savings_per_category')
 class UserTransactionAnalyzer:
-    def __init__(self, users_file, receipts_file, organizations_file):
-        # Load datasets
-        self.organizations_df = pd.read_csv(organizations_file)
-        self.receipts_df = pd.read_csv(receipts_file)
-        self.users_df = pd.read_csv(users_file)
+    def __init__(self, users: SharedDataset, receipts: SharedDataset, organizations: SharedDataset):
+        # The datasets are attached from the published snapshots, or read on first use
+        self.users = users
+        self.receipts = receipts
+        self.organizations = organizations
+
+    @property
+    def organizations_df(self) -> pd.DataFrame:
+        return self.organizations.get()
+
+    @property
+    def receipts_df(self) -> pd.DataFrame:
+        return self.receipts.get()
 
-        # Ensure 'create_date' is in datetime format, with error handling
-        self.receipts_df['create_date'] = pd.to_datetime(self.receipts_df['create_date'], errors='coerce')
+    @property
+    def users_df(self) -> pd.DataFrame:
+        return self.users.get()
 
     def get_transactions_for_user(self, user_id: int, year: int = None, month: int = None):
         # Filter by user_id
         user_transactions = self.receipts_df[self.receipts_df['customer_id'] == user_id]
 
-        # Filter by year and month if specified
+        # Filter by year and month if specified; a month without a year is in the user's latest year
+        if month and not year and not user_transactions.empty:
+            year = int(user_transactions['create_date'].dt.year.max())
         if year:
             user_transactions = user_transactions[user_transactions['create_date'].dt.year == year]
         if month:
@@ -32,62 +63,39 @@ class UserTransactionAnalyzer:
         return user_transactions, categories
 
     @staticmethod
-    def get_receipt_items(receipt_id):
+    def get_sale_amount_for_receipt(receipt_id):
         """
-        Fetches receipt data from the API using the provided receipt ID and returns the receipt items.
+        Calculates the total sale amount for a given receipt ID from the local receipt item index.
         """
-        url = 'https://ekasa.financnasprava.sk/mdu/api/v1/opd/receipt/find'
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json;charset=UTF-8',
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36'
-        }
-        payload = {'receiptId': receipt_id}
-
-        response = requests.post(url, headers=headers, json=payload)
-
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("receipt", {}).get("items", [])
-        else:
-            pprint(f"Request failed with status code {response.status_code}")
-            return []
-
-    def get_sale_amount_for_receipt(self, receipt_id):
-        items = self.get_receipt_items(receipt_id)
-        sale_amount = sum(
-            item.get('price', 0) * item.get('quantity', 1)
-            for item in items if item.get('itemType') == 'Z'
-        )
-        return sale_amount
+        return float(receipt_item_index.get().sale_amounts([receipt_id])[0])
 
     def get_savings_per_category(self, user_transactions, categories):
-        sale_amount_per_category = {}
+        """
+        Calculates the total savings per category for a user's transactions, summing the sale
+        amounts of the distinct receipts of each category in one grouped pass.
+        """
+        receipts = user_transactions[['category', 'receipt_id']].drop_duplicates()
+        sale_amounts = pd.Series(receipt_item_index.get().sale_amounts(receipts['receipt_id']),
+                                 index=receipts['category'].to_numpy())
+        sale_amount_per_category = sale_amounts.groupby(level=0).sum()
+
+        return {category: float(sale_amount_per_category.get(category, 0.0)) for category in categories}
+
+
+users_dataset = shared_dataset(USERS_FILE)
+receipts_dataset = shared_dataset(RECEIPTS_FILE, RECEIPT_COLUMNS)
+organizations_dataset = shared_dataset(ORGANIZATIONS_FILE, ORGANIZATION_COLUMNS)
 
-        for category in categories:
-            category_transactions = user_transactions[user_transactions['category'] == category]
-            total_sale_amount = sum(
-                self.get_sale_amount_for_receipt(receipt_id)
-                for receipt_id in category_transactions['receipt_id'].unique()
-            )
-            sale_amount_per_category[category] = total_sale_amount
 
-        return sale_amount_per_category
+def load_saving_categorizator() -> UserTransactionAnalyzer:
+    return UserTransactionAnalyzer(users_dataset, receipts_dataset, organizations_dataset)
 
 
-saving_categorizator = UserTransactionAnalyzer(
-    users_file='ml_services/data/Users.csv',
-    receipts_file='ml_services/data/Receipts_with_customer_id.csv',
-    organizations_file='ml_services/data/Organizations.csv'
-)
+saving_categorizator = Lazy(load_saving_categorizator)
 
 if __name__ == '__main__':
     # Example usage
-    analyzer = UserTransactionAnalyzer(
-        users_file='ml_services/data/Users.csv',
-        receipts_file='ml_services/data/Receipts_with_customer_id.csv',
-        organizations_file='ml_services/data/Organizations.csv'
-    )
+    analyzer = saving_categorizator.get()
 
     # Step 1: Get user transactions and categories
     user_transactions, categories = analyzer.get_transactions_for_user(user_id=2, year=2024, month=10)
@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from ml_services.receipt_item_index import ReceiptItemIndex, receipt_item_index
+from ml_services.saving_categorizator import receipts_dataset
+from ml_services.shared_snapshot import Derived
+from ml_services.spending_cube import Period, ordinal_period, period_ordinal
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+SAVINGS_COLUMNS = ['customer_id', 'year', 'month', 'category', 'sale_amount', 'receipt_count']
+
+
+@dataclass(frozen=True, eq=False)
+class SavingsTable:
+    """
+    Sale amounts of all users per (customer_id, year, month, category), one row per
+    combination with receipts, sorted by customer and period.
+
+    `user_rows` maps a customer to its slice of the table and `ordinals` holds the period
+    ordinal of every row, so the rows of a user and period range are found by binary search.
+    """
+    table: pd.DataFrame
+    user_rows: dict
+    ordinals: np.ndarray
+
+    def last_period(self, user_id: Optional[int] = None) -> Optional[Period]:
+        """
+        The latest period with receipts of the user, or of anyone if no user is given.
+        """
+        start, stop = self.user_rows.get(user_id, (0, 0)) if user_id is not None else (0, len(self.ordinals))
+        return ordinal_period(self.ordinals[start:stop].max()) if stop > start else None
+
+    def for_user(self, user_id: int, start: Period, end: Period) -> pd.DataFrame:
+        """
+        The rows of a user from the `start` period to the `end` period (inclusive).
+        """
+        user_start, user_stop = self.user_rows.get(user_id, (0, 0))
+        ordinals = self.ordinals[user_start:user_stop]
+        first = user_start + np.searchsorted(ordinals, period_ordinal(start), side='left')
+        last = user_start + np.searchsorted(ordinals, period_ordinal(end), side='right')
+        return self.table.iloc[first:last]
+
+    def savings_per_category(self, user_id: int, start: Period, end: Period) -> dict:
+        """
+        Sale amount per category of a user over a period range, categories without sales included.
+        """
+        rows = self.for_user(user_id, start, end)
+        totals = rows.groupby('category', sort=False)['sale_amount'].sum()
+        return {category: float(amount) for category, amount in totals.items()}
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='savings_engine', stage='build_savings_table')
+def build_savings_table(receipts: pd.DataFrame, index: ReceiptItemIndex) -> SavingsTable:
+    """
+    Sums the sale amounts of every user's receipts per category and month in one grouped pass.
+    Receipts are placed in the month they were created, like the per-user analysis does, and
+    receipts without a category are left out.
+    """
+    receipts = receipts.loc[receipts['category'].notna() & receipts['create_date'].notna(),
+                            ['customer_id', 'create_date', 'category', 'receipt_id']]
+    receipts = receipts.drop_duplicates(subset=['customer_id', 'category', 'receipt_id'])
+
+    rows = pd.DataFrame({
+        'customer_id': receipts['customer_id'].to_numpy(),
+        'year': receipts['create_date'].dt.year.to_numpy(),
+        'month': receipts['create_date'].dt.month.to_numpy(),
+        'category': np.asarray(receipts['category'], dtype=object),
+        'sale_amount': index.sale_amounts(receipts['receipt_id']),
+    })
+    table = rows.groupby(['customer_id', 'year', 'month', 'category'], sort=True).agg(
+        sale_amount=('sale_amount', 'sum'),
+        receipt_count=('sale_amount', 'size')
+    ).reset_index()[SAVINGS_COLUMNS]
+
+    customers = table['customer_id'].to_numpy()
+    users, starts = np.unique(customers, return_index=True)
+    stops = np.r_[starts[1:], len(table)]
+    user_rows = {user_id: (int(start), int(stop)) for user_id, start, stop in zip(users.tolist(), starts, stops)}
+
+    return SavingsTable(
+        table=table,
+        user_rows=user_rows,
+        ordinals=(table['year'] * 12 + table['month'] - 1).to_numpy(dtype=np.int64),
+    )
+
+
+def load_savings_table(receipts: pd.DataFrame) -> SavingsTable:
+    return build_savings_table(receipts, receipt_item_index.get())
+
+
+# Rebuilt when a new version of the receipts is published
+savings_table = Derived(receipts_dataset, load_savings_table)
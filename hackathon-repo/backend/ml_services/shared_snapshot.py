@@ -0,0 +1,347 @@
+import functools
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+import numpy as np
+import pandas as pd
+
+from ml_services.dataset_store import dataset_version, read_dataset
+from utils.environment_variables import SNAPSHOT_CHECK_INTERVAL, SNAPSHOT_DIR
+
+T = TypeVar('T')
+
+MANIFEST_FILE = 'manifest.json'
+# Name of the file holding the version all processes should use
+CURRENT_FILE = 'CURRENT'
+# Directory of the derived tables inside a version
+TABLES_DIR = 'tables'
+# Directory of the datasets published on their own, inside the snapshot root
+DATASETS_DIR = 'datasets'
+
+_MISSING = object()
+
+
+def _column_file(directory: str, name: str) -> str:
+    return os.path.join(directory, f'{name}.npy')
+
+
+def _write_frame(data: pd.DataFrame, directory: str, manifest: dict) -> None:
+    """
+    Writes every column of a frame as one .npy file and the manifest describing them.
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = {}
+    for name in data.columns:
+        column = data[name]
+        if column.dtype == object or pd.api.types.is_string_dtype(column):
+            # Strings cannot be memory-mapped, they are stored dictionary-encoded
+            column = column.astype('category')
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            np.save(_column_file(directory, name), column.cat.codes.to_numpy())
+            columns[name] = {'kind': 'categorical', 'categories': column.cat.categories.tolist()}
+        elif pd.api.types.is_datetime64_any_dtype(column):
+            np.save(_column_file(directory, name), column.to_numpy(dtype='datetime64[ns]').view(np.int64))
+            columns[name] = {'kind': 'datetime'}
+        else:
+            np.save(_column_file(directory, name), column.to_numpy())
+            columns[name] = {'kind': 'values'}
+
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as file:
+        json.dump({**manifest, 'rows': len(data), 'columns': columns}, file)
+
+
+def publish(data: pd.DataFrame, version: str, root: str = SNAPSHOT_DIR, keep: int = 2,
+            tables: Optional[Dict[str, pd.DataFrame]] = None) -> str:
+    """
+    Writes prepared data as a read-only snapshot and makes it the current version.
+
+    Every column becomes one .npy file: numbers and dates as their values, categoricals and
+    strings as their codes, with the categories in the manifest. `tables` are arrays derived
+    from the data (for example the spending cube), written the same way next to it, so they
+    are computed once and shared too. The version directory is written under a temporary name
+    and renamed, then the CURRENT pointer is replaced atomically, so readers see either the old
+    or the new snapshot, never a partial one. Only the `keep` newest versions are kept;
+    processes still attached to a removed version keep their mapping.
+    """
+    target = os.path.join(root, version)
+    if not os.path.exists(target):
+        temporary = f'{target}.{os.getpid()}.tmp'
+        tables = tables or {}
+        for name, table in tables.items():
+            _write_frame(table, os.path.join(temporary, TABLES_DIR, name), {'version': version, 'table': name})
+        _write_frame(data, temporary, {'version': version, 'created_at': time.time(), 'tables': sorted(tables)})
+        try:
+            os.replace(temporary, target)
+        except OSError:
+            # Another process published the same version meanwhile
+            if not os.path.exists(target):
+                raise
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    pointer = os.path.join(root, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(pointer, 'w') as file:
+        file.write(version)
+    os.replace(pointer, os.path.join(root, CURRENT_FILE))
+
+    for old_version in published_versions(root)[:-keep]:
+        if old_version != version:
+            shutil.rmtree(os.path.join(root, old_version), ignore_errors=True)
+    return target
+
+
+def publish_dataset(csv_path: str, columns: Optional[List[str]] = None, root: str = SNAPSHOT_DIR,
+                    derive: Optional[Callable[[pd.DataFrame], Dict[str, pd.DataFrame]]] = None) -> str:
+    """
+    Publishes the prepared columns of a CSV dataset under the dataset's version, with the
+    tables `derive` computes from them.
+    """
+    data = read_dataset(csv_path, columns=columns)
+    return publish(data, dataset_version(csv_path), root, tables=derive(data) if derive is not None else None)
+
+
+def dataset_root(csv_path: str, root: str = SNAPSHOT_DIR) -> str:
+    """
+    Snapshot directory of a dataset published on its own, next to the spending snapshots.
+    """
+    return os.path.join(root, DATASETS_DIR, os.path.splitext(os.path.basename(csv_path))[0])
+
+
+def published_versions(root: str = SNAPSHOT_DIR) -> List[str]:
+    """
+    The complete snapshot versions in `root`, oldest first.
+    """
+    if not os.path.isdir(root):
+        return []
+    versions = [name for name in os.listdir(root)
+                if os.path.isfile(os.path.join(root, name, MANIFEST_FILE))]
+    return sorted(versions, key=lambda name: os.path.getmtime(os.path.join(root, name, MANIFEST_FILE)))
+
+
+def current_version(root: str = SNAPSHOT_DIR) -> Optional[str]:
+    """
+    The version the CURRENT pointer names, None if nothing was published.
+    """
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _read_frame(directory: str) -> pd.DataFrame:
+    with open(os.path.join(directory, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+
+    columns = {}
+    for name, column in manifest['columns'].items():
+        # A plain ndarray view of the mapping, so pandas results are not np.memmap subclasses
+        values = np.load(_column_file(directory, name), mmap_mode='r').view(np.ndarray)
+        if column['kind'] == 'categorical':
+            columns[name] = pd.Categorical.from_codes(values, categories=pd.Index(column['categories']),
+                                                      validate=False)
+        elif column['kind'] == 'datetime':
+            columns[name] = values.view('datetime64[ns]')
+        else:
+            columns[name] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def attach(version: str, root: str = SNAPSHOT_DIR, table: Optional[str] = None) -> pd.DataFrame:
+    """
+    Maps a published snapshot (or one of its derived tables) into memory as a data frame
+    without copying the rows.
+
+    The columns are read-only views of the files, so all processes attached to the same
+    version share one copy in the page cache; only the category labels are per process.
+    """
+    directory = os.path.join(root, version)
+    return _read_frame(os.path.join(directory, TABLES_DIR, table) if table is not None else directory)
+
+
+def attach_tables(version: str, root: str = SNAPSHOT_DIR) -> Dict[str, pd.DataFrame]:
+    """
+    Maps all derived tables published with a snapshot, by name.
+    """
+    with open(os.path.join(root, version, MANIFEST_FILE)) as file:
+        names = json.load(file).get('tables', [])
+    return {name: attach(version, root, name) for name in names}
+
+
+class DerivedCache:
+    """
+    Values derived from one snapshot (a cube, scores of a month, ...), built once on first use.
+
+    The cache is owned by the snapshot, so when a new version is attached and the old snapshot
+    is dropped, everything derived from it goes with it.
+    """
+
+    def __init__(self):
+        self._values = {}
+        # Reentrant, as derived values are built from other derived values
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, build: Callable[[], T]) -> T:
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            with self._lock:
+                value = self._values.get(key, _MISSING)
+                if value is _MISSING:
+                    value = self._values[key] = build()
+        return value
+
+
+class SharedDataset(Generic[T]):
+    """
+    Provider of a value built from the current published snapshot.
+
+    `get` looks at the CURRENT pointer at most every `check_interval` seconds and attaches to
+    a newly published version when it changed, so running workers switch to new data without
+    a restart. `build` gets the attached data, the version and the derived tables published
+    with it. Until anything is published, the value comes from `fallback` (for example by
+    reading the CSV), loaded again whenever `fallback_version` changes. `on_change` is called
+    with every newly attached or loaded value.
+    """
+
+    def __init__(self, build: Callable[[pd.DataFrame, str, Dict[str, pd.DataFrame]], T], fallback: Callable[[], T],
+                 root: str = SNAPSHOT_DIR, check_interval: float = SNAPSHOT_CHECK_INTERVAL,
+                 fallback_version: Optional[Callable[[], str]] = None,
+                 on_change: Optional[Callable[[T], None]] = None):
+        self.build = build
+        self.fallback = fallback
+        self.fallback_version = fallback_version
+        self.on_change = on_change
+        self.root = root
+        self.check_interval = check_interval
+        self._value: Optional[T] = None
+        self._version: Optional[str] = None
+        self._loaded_fallback_version: Optional[str] = None
+        self._checked = -float('inf')
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not None
+
+    @property
+    def version(self) -> Optional[str]:
+        """
+        The attached snapshot version, None when the fallback value is used.
+        """
+        return self._version
+
+    def get(self) -> T:
+        value = self._value
+        if value is not None and time.monotonic() - self._checked < self.check_interval:
+            return value
+
+        with self._lock:
+            if self._value is None or time.monotonic() - self._checked >= self.check_interval:
+                self._refresh()
+            return self._value
+
+    def _refresh(self) -> None:
+        version = current_version(self.root)
+        if version is not None and version != self._version:
+            try:
+                self._value = self.build(attach(version, self.root), version, attach_tables(version, self.root))
+                self._version = version
+                self._changed()
+            except (OSError, ValueError, KeyError):
+                # E.g. the version was pruned meanwhile; keep serving the attached one if any
+                if self._value is None:
+                    raise
+        elif version is None and self._fallback_changed():
+            # Released first, so the old and the new data are not both held while loading
+            self._value = None
+            self._loaded_fallback_version = self.fallback_version() if self.fallback_version is not None else None
+            self._value = self.fallback()
+            self._changed()
+        self._checked = time.monotonic()
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change(self._value)
+
+    def _fallback_changed(self) -> bool:
+        if self._value is None:
+            return True
+        return self.fallback_version is not None and self.fallback_version() != self._loaded_fallback_version
+
+    def expire(self) -> None:
+        """
+        Makes the next `get` look for new data right away instead of after the check interval.
+        """
+        self._checked = -float('inf')
+
+    def reset(self) -> None:
+        with self._lock:
+            self._value, self._version, self._checked = None, None, -float('inf')
+            self._loaded_fallback_version = None
+
+
+class Derived(Generic[T]):
+    """
+    Provider of a value built from the current value of a shared dataset, rebuilt when the
+    dataset switches to a new version. The old value is released before the new one is built.
+    """
+
+    def __init__(self, source: SharedDataset, build: Callable[[Any], T]):
+        self.source = source
+        self.build = build
+        self._cached: Optional[Tuple[Any, T]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._cached is not None
+
+    def get(self) -> T:
+        source_value = self.source.get()
+        cached = self._cached
+        if cached is None or cached[0] is not source_value:
+            with self._lock:
+                cached = self._cached
+                if cached is None or cached[0] is not source_value:
+                    self._cached = None
+                    cached = self._cached = (source_value, self.build(source_value))
+        return cached[1]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._cached = None
+
+
+def _attached_frame(data: pd.DataFrame, version: str, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    return data
+
+
+def shared_dataset(csv_path: str, columns: Optional[List[str]] = None,
+                   root: str = SNAPSHOT_DIR) -> SharedDataset[pd.DataFrame]:
+    """
+    The prepared columns of a CSV dataset, attached from its published snapshot (see
+    `dataset_root`) or read from the file until one is published.
+    """
+    return SharedDataset(build=_attached_frame, fallback=functools.partial(read_dataset, csv_path, columns),
+                         root=dataset_root(csv_path, root))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from ml_services.advice_engine import SPENDING_DATA_FILE, load_snapshot, publish_snapshot
+    from ml_services.saving_categorizator import SHARED_DATASETS
+
+    parser = argparse.ArgumentParser(description="Publish the spending dataset as the shared read-only snapshot.")
+    parser.add_argument('csv_path', nargs='?', default=SPENDING_DATA_FILE)
+    parser.add_argument('--root', default=SNAPSHOT_DIR)
+    arguments = parser.parse_args()
+
+    # The spending rows with the ingested receipts appended, under the version of both
+    snapshot = load_snapshot(arguments.csv_path)
+    print(f"Published {publish_snapshot(snapshot, arguments.root)}")
+    for csv_path, columns in SHARED_DATASETS.items():
+        print(f"Published {publish_dataset(csv_path, columns, dataset_root(csv_path, arguments.root))}")
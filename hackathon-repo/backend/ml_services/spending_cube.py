@@ -0,0 +1,312 @@
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ml_services.dataset_store import spending_prices
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+# A period is a (year, month) pair
+Period = Tuple[int, int]
+
+CATEGORY_LEVELS = ('subcategory', 'primary_category')
+
+
+def period_ordinal(period: Period) -> int:
+    year, month = period
+    return year * 12 + month - 1
+
+
+def ordinal_period(ordinal: int) -> Period:
+    year, month_index = divmod(int(ordinal), 12)
+    return year, month_index + 1
+
+
+def shift_period(period: Period, months: int) -> Period:
+    """
+    The period `months` months after (or before, if negative) the given one.
+    """
+    return ordinal_period(period_ordinal(period) + months)
+
+
+def spend_change(recent_average: np.ndarray, prior_average: np.ndarray) -> np.ndarray:
+    """
+    Relative change of the average monthly spend, NaN where nothing was spent before.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(prior_average > 0, (recent_average - prior_average) / prior_average, np.nan)
+
+
+@dataclass(frozen=True, eq=False)
+class SpendingCube:
+    """
+    Spending materialized as a sparse customer x (category, subcategory) x (year, month) cube.
+
+    Only occupied cells are stored (COO layout): cell `i` is user row `cell_users[i]`, pair
+    `cell_pairs[i]` and period offset `cell_periods[i]`, and holds the sum, the number and the
+    sum of squares of the item prices, so the total, mean and standard deviation of any period
+    range are obtained by summing cells, without going back to the raw rows. Cells are sorted by
+    user, period and pair, and `user_offsets[u]:user_offsets[u + 1]` is the slice of user row
+    `u` (CSR offsets), so the size follows the number of rows rather than users x pairs x
+    periods. Categories are sorted by (primary_category, subcategory), so the subcategories of a
+    primary category are adjacent pairs.
+    """
+    users: np.ndarray
+    pairs: pd.MultiIndex
+    first_ordinal: int
+    n_periods: int
+    cell_users: np.ndarray
+    cell_pairs: np.ndarray
+    cell_periods: np.ndarray
+    total: np.ndarray
+    count: np.ndarray
+    sum_of_squares: np.ndarray
+    user_offsets: np.ndarray
+
+    @property
+    def first_period(self) -> Period:
+        return ordinal_period(self.first_ordinal)
+
+    @property
+    def last_period(self) -> Period:
+        return ordinal_period(self.first_ordinal + self.n_periods - 1)
+
+    @property
+    def categories(self) -> pd.Index:
+        return self.pairs.get_level_values(0).unique()
+
+    def _category_codes(self) -> np.ndarray:
+        """
+        Position of the primary category of every pair in `categories`.
+        """
+        return pd.factorize(self.pairs.get_level_values(0), sort=True)[0]
+
+    def _columns(self, level: str) -> Tuple[np.ndarray, int]:
+        """
+        Column of every cell at the given level, and the number of columns.
+        """
+        if level == 'primary_category':
+            return self._category_codes()[self.cell_pairs], len(self.categories)
+        if level == 'subcategory':
+            return self.cell_pairs, len(self.pairs)
+        raise ValueError(f"Unknown category level '{level}', expected one of {CATEGORY_LEVELS}.")
+
+    def _user_row(self, user_id: int) -> Optional[int]:
+        row = np.searchsorted(self.users, user_id)
+        return int(row) if row < len(self.users) and self.users[row] == user_id else None
+
+    def _offset_range(self, start: Period, end: Period) -> Tuple[int, int]:
+        first = min(max(period_ordinal(start) - self.first_ordinal, 0), self.n_periods)
+        last = min(max(period_ordinal(end) - self.first_ordinal + 1, first), self.n_periods)
+        return first, last
+
+    def _window(self, start: Period, end: Period, level: str, user_row: Optional[int] = None):
+        columns, n_columns = self._columns(level)
+        first, last = self._offset_range(start, end)
+        cells = slice(self.user_offsets[user_row], self.user_offsets[user_row + 1]) \
+            if user_row is not None else slice(None)
+
+        in_range = (self.cell_periods[cells] >= first) & (self.cell_periods[cells] < last)
+        n_rows = 1 if user_row is not None else len(self.users)
+        rows = self.cell_users[cells][in_range] - (user_row if user_row is not None else 0)
+        keys = rows * n_columns + columns[cells][in_range]
+
+        size = n_rows * n_columns
+        shape = (n_rows, n_columns)
+        return (
+            np.bincount(keys, weights=self.total[cells][in_range], minlength=size).reshape(shape),
+            np.bincount(keys, weights=self.count[cells][in_range], minlength=size).astype(np.int64).reshape(shape),
+            np.bincount(keys, weights=self.sum_of_squares[cells][in_range], minlength=size).reshape(shape),
+        )
+
+    def window(self, start: Period, end: Period, level: str = 'subcategory'):
+        """
+        Sums, counts and sums of squares over the periods from `start` to `end` (inclusive), as
+        users x categories matrices. With level='primary_category' the subcategories are merged.
+        """
+        return self._window(start, end, level)
+
+    def _labels(self, level: str) -> pd.DataFrame:
+        if level == 'primary_category':
+            return pd.DataFrame({'primary_category': np.asarray(self.categories)})
+        return pd.DataFrame({'primary_category': np.asarray(self.pairs.get_level_values(0)),
+                             'subcategory': np.asarray(self.pairs.get_level_values(1))})
+
+    def _user_window(self, start: Period, end: Period, level: str, user_id: Optional[int] = None):
+        """
+        The window of all users, or of one user only (its matrices then have one row), with the
+        customer ids of the rows.
+        """
+        if user_id is None:
+            return self.users, self._window(start, end, level)
+        row = self._user_row(user_id)
+        if row is None:
+            n_columns = self._columns(level)[1]
+            return self.users[:0], tuple(np.zeros((0, n_columns)) for _ in range(3))
+        return self.users[row:row + 1], self._window(start, end, level, row)
+
+    def _cells_frame(self, users: np.ndarray, present: np.ndarray, level: str, columns: dict) -> pd.DataFrame:
+        rows, columns_index = np.nonzero(present)
+        frame = self._labels(level).iloc[columns_index].reset_index(drop=True)
+        frame.insert(0, 'customer_id', users[rows])
+        for name, values in columns.items():
+            frame[name] = values[rows, columns_index]
+        return frame
+
+    def window_frame(self, start: Period, end: Period, level: str = 'subcategory',
+                     user_id: Optional[int] = None) -> pd.DataFrame:
+        """
+        Spending over a period range as one row per (customer, category) with purchases: total
+        spent, number of items and the mean and sample standard deviation of the item prices.
+        """
+        users, (total, count, sum_of_squares) = self._user_window(start, end, level, user_id)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            variance = (sum_of_squares - count * mean ** 2) / (count - 1)
+        std = np.sqrt(np.maximum(variance, 0.0))
+        std[count < 2] = np.nan
+
+        return self._cells_frame(users, count > 0, level, {
+            'total_spent': total,
+            'item_count': count,
+            'mean_item_price': mean,
+            'std_item_price': std,
+        })
+
+    def compare_windows(self, end: Period, recent_months: int = 3, prior_months: int = 12,
+                        level: str = 'primary_category', user_id: Optional[int] = None) -> pd.DataFrame:
+        """
+        Average monthly spend in the last `recent_months` months up to `end` against the average
+        of the `prior_months` months before them, per (customer, category).
+        """
+        recent_start = shift_period(end, -(recent_months - 1))
+        prior_end = shift_period(recent_start, -1)
+        prior_start = shift_period(prior_end, -(prior_months - 1))
+
+        users, (recent_total, recent_count, _) = self._user_window(recent_start, end, level, user_id)
+        _, (prior_total, prior_count, _) = self._user_window(prior_start, prior_end, level, user_id)
+        recent_average = recent_total / recent_months
+        prior_average = prior_total / prior_months
+
+        return self._cells_frame(users, (recent_count > 0) | (prior_count > 0), level, {
+            'recent_monthly_spent': recent_average,
+            'prior_monthly_spent': prior_average,
+            'change_ratio': spend_change(recent_average, prior_average),
+        })
+
+    def monthly_totals(self, user_id: int, level: str = 'primary_category') -> pd.DataFrame:
+        """
+        Spend of a user per month and category, one row per month with purchases.
+        """
+        labels = self._labels(level)
+        row = self._user_row(user_id)
+        if row is None:
+            return pd.DataFrame(columns=['year', 'month', *labels.columns, 'total_spent'])
+
+        cells = slice(self.user_offsets[row], self.user_offsets[row + 1])
+        columns, n_columns = self._columns(level)
+        keys, positions = np.unique(self.cell_periods[cells] * n_columns + columns[cells], return_inverse=True)
+        periods, columns = np.divmod(keys, n_columns)
+
+        frame = labels.iloc[columns].reset_index(drop=True)
+        years, month_indexes = np.divmod(self.first_ordinal + periods, 12)
+        frame.insert(0, 'month', month_indexes + 1)
+        frame.insert(0, 'year', years)
+        frame['total_spent'] = np.bincount(positions.ravel(), weights=self.total[cells], minlength=len(keys))
+        return frame
+
+    def to_tables(self) -> Dict[str, pd.DataFrame]:
+        """
+        The cube as plain columnar tables, to be published with a snapshot (see shared_snapshot).
+        """
+        return {
+            'cube_cells': pd.DataFrame({
+                'user': self.cell_users, 'pair': self.cell_pairs, 'period': self.cell_periods,
+                'total': self.total, 'count': self.count, 'sum_of_squares': self.sum_of_squares,
+            }),
+            'cube_users': pd.DataFrame({'customer_id': self.users}),
+            'cube_pairs': self.pairs.to_frame(index=False, name=['primary_category', 'subcategory']),
+            'cube_periods': pd.DataFrame({'first_ordinal': [self.first_ordinal], 'n_periods': [self.n_periods]}),
+        }
+
+    @classmethod
+    def from_tables(cls, tables: Dict[str, pd.DataFrame]) -> 'SpendingCube':
+        """
+        The cube from the tables of `to_tables`, sharing their arrays.
+        """
+        cells = tables['cube_cells']
+        users = tables['cube_users']['customer_id'].to_numpy()
+        pairs = tables['cube_pairs']
+        cell_users = cells['user'].to_numpy()
+        return cls(
+            users=users,
+            pairs=pd.MultiIndex.from_arrays([np.asarray(pairs['primary_category'], dtype=object),
+                                             np.asarray(pairs['subcategory'], dtype=object)],
+                                            names=['primary_category', 'subcategory']),
+            first_ordinal=int(tables['cube_periods']['first_ordinal'].iloc[0]),
+            n_periods=int(tables['cube_periods']['n_periods'].iloc[0]),
+            cell_users=cell_users,
+            cell_pairs=cells['pair'].to_numpy(),
+            cell_periods=cells['period'].to_numpy(),
+            total=cells['total'].to_numpy(),
+            count=cells['count'].to_numpy(),
+            sum_of_squares=cells['sum_of_squares'].to_numpy(),
+            user_offsets=np.searchsorted(cell_users, np.arange(len(users) + 1)),
+        )
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='spending_cube', stage='build_spending_cube')
+def build_spending_cube(data: pd.DataFrame) -> SpendingCube:
+    """
+    Builds the cube from prepared or compact spending rows: the occupied cells are the unique
+    (user, period, pair) keys of the rows, summed with np.bincount.
+    Rows without an issue date cannot be placed in a period and are left out.
+    """
+    data = data[data['issue_date'].notna()]
+    ordinals = (data['issue_date'].dt.year * 12 + data['issue_date'].dt.month - 1).to_numpy(dtype=np.int64)
+
+    user_codes, users = pd.factorize(data['customer_id'], sort=True)
+    pair_codes, pairs = pd.factorize(
+        pd.MultiIndex.from_arrays([data['primary_category'], data['subcategory']]), sort=True
+    )
+
+    first_ordinal = int(ordinals.min()) if len(ordinals) else 0
+    n_users, n_pairs = len(users), len(pairs)
+    n_periods = int(ordinals.max()) - first_ordinal + 1 if len(ordinals) else 0
+
+    keys = (user_codes.astype(np.int64) * n_periods + (ordinals - first_ordinal)) * n_pairs + pair_codes
+    cell_keys, cells = np.unique(keys, return_inverse=True)
+    cells = cells.ravel()
+    prices = spending_prices(data)
+
+    cell_users, rest = np.divmod(cell_keys, max(n_periods * n_pairs, 1))
+    cell_periods, cell_pairs = np.divmod(rest, max(n_pairs, 1))
+    cell_users = cell_users.astype(np.int32)
+
+    return SpendingCube(
+        users=users.to_numpy(),
+        pairs=pairs,
+        first_ordinal=first_ordinal,
+        n_periods=n_periods,
+        cell_users=cell_users,
+        cell_pairs=cell_pairs.astype(np.int32),
+        cell_periods=cell_periods.astype(np.int32),
+        total=np.bincount(cells, weights=prices, minlength=len(cell_keys)),
+        count=np.bincount(cells, minlength=len(cell_keys)).astype(np.int32),
+        sum_of_squares=np.bincount(cells, weights=prices ** 2, minlength=len(cell_keys)),
+        user_offsets=np.searchsorted(cell_users, np.arange(n_users + 1)),
+    )
+
+
+def get_spending_cube(snapshot) -> SpendingCube:
+    """
+    The cube of a spending snapshot, attached from the tables published with the snapshot or
+    else built from its rows, once per snapshot and dropped together with it.
+    """
+    def load() -> SpendingCube:
+        if 'cube_cells' in snapshot.tables:
+            return SpendingCube.from_tables(snapshot.tables)
+        return build_spending_cube(snapshot.data)
+
+    return snapshot.derived.get('spending_cube', load)
@@ -0,0 +1,181 @@
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ml_services.spending_cube import Period, SpendingCube, get_spending_cube, period_ordinal
+from utils.metrics import ANALYSIS_STAGE_SECONDS, timed
+
+PERCENTILE_COLUMNS = ['primary_category', 'subcategory', 'total_spent', 'percentile', 'users', 'median_spent']
+
+
+@dataclass(frozen=True, eq=False)
+class SpendingPercentiles:
+    """
+    The spend of every user who bought in a (primary_category, subcategory) in a month, sorted,
+    for every category and month. Primary categories are included with an empty subcategory.
+
+    The spends are sorted by group and value in `values`, with the group of every value in
+    `groups` (`t * n_columns + c` for category column `c` in period offset `t`), so the spends
+    of a group are found by binary search and a user's percentile by another one in them.
+    A user's own spends are the cells `user_offsets[u]:user_offsets[u + 1]` of the `cell_*`
+    arrays (sorted by period), only for the categories the user bought in.
+    """
+    users: np.ndarray
+    labels: pd.DataFrame
+    first_ordinal: int
+    n_periods: int
+    cell_columns: np.ndarray
+    cell_periods: np.ndarray
+    cell_spend: np.ndarray
+    user_offsets: np.ndarray
+    groups: np.ndarray
+    values: np.ndarray
+
+    def user_cells(self, user_id: int, period: Period) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The columns the user bought in during the month and the user's spend in each.
+        """
+        row = np.searchsorted(self.users, user_id)
+        offset = period_ordinal(period) - self.first_ordinal
+        if row == len(self.users) or self.users[row] != user_id or not 0 <= offset < self.n_periods:
+            return self.cell_columns[:0], self.cell_spend[:0]
+
+        start, stop = self.user_offsets[row], self.user_offsets[row + 1]
+        first = start + np.searchsorted(self.cell_periods[start:stop], offset, side='left')
+        last = start + np.searchsorted(self.cell_periods[start:stop], offset, side='right')
+        return self.cell_columns[first:last], self.cell_spend[first:last]
+
+    def column_spends(self, period: Period, column: int) -> np.ndarray:
+        """
+        The sorted spends of all users who bought in a category column during the month.
+        """
+        offset = period_ordinal(period) - self.first_ordinal
+        if not 0 <= offset < self.n_periods:
+            return self.values[:0]
+        group = offset * len(self.labels) + column
+        return self.values[np.searchsorted(self.groups, group, side='left'):
+                           np.searchsorted(self.groups, group, side='right')]
+
+    def compare(self, user_id: int, period: Period) -> pd.DataFrame:
+        """
+        Percentile rank of the user's spend in every category and subcategory they bought in
+        during the month: the share of users spending less, counting ties as half.
+        """
+        columns, user_spend = self.user_cells(user_id, period)
+        return rank_spend(self.labels.iloc[columns], user_spend,
+                          [self.column_spends(period, column) for column in columns])
+
+    def to_tables(self) -> Dict[str, pd.DataFrame]:
+        """
+        The arrays as plain columnar tables, to be published with a snapshot (see shared_snapshot).
+        The customer ids and periods are those of the cube the percentiles were built from.
+        """
+        return {
+            'percentile_cells': pd.DataFrame({'column': self.cell_columns, 'period': self.cell_periods,
+                                              'spend': self.cell_spend}),
+            'percentile_users': pd.DataFrame({'offset': self.user_offsets}),
+            'percentile_values': pd.DataFrame({'group': self.groups, 'value': self.values}),
+            'percentile_labels': self.labels,
+        }
+
+    @classmethod
+    def from_tables(cls, cube: SpendingCube, tables: Dict[str, pd.DataFrame]) -> 'SpendingPercentiles':
+        """
+        The percentiles from the tables of `to_tables`, sharing their arrays.
+        """
+        labels = tables['percentile_labels']
+        return cls(
+            users=cube.users,
+            labels=pd.DataFrame({name: np.asarray(labels[name], dtype=object) for name in labels.columns}),
+            first_ordinal=cube.first_ordinal,
+            n_periods=cube.n_periods,
+            cell_columns=tables['percentile_cells']['column'].to_numpy(),
+            cell_periods=tables['percentile_cells']['period'].to_numpy(),
+            cell_spend=tables['percentile_cells']['spend'].to_numpy(),
+            user_offsets=tables['percentile_users']['offset'].to_numpy(),
+            groups=tables['percentile_values']['group'].to_numpy(),
+            values=tables['percentile_values']['value'].to_numpy(),
+        )
+
+
+def rank_spend(labels: pd.DataFrame, user_spend: np.ndarray, group_spends: List[np.ndarray]) -> pd.DataFrame:
+    """
+    The comparison rows of a user's spends against the sorted spends of their groups.
+    """
+    percentiles, users, medians = [], [], []
+    for spends, spend in zip(group_spends, user_spend):
+        below = np.searchsorted(spends, spend, side='left')
+        equal = np.searchsorted(spends, spend, side='right') - below
+        percentiles.append(100.0 * (below + 0.5 * equal) / len(spends))
+        users.append(len(spends))
+        # The spends are sorted, so the median is read off the middle
+        medians.append(float((spends[(len(spends) - 1) // 2] + spends[len(spends) // 2]) / 2))
+
+    frame = labels.reset_index(drop=True)
+    frame['total_spent'] = user_spend
+    frame['percentile'] = percentiles
+    frame['users'] = users
+    frame['median_spent'] = medians
+    return frame[PERCENTILE_COLUMNS]
+
+
+@timed(ANALYSIS_STAGE_SECONDS, analyzer='spending_percentiles', stage='build_spending_percentiles')
+def build_spending_percentiles(cube: SpendingCube) -> SpendingPercentiles:
+    """
+    Sums the cube cells per (user, period, column), subcategories and primary categories alike,
+    and sorts the spends of all (category, month) groups in one lexsort. Only occupied cells are
+    touched, so the work and the memory follow the size of the cube.
+    """
+    pair_categories = np.asarray(cube.pairs.get_level_values(0))
+    pair_subcategories = np.asarray(cube.pairs.get_level_values(1))
+    main_codes, categories = pd.factorize(pair_categories, sort=True)
+    n_pairs = len(cube.pairs)
+    n_columns = n_pairs + len(categories)
+
+    labels = pd.DataFrame({
+        'primary_category': np.r_[pair_categories, np.asarray(categories)],
+        'subcategory': np.r_[pair_subcategories, np.full(len(categories), '', dtype=object)],
+    })
+
+    # Columns: the subcategories, then the primary categories; "Unknown" subcategories are not
+    # compared against other users
+    known = (pair_subcategories != "Unknown")[cube.cell_pairs]
+    columns = np.r_[cube.cell_pairs[known], n_pairs + main_codes[cube.cell_pairs]]
+    keys = (np.r_[cube.cell_users[known], cube.cell_users].astype(np.int64) * cube.n_periods
+            + np.r_[cube.cell_periods[known], cube.cell_periods]) * n_columns + columns
+    cell_keys, cells = np.unique(keys, return_inverse=True)
+    cell_spend = np.bincount(cells.ravel(), weights=np.r_[cube.total[known], cube.total], minlength=len(cell_keys))
+
+    cell_users, rest = np.divmod(cell_keys, max(cube.n_periods * n_columns, 1))
+    cell_periods, cell_columns = np.divmod(rest, max(n_columns, 1))
+
+    groups = cell_periods * n_columns + cell_columns
+    order = np.lexsort((cell_spend, groups))
+
+    return SpendingPercentiles(
+        users=cube.users,
+        labels=labels,
+        first_ordinal=cube.first_ordinal,
+        n_periods=cube.n_periods,
+        cell_columns=cell_columns.astype(np.int32),
+        cell_periods=cell_periods.astype(np.int32),
+        cell_spend=cell_spend,
+        user_offsets=np.searchsorted(cell_users, np.arange(len(cube.users) + 1)),
+        groups=groups[order].astype(np.int32),
+        values=cell_spend[order],
+    )
+
+
+def get_spending_percentiles(snapshot) -> SpendingPercentiles:
+    """
+    The percentile arrays of a spending snapshot, attached from the tables published with the
+    snapshot or else built from its cube, once per snapshot and dropped together with it.
+    """
+    def load() -> SpendingPercentiles:
+        if 'percentile_values' in snapshot.tables:
+            return SpendingPercentiles.from_tables(get_spending_cube(snapshot), snapshot.tables)
+        return build_spending_percentiles(get_spending_cube(snapshot))
+
+    return snapshot.derived.get('spending_percentiles', load)
@@ -1,7 +1,24 @@
-from transformers import pipeline
+from utils.lazy import Lazy
 
-messages = [
-    {"role": "user", "content": "Who are you?"},
-]
-pipe = pipeline("text-generation", model="nvidia/Llama-3.1-Nemotron-70B-Instruct-HF")
-pipe(messages)
\ No newline at end of file
+SUMMARY_MODEL = "nvidia/Llama-3.1-Nemotron-70B-Instruct-HF"
+
+
+def load_pipeline():
+    # transformers is heavy to import and the model is huge, so both wait until first use
+    from transformers import pipeline
+
+    return pipeline("text-generation", model=SUMMARY_MODEL)
+
+
+summary_pipeline = Lazy(load_pipeline)
+
+
+def generate(messages):
+    return summary_pipeline.get()(messages)
+
+
+if __name__ == '__main__':
+    messages = [
+        {"role": "user", "content": "Who are you?"},
+    ]
+    print(generate(messages))
@@ -0,0 +1,304 @@
+"""
+Deterministic generator of synthetic receipts, product items and spending rows.
+
+Scales the idea of ReceiptChanger.py (real receipts with random customers) to any number of users,
+receipts and months. The real tables are the reference: products (with their prices, discount
+lines and categories from ProductCategories.csv) and the merchants of Organizations.csv are reused,
+and the number of items per receipt and the item quantities follow their real distributions.
+Spending rows carry the category of the item from the product category hierarchy and the item's
+line total, receipts keep the category of their merchant.
+
+The output directory gets the same files as ml_services/data, so it can be used with DATA_DIR:
+
+    python -m ml_services.synthetic_data --users 10000 --receipts 2000000 --months 24 \\
+        --output ml_services/data/synthetic
+    DATA_DIR=ml_services/data/synthetic python -m benchmarks.advice_benchmark
+
+Receipts are generated and appended in chunks, so memory use depends on the chunk size only.
+The same seed, arguments and chunk size always produce the same files.
+"""
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from ml_services.dataset_store import DATE_FORMAT
+from utils.environment_variables import DATA_DIR
+
+# Tables copied unchanged into the output directory
+REFERENCE_FILES = ['Organizations.csv', 'Products.csv', 'ProductCategories.csv']
+
+RECEIPT_COLUMNS = ['id', 'receipt_id', 'ico', 'issue_date', 'create_date', 'customer_id', 'total_price',
+                   'category', 'organization_id', 'org_name']
+PRODUCT_ITEM_COLUMNS = ['id', 'quantity', 'product_id', 'fs_receipt_id']
+SPENDING_COLUMNS = ['customer_id', 'receipt_id', 'total_price', 'category_item', 'issue_date']
+
+# Share of a user's receipts issued by one of their regular merchants
+FAVOURITE_MERCHANT_SHARE = 0.8
+FAVOURITE_MERCHANTS = 5
+
+
+@dataclass(frozen=True)
+class GeneratorConfig:
+    users: int = 1000
+    receipts: int = 100_000
+    start_year: int = 2023
+    start_month: int = 1
+    months: int = 24
+    seed: int = 0
+    chunk_size: int = 50_000
+
+
+@dataclass(frozen=True, eq=False)
+class ReferenceData:
+    """
+    The real tables the synthetic data is sampled from.
+
+    Products are grouped by merchant: the products of merchant `m` are
+    `merchant_products[merchant_offsets[m]:merchant_offsets[m + 1]]` (indices into the catalog).
+    """
+    merchant_ids: np.ndarray
+    merchant_icos: np.ndarray
+    merchant_names: np.ndarray
+    merchant_categories: np.ndarray
+    merchant_popularity: np.ndarray
+    merchant_offsets: np.ndarray
+    merchant_products: np.ndarray
+    product_ids: np.ndarray
+    product_prices: np.ndarray
+    product_categories: np.ndarray
+    items_per_receipt: np.ndarray
+    quantities: np.ndarray
+
+
+def load_reference(data_dir: str = DATA_DIR) -> ReferenceData:
+    """
+    Reads the real organizations, products, receipts and product items.
+    """
+    organizations = pd.read_csv(os.path.join(data_dir, 'Organizations.csv'), usecols=['id', 'name', 'ico', 'category'],
+                                dtype={'ico': str})
+    products = pd.read_csv(os.path.join(data_dir, 'Products.csv'), usecols=['id', 'price', 'organization_id'])
+    categories = pd.read_csv(os.path.join(data_dir, 'ProductCategories.csv'), usecols=['id', 'category', 'product_id'])
+    receipts = pd.read_csv(os.path.join(data_dir, 'Receipts.csv'), usecols=['id', 'organization_id'])
+    product_items = pd.read_csv(os.path.join(data_dir, 'ProductItems.csv'), usecols=['quantity', 'fs_receipt_id'])
+
+    # Only products placed in the category hierarchy are sold
+    products = products[products['id'].isin(categories['product_id']) & products['price'].notna()]
+    products = products.sort_values(['organization_id', 'id'], kind='stable').reset_index(drop=True)
+    # A product is listed under several categories; its first entry is its own category
+    product_categories = categories.sort_values('id').drop_duplicates(subset='product_id').set_index('product_id')
+
+    organizations = organizations.sort_values('id').reset_index(drop=True)
+    merchant_codes = organizations['id'].to_numpy()
+
+    # Merchants without products of their own sell from the whole catalog
+    product_merchants = np.searchsorted(merchant_codes, products['organization_id'].to_numpy())
+    known = (product_merchants < len(merchant_codes)) & \
+        (merchant_codes[np.minimum(product_merchants, len(merchant_codes) - 1)] == products['organization_id'].to_numpy())
+    counts = np.bincount(product_merchants[known], minlength=len(merchant_codes))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    merchant_products = np.flatnonzero(known)
+
+    popularity = receipts['organization_id'].value_counts().reindex(organizations['id'], fill_value=0).to_numpy() + 1.0
+
+    return ReferenceData(
+        merchant_ids=merchant_codes,
+        merchant_icos=organizations['ico'].to_numpy(),
+        merchant_names=organizations['name'].to_numpy(),
+        merchant_categories=organizations['category'].fillna("Unknown").to_numpy(),
+        merchant_popularity=popularity / popularity.sum(),
+        merchant_offsets=offsets,
+        merchant_products=merchant_products,
+        product_ids=products['id'].to_numpy(),
+        product_prices=products['price'].to_numpy(dtype=np.float64),
+        product_categories=product_categories['category'].reindex(products['id']).to_numpy(),
+        items_per_receipt=product_items.groupby('fs_receipt_id').size().to_numpy(),
+        quantities=product_items['quantity'].dropna().to_numpy(dtype=np.float64),
+    )
+
+
+@dataclass(frozen=True, eq=False)
+class UserProfiles:
+    activity: np.ndarray
+    basket_scale: np.ndarray
+    favourite_merchants: np.ndarray
+
+
+def generate_users(config: GeneratorConfig, reference: ReferenceData) -> UserProfiles:
+    """
+    How often every user shops, how big their baskets are and where they usually shop.
+    """
+    rng = np.random.default_rng([config.seed, 0])
+    activity = rng.lognormal(mean=0.0, sigma=0.8, size=config.users)
+    favourites = rng.choice(len(reference.merchant_ids), size=(config.users, FAVOURITE_MERCHANTS),
+                            p=reference.merchant_popularity)
+    return UserProfiles(
+        activity=activity / activity.sum(),
+        basket_scale=rng.lognormal(mean=0.0, sigma=0.4, size=config.users),
+        favourite_merchants=favourites,
+    )
+
+
+def _receipt_ids(rng: np.random.Generator, count: int) -> np.ndarray:
+    # Same shape as the real IDs: 'O-' and 32 upper-case hex digits
+    digits = rng.integers(0, 16, size=(count, 32), dtype=np.uint8)
+    hexadecimal = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)[digits]
+    return np.char.add('O-', hexadecimal.view('S32').ravel().astype(str))
+
+
+def generate_chunk(config: GeneratorConfig, reference: ReferenceData, users: UserProfiles,
+                   chunk_index: int, first_receipt: int, first_item: int, count: int) -> Dict[str, pd.DataFrame]:
+    """
+    Generates `count` receipts with their product items and spending rows. The random state only
+    depends on the seed and the chunk index.
+    """
+    rng = np.random.default_rng([config.seed, 1, chunk_index])
+
+    # Who, where and when
+    customers = rng.choice(config.users, size=count, p=users.activity)
+    favourite = rng.random(count) < FAVOURITE_MERCHANT_SHARE
+    merchants = np.where(
+        favourite,
+        users.favourite_merchants[customers, rng.integers(0, FAVOURITE_MERCHANTS, size=count)],
+        rng.choice(len(reference.merchant_ids), size=count, p=reference.merchant_popularity),
+    )
+    # Any day of the period, during opening hours (7:00 - 21:00)
+    start = pd.Timestamp(year=config.start_year, month=config.start_month, day=1)
+    days = (start + pd.DateOffset(months=config.months) - start).days
+    seconds = rng.integers(0, days, size=count) * 86400 + rng.integers(7 * 3600, 21 * 3600, size=count)
+    issue_dates = start + pd.to_timedelta(np.sort(seconds), unit='s')
+
+    # Basket sizes follow the real items-per-receipt distribution, scaled per user
+    base_items = rng.choice(reference.items_per_receipt, size=count)
+    items_per_receipt = np.maximum(1, np.rint(base_items * users.basket_scale[customers])).astype(np.int64)
+
+    # Items come from the merchant's own products, or from the whole catalog if it has none
+    item_receipts = np.repeat(np.arange(count), items_per_receipt)
+    item_merchants = merchants[item_receipts]
+    catalog_sizes = np.diff(reference.merchant_offsets)[item_merchants]
+    draw = rng.random(len(item_receipts))
+    own_products = reference.merchant_products[
+        np.minimum(reference.merchant_offsets[item_merchants] + (draw * catalog_sizes).astype(np.int64),
+                   len(reference.merchant_products) - 1)
+    ] if len(reference.merchant_products) else np.zeros(len(item_receipts), dtype=np.int64)
+    any_products = (draw * len(reference.product_ids)).astype(np.int64)
+    products = np.where(catalog_sizes > 0, own_products, any_products)
+    quantities = rng.choice(reference.quantities, size=len(item_receipts))
+
+    line_totals = reference.product_prices[products] * quantities
+    totals = np.round(np.bincount(item_receipts, weights=line_totals, minlength=count), 2)
+
+    receipt_numbers = first_receipt + np.arange(count)
+    receipt_ids = _receipt_ids(rng, count)
+    formatted_dates = issue_dates.strftime(DATE_FORMAT)
+    customer_ids = customers + 1
+
+    receipts = pd.DataFrame({
+        'id': receipt_numbers,
+        'receipt_id': receipt_ids,
+        'ico': reference.merchant_icos[merchants],
+        'issue_date': formatted_dates,
+        'create_date': formatted_dates,
+        'customer_id': customer_ids,
+        'total_price': totals,
+        'category': reference.merchant_categories[merchants],
+        'organization_id': reference.merchant_ids[merchants],
+        'org_name': reference.merchant_names[merchants],
+    }, columns=RECEIPT_COLUMNS)
+
+    product_items = pd.DataFrame({
+        'id': first_item + np.arange(len(item_receipts)),
+        'quantity': quantities,
+        'product_id': reference.product_ids[products],
+        'fs_receipt_id': receipt_numbers[item_receipts],
+    }, columns=PRODUCT_ITEM_COLUMNS)
+
+    # One row per item with the item's line total and its category in the product hierarchy
+    spending = pd.DataFrame({
+        'customer_id': customer_ids[item_receipts],
+        'receipt_id': receipt_ids[item_receipts],
+        'total_price': np.round(line_totals, 2),
+        'category_item': reference.product_categories[products],
+        'issue_date': np.asarray(formatted_dates)[item_receipts],
+    }, columns=SPENDING_COLUMNS)
+
+    return {'receipts': receipts, 'product_items': product_items, 'spending': spending}
+
+
+def _append(frame: pd.DataFrame, path: str, first: bool) -> None:
+    frame.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+
+
+def generate(config: GeneratorConfig, output_dir: str, data_dir: str = DATA_DIR,
+             reference: Optional[ReferenceData] = None) -> Dict[str, int]:
+    """
+    Writes a complete synthetic dataset to `output_dir`. Returns the number of written rows per file.
+    """
+    if os.path.abspath(output_dir) == os.path.abspath(data_dir):
+        raise ValueError("The output directory must differ from the reference data directory.")
+
+    reference = reference or load_reference(data_dir)
+    users = generate_users(config, reference)
+    os.makedirs(output_dir, exist_ok=True)
+
+    for file_name in REFERENCE_FILES:
+        shutil.copyfile(os.path.join(data_dir, file_name), os.path.join(output_dir, file_name))
+
+    created = pd.Timestamp(year=config.start_year, month=config.start_month, day=1) - pd.DateOffset(days=1)
+    pd.DataFrame({
+        'id': np.arange(1, config.users + 1),
+        'created_date': created.strftime('%Y-%m-%d %H:%M:%S'),
+    }).to_csv(os.path.join(output_dir, 'Users.csv'), index=False)
+
+    paths = {
+        'receipts': os.path.join(output_dir, 'Receipts_with_customer_id.csv'),
+        'anonymous_receipts': os.path.join(output_dir, 'Receipts.csv'),
+        'product_items': os.path.join(output_dir, 'ProductItems.csv'),
+        'spending': os.path.join(output_dir, 'Merged_Spending_Data.csv'),
+    }
+    written = {'users': config.users, 'receipts': 0, 'product_items': 0, 'spending': 0}
+
+    for chunk_index, first in enumerate(range(0, config.receipts, config.chunk_size)):
+        count = min(config.chunk_size, config.receipts - first)
+        chunk = generate_chunk(config, reference, users, chunk_index,
+                               first_receipt=first + 1, first_item=written['product_items'] + 1, count=count)
+        is_first = chunk_index == 0
+
+        _append(chunk['receipts'], paths['receipts'], is_first)
+        # Like the exported Receipts.csv, the anonymous copy has no customers
+        _append(chunk['receipts'].assign(customer_id=None), paths['anonymous_receipts'], is_first)
+        _append(chunk['product_items'], paths['product_items'], is_first)
+        _append(chunk['spending'], paths['spending'], is_first)
+
+        for name in ('receipts', 'product_items', 'spending'):
+            written[name] += len(chunk[name])
+
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic spending dataset.")
+    parser.add_argument('--users', type=int, default=GeneratorConfig.users)
+    parser.add_argument('--receipts', type=int, default=GeneratorConfig.receipts)
+    parser.add_argument('--start-year', type=int, default=GeneratorConfig.start_year)
+    parser.add_argument('--start-month', type=int, default=GeneratorConfig.start_month)
+    parser.add_argument('--months', type=int, default=GeneratorConfig.months)
+    parser.add_argument('--seed', type=int, default=GeneratorConfig.seed)
+    parser.add_argument('--chunk-size', type=int, default=GeneratorConfig.chunk_size)
+    parser.add_argument('--data-dir', default=DATA_DIR, help="directory with the real reference tables")
+    parser.add_argument('--output', default=os.path.join(DATA_DIR, 'synthetic'))
+    arguments = parser.parse_args()
+
+    generator_config = GeneratorConfig(
+        users=arguments.users, receipts=arguments.receipts, start_year=arguments.start_year,
+        start_month=arguments.start_month, months=arguments.months, seed=arguments.seed,
+        chunk_size=arguments.chunk_size,
+    )
+    for name, rows in generate(generator_config, arguments.output, arguments.data_dir).items():
+        print(f"{name}: {rows} rows")
+    print(f"Written to {arguments.output}")
@@ -1,20 +1,20 @@
 import pandas as pd
-import requests
+
+from ml_services.dataset_store import read_dataset
+from ml_services.receipt_items import receipt_item_store
 
 
 class IntegratedSpendingAnalyzer:
-    def __init__(self, users_file, receipts_file, organizations_file, user_id, target_month=None):
+    def __init__(self, users_file, receipts_file, organizations_file, user_id, target_month=None, target_year=None):
         # Load datasets
-        self.organizations_df = pd.read_csv(organizations_file)
-        self.receipts_df = pd.read_csv(receipts_file)
-        self.users_df = pd.read_csv(users_file)
+        self.organizations_df = read_dataset(organizations_file)
+        self.receipts_df = read_dataset(receipts_file)
+        self.users_df = read_dataset(users_file)
 
         # Parameters
         self.user_id = user_id
         self.target_month = target_month
-
-        # Ensure 'create_date' is in datetime format, with error handling
-        self.receipts_df['create_date'] = pd.to_datetime(self.receipts_df['create_date'], errors='coerce')
+        self.target_year = target_year
 
         # Processed data for further use
         self.user_spending = None
@@ -23,19 +23,24 @@ class IntegratedSpendingAnalyzer:
         self.preprocess_data()
 
     def preprocess_data(self):
-        """Filter for target user and optionally by month, split categories."""
+        """Filter for target user and optionally by month of a year (the latest by default), split categories."""
         if self.user_id not in self.receipts_df['customer_id'].unique():
             raise ValueError(f"User {self.user_id} does not exist in the dataset.")
 
         # Filter by user and optionally by month if specified
         self.receipts_df = self.receipts_df[self.receipts_df['customer_id'] == self.user_id]
         if self.target_month:
-            self.receipts_df = self.receipts_df[self.receipts_df['create_date'].dt.month == self.target_month]
+            if self.target_year is None:
+                self.target_year = int(self.receipts_df['create_date'].dt.year.max())
+            self.receipts_df = self.receipts_df[
+                (self.receipts_df['create_date'].dt.year == self.target_year) &
+                (self.receipts_df['create_date'].dt.month == self.target_month)
+                ]
 
         # Split the category into primary and subcategory, handle missing values
         self.receipts_df[['primary_category', 'subcategory']] = self.receipts_df['category'].str.split('/', expand=True)
-        self.receipts_df['primary_category'].fillna("Unknown", inplace=True)
-        self.receipts_df['subcategory'].fillna("Unknown", inplace=True)
+        self.receipts_df['primary_category'] = self.receipts_df['primary_category'].fillna("Unknown")
+        self.receipts_df['subcategory'] = self.receipts_df['subcategory'].fillna("Unknown")
 
     def calculate_user_spending(self):
         """Aggregates user spending per category and subcategory."""
@@ -45,23 +50,8 @@ class IntegratedSpendingAnalyzer:
 
     @staticmethod
     def get_receipt_items(receipt_id):
-        """Fetches receipt data from the API using the provided receipt ID and returns the receipt items."""
-        url = 'https://ekasa.financnasprava.sk/mdu/api/v1/opd/receipt/find'
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json;charset=UTF-8',
-            'User-Agent': 'Mozilla/5.0'
-        }
-        payload = {'receiptId': receipt_id}
-
-        response = requests.post(url, headers=headers, json=payload)
-
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("receipt", {}).get("items", [])
-        else:
-            print(f"Request failed with status code {response.status_code}")
-            return []
+        """Returns the receipt items for the provided receipt ID from the shared receipt item store."""
+        return receipt_item_store.get().get(receipt_id)
 
     def calculate_main_category_statistics(self):
         """Calculates mean and standard deviation for main categories across all months for this user."""
@@ -100,8 +90,9 @@ class IntegratedSpendingAnalyzer:
 
         # Analyze expensive items in anomalous receipts
         expensive_items = []
+        items_by_receipt = receipt_item_store.get().get_many(receipts_in_category)
         for receipt_id in receipts_in_category:
-            items = self.get_receipt_items(receipt_id)
+            items = items_by_receipt[receipt_id]
             for item in items:
                 if item.get('itemType') == 'Z':  # Only consider sale items
                     item_total_cost = item.get('price', 0) * item.get('quantity', 1)
@@ -125,17 +116,18 @@ class IntegratedSpendingAnalyzer:
         }
 
 
-# Example usage
-analyzer = IntegratedSpendingAnalyzer(
-    users_file='data/Users.csv',
-    receipts_file='data/Receipts_with_customer_id.csv',
-    organizations_file='data/Organizations.csv',
-    user_id=2
-)
+if __name__ == '__main__':
+    # Example usage
+    analyzer = IntegratedSpendingAnalyzer(
+        users_file='data/Users.csv',
+        receipts_file='data/Receipts_with_customer_id.csv',
+        organizations_file='data/Organizations.csv',
+        user_id=2
+    )
 
-analyzer.calculate_user_spending()
-analyzer.calculate_main_category_statistics()
-analyzer.detect_anomalies()
-anomaly_analysis = analyzer.analyze_anomaly()
+    analyzer.calculate_user_spending()
+    analyzer.calculate_main_category_statistics()
+    analyzer.detect_anomalies()
+    anomaly_analysis = analyzer.analyze_anomaly()
 
-print(anomaly_analysis)
+    print(anomaly_analysis)
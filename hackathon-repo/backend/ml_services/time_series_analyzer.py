@@ -1,18 +1,129 @@
+import numpy as np
 import pandas as pd
-import requests
-from pprint import pprint
 import os
 
-
+from ml_services.dataset_store import read_dataset, split_category
+from ml_services.receipt_item_index import ReceiptItemIndex, receipt_item_index
+from ml_services.spending_cube import period_ordinal
+from utils.metrics import instrument_stages
+
+PRODUCT_Z_SCORE_THRESHOLD = 2
+
+ANOMALY_REPORT_COLUMNS = [
+    'product_name', 'quantity', 'historical_avg_quantity', 'historical_std_quantity',
+    'quantity_z_score', 'is_anomaly', 'is_new_product', 'receipt_id', 'issue_date',
+    'primary_category', 'subcategory', 'total_price'
+]
+
+
+def product_history_stats(historical_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Historical quantity statistics per (customer, product) for all customers in one groupby.
+    """
+    return historical_data.groupby(['customer_id', 'product_name'], observed=True).agg(
+        historical_avg_quantity=('quantity', 'mean'),
+        historical_std_quantity=('quantity', 'std'),
+        historical_max_quantity=('quantity', 'max')
+    ).reset_index()
+
+
+def score_purchases(purchases: pd.DataFrame, history_stats: pd.DataFrame,
+                    z_score_threshold: float = PRODUCT_Z_SCORE_THRESHOLD) -> pd.DataFrame:
+    """
+    Scores purchases against the historical behavior of their customer with vectorized NumPy.
+    A product with no spread in its history scores an infinite z-score if the quantity differs
+    from the average, and a product never bought before is flagged as new.
+    """
+    scored = purchases.merge(history_stats, on=['customer_id', 'product_name'], how='left')
+
+    # Products not seen before have no history
+    for column in ['historical_avg_quantity', 'historical_std_quantity', 'historical_max_quantity']:
+        scored[column] = scored[column].fillna(0)
+
+    quantity = scored['quantity'].to_numpy(dtype=float)
+    average = scored['historical_avg_quantity'].to_numpy(dtype=float)
+    std = scored['historical_std_quantity'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_score = np.where(std > 0, (quantity - average) / std, np.where(quantity != average, np.inf, 0.0))
+
+    scored['quantity_z_score'] = z_score
+    scored['is_anomaly'] = np.abs(z_score) > z_score_threshold
+    scored['is_new_product'] = average == 0
+    return scored
+
+
+def anomaly_messages(anomalies: pd.DataFrame) -> pd.Series:
+    """
+    Recommendation messages for scored anomalies, built column-wise.
+    """
+    issue_date = anomalies['issue_date'].dt.strftime('%Y-%m-%d')
+    product_name = anomalies['product_name'].astype(str)
+    new_product = ("On " + issue_date + ", you purchased '" + product_name + "' for the first time. "
+                   "Consider if this purchase aligns with your usual spending habits.")
+    changed_quantity = ("On " + issue_date + ", you purchased '" + product_name + "' in a quantity ("
+                        + anomalies['quantity'].astype(str) + ") significantly different from your "
+                        "historical average (" + anomalies['historical_avg_quantity'].map('{:.2f}'.format) + ").")
+    return new_product.where(anomalies['is_new_product'], changed_quantity)
+
+
+def top_anomalies_per_user(scored: pd.DataFrame, top_n: int = 5) -> pd.DataFrame:
+    """
+    The `top_n` anomalies of every customer by absolute z-score, with recommendation messages.
+    """
+    anomalies = scored[scored['is_anomaly'] | scored['is_new_product']]
+    anomalies = anomalies.assign(abs_z_score=anomalies['quantity_z_score'].abs())
+    anomalies = anomalies.sort_values(['customer_id', 'abs_z_score'], ascending=[True, False], kind='stable')
+    top = anomalies.groupby('customer_id', sort=False).head(top_n).reset_index(drop=True)
+    top['message'] = anomaly_messages(top)
+    return top
+
+
+def product_purchases(spending: pd.DataFrame, item_index: ReceiptItemIndex) -> pd.DataFrame:
+    """
+    The products bought on the receipts of spending rows, one row per receipt line from the
+    receipt item index, with the customer and issue date of the receipt. The categories are the
+    product's own ('category/subcategory' in Products.csv). Receipts the index does not know
+    have no lines.
+    """
+    receipts = spending[['customer_id', 'receipt_id', 'issue_date']].drop_duplicates('receipt_id')
+    receipts = receipts.assign(receipt_id=receipts['receipt_id'].astype(str))
+
+    items = item_index.items(receipts['receipt_id'])
+    items = items[['receipt_id', 'product_name', 'quantity', 'total_price']].join(
+        split_category(items['category'].astype(object))
+    )
+    return items.merge(receipts, on='receipt_id', how='inner')
+
+
+def find_product_anomalies(data: pd.DataFrame, target_year: int, target_month: int = 10, top_n: int = 5,
+                           z_score_threshold: float = PRODUCT_Z_SCORE_THRESHOLD) -> pd.DataFrame:
+    """
+    Product-level anomalies of the whole customer base in one pass: every purchase of the
+    target month of `target_year` is scored against the customer's purchases in all earlier
+    months, and the `top_n` anomalies of each customer are returned. Customers without history
+    are skipped, like SpendingAnalyzer does for a single user. `data` holds one row per
+    purchase with the product name and quantity (see `product_purchases`).
+    """
+    if not pd.api.types.is_datetime64_any_dtype(data['issue_date']):
+        data = data.assign(issue_date=pd.to_datetime(data['issue_date'], format='%d.%m.%Y %H:%M:%S', errors='coerce'))
+
+    ordinals = data['issue_date'].dt.year * 12 + data['issue_date'].dt.month - 1
+    target_ordinal = period_ordinal((target_year, target_month))
+    historical_data = data[ordinals < target_ordinal]
+    target_data = data[(ordinals == target_ordinal) &
+                       data['customer_id'].isin(historical_data['customer_id'].unique())]
+
+    scored = score_purchases(target_data, product_history_stats(historical_data), z_score_threshold)
+    return top_anomalies_per_user(scored, top_n)
+
+
+@instrument_stages('get_transactions_for_user', 'get_sale_amount_for_receipt', 'get_savings_per_category')
 class UserTransactionAnalyzer:
     def __init__(self, users_file, receipts_file, organizations_file):
         # Load datasets
-        self.organizations_df = pd.read_csv(organizations_file)
-        self.receipts_df = pd.read_csv(receipts_file)
-        self.users_df = pd.read_csv(users_file)
-
-        # Ensure 'create_date' is in datetime format, with error handling
-        self.receipts_df['create_date'] = pd.to_datetime(self.receipts_df['create_date'], errors='coerce')
+        self.organizations_df = read_dataset(organizations_file)
+        self.receipts_df = read_dataset(receipts_file)
+        self.users_df = read_dataset(users_file)
 
     def get_transactions_for_user(self, user_id: int, year: int = None, month: int = None):
         """
@@ -21,7 +132,9 @@ class UserTransactionAnalyzer:
         # Filter by user_id
         user_transactions = self.receipts_df[self.receipts_df['customer_id'] == user_id]
 
-        # Filter by year and month if specified
+        # Filter by year and month if specified; a month without a year is in the user's latest year
+        if month and not year and not user_transactions.empty:
+            year = int(user_transactions['create_date'].dt.year.max())
         if year:
             user_transactions = user_transactions[user_transactions['create_date'].dt.year == year]
         if month:
@@ -36,60 +149,33 @@ class UserTransactionAnalyzer:
         return user_transactions, categories
 
     @staticmethod
-    def get_receipt_items(receipt_id):
-        """
-        Fetches receipt data from the API using the provided receipt ID and returns the receipt items.
+    def get_sale_amount_for_receipt(receipt_id):
         """
-        url = 'https://ekasa.financnasprava.sk/mdu/api/v1/opd/receipt/find'
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-            'Content-Type': 'application/json;charset=UTF-8',
-            'User-Agent': 'Mozilla/5.0'
-        }
-        payload = {'receiptId': receipt_id}
-
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("receipt", {}).get("items", [])
-        except requests.exceptions.RequestException as e:
-            pprint(f"An error occurred while fetching receipt items: {e}")
-            return []
-
-    def get_sale_amount_for_receipt(self, receipt_id):
+        Calculates the total sale amount for a given receipt ID from the local receipt item index.
         """
-        Calculates the total sale amount for a given receipt ID by summing up the price of items.
-        """
-        items = self.get_receipt_items(receipt_id)
-        sale_amount = sum(
-            item.get('price', 0) * item.get('quantity', 1)
-            for item in items if item.get('itemType') == 'Z'
-        )
-        return sale_amount
+        return float(receipt_item_index.get().sale_amounts([receipt_id])[0])
 
     def get_savings_per_category(self, user_transactions, categories):
         """
-        Calculates the total savings per category for a user's transactions.
+        Calculates the total savings per category for a user's transactions, summing the sale
+        amounts of the distinct receipts of each category in one grouped pass.
         """
-        sale_amount_per_category = {}
-
-        for category in categories:
-            category_transactions = user_transactions[user_transactions['category'] == category]
-            total_sale_amount = sum(
-                self.get_sale_amount_for_receipt(receipt_id)
-                for receipt_id in category_transactions['receipt_id'].unique()
-            )
-            sale_amount_per_category[category] = total_sale_amount
+        receipts = user_transactions[['category', 'receipt_id']].drop_duplicates()
+        sale_amounts = pd.Series(receipt_item_index.get().sale_amounts(receipts['receipt_id']),
+                                 index=receipts['category'].to_numpy())
+        sale_amount_per_category = sale_amounts.groupby(level=0).sum()
 
-        return sale_amount_per_category
+        return {category: float(sale_amount_per_category.get(category, 0.0)) for category in categories}
 
 
+@instrument_stages('preprocess_data', 'calculate_historical_behavior', 'identify_october_anomalies',
+                   'analyze_and_report_anomalies', 'save_all_data_to_csv', 'analyze_anomalies')
 class SpendingAnalyzer:
-    def __init__(self, file_path, user_id, target_month=10):
-        self.data = pd.read_csv(file_path)
+    def __init__(self, file_path, user_id, target_month=10, target_year=None):
+        self.data = read_dataset(file_path)
         self.user_id = user_id
         self.target_month = target_month  # October
+        self.target_year = target_year  # The latest year in the data by default
         self.user_spending = None
 
         self.preprocess_data()
@@ -107,15 +193,16 @@ class SpendingAnalyzer:
         # Ensure 'issue_date' is in datetime format
         self.data['issue_date'] = pd.to_datetime(self.data['issue_date'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
 
-        # Split the category into primary and subcategory
-        self.data[['primary_category', 'subcategory']] = self.data['category_item'].str.split('/', expand=True, n=1)
+        # Split the category into primary and subcategory, unless the dataset cache already did
+        if 'primary_category' not in self.data.columns:
+            self.data[['primary_category', 'subcategory']] = self.data['category_item'].str.split('/', expand=True, n=1)
 
         # Fill missing values and strip whitespace
         self.data['primary_category'] = self.data['primary_category'].fillna("Unknown").str.strip()
         self.data['subcategory'] = self.data['subcategory'].fillna("Unknown").str.strip()
 
         # Replace empty strings and variations of 'null' with 'Unknown'
-        self.data['subcategory'].replace(['', 'null', 'Null', 'NULL'], 'Unknown', inplace=True)
+        self.data['subcategory'] = self.data['subcategory'].replace(['', 'null', 'Null', 'NULL'], 'Unknown')
 
         # Ensure 'receipt_id' is present
         required_columns = ['customer_id', 'issue_date', 'total_price', 'category_item', 'receipt_id', 'quantity',
@@ -124,9 +211,13 @@ class SpendingAnalyzer:
         if missing_columns:
             raise ValueError(f"Missing columns in data: {missing_columns}")
 
-        # Separate historical data (before October) and October data
-        self.historical_data = self.data[self.data['issue_date'].dt.month < self.target_month]
-        self.october_data = self.data[self.data['issue_date'].dt.month == self.target_month]
+        # Separate historical data (the months before October of the target year) and October data
+        if self.target_year is None:
+            self.target_year = int(self.data['issue_date'].dt.year.max())
+        ordinals = self.data['issue_date'].dt.year * 12 + self.data['issue_date'].dt.month - 1
+        target_ordinal = period_ordinal((self.target_year, self.target_month))
+        self.historical_data = self.data[ordinals < target_ordinal]
+        self.october_data = self.data[ordinals == target_ordinal]
 
         # Ensure we have data for the user in historical data
         if self.historical_data[self.historical_data['customer_id'] == self.user_id].empty:
@@ -139,11 +230,7 @@ class SpendingAnalyzer:
         user_historical = self.historical_data[self.historical_data['customer_id'] == self.user_id]
 
         # Aggregate historical purchase amounts for each product
-        self.user_historical_product_stats = user_historical.groupby('product_name').agg(
-            historical_avg_quantity=('quantity', 'mean'),
-            historical_std_quantity=('quantity', 'std'),
-            historical_max_quantity=('quantity', 'max')
-        ).reset_index()
+        self.user_historical_product_stats = product_history_stats(user_historical)
 
     def identify_october_anomalies(self):
         """
@@ -155,38 +242,8 @@ class SpendingAnalyzer:
             print(f"No purchase data for User {self.user_id} in October.")
             return
 
-        # Merge October data with historical stats
-        self.user_october_purchases = user_october.merge(
-            self.user_historical_product_stats,
-            on='product_name',
-            how='left'
-        )
-
-        # Fill NaN values for products not seen before
-        self.user_october_purchases['historical_avg_quantity'].fillna(0, inplace=True)
-        self.user_october_purchases['historical_std_quantity'].fillna(0, inplace=True)
-        self.user_october_purchases['historical_max_quantity'].fillna(0, inplace=True)
-
-        # Calculate z-score for quantity
-        def calculate_z_score(row):
-            if row['historical_std_quantity'] > 0:
-                return (row['quantity'] - row['historical_avg_quantity']) / row['historical_std_quantity']
-            else:
-                # If std is 0, but quantity differs from historical average, flag as anomaly
-                if row['quantity'] != row['historical_avg_quantity']:
-                    return float('inf')  # Infinite z-score
-                else:
-                    return 0
-
-        self.user_october_purchases['quantity_z_score'] = self.user_october_purchases.apply(calculate_z_score, axis=1)
-
-        # Identify anomalies based on z-score threshold
-        z_score_threshold = 2  # You can adjust this threshold
-        self.user_october_purchases['is_anomaly'] = self.user_october_purchases[
-                                                        'quantity_z_score'].abs() > z_score_threshold
-
-        # For products not seen before, we can also flag them as potential anomalies
-        self.user_october_purchases['is_new_product'] = self.user_october_purchases['historical_avg_quantity'] == 0
+        # Merge October data with historical stats and score the quantities
+        self.user_october_purchases = score_purchases(user_october, self.user_historical_product_stats)
 
     def analyze_and_report_anomalies(self):
         """
@@ -200,11 +257,7 @@ class SpendingAnalyzer:
             return None
 
         # Prepare a report
-        anomalies_report = anomalies[[
-            'product_name', 'quantity', 'historical_avg_quantity', 'historical_std_quantity',
-            'quantity_z_score', 'is_anomaly', 'is_new_product', 'receipt_id', 'issue_date',
-            'primary_category', 'subcategory', 'total_price'
-        ]]
+        anomalies_report = anomalies[ANOMALY_REPORT_COLUMNS]
 
         # Save to CSV
         output_dir = 'output'
@@ -239,40 +292,10 @@ class SpendingAnalyzer:
         """
         anomalies_report = self.analyze_and_report_anomalies()
         if anomalies_report is not None:
-            # Sort anomalies by the absolute value of the z-score
-            anomalies_report['abs_z_score'] = anomalies_report['quantity_z_score'].abs()
-            anomalies_report = anomalies_report.sort_values(by='abs_z_score', ascending=False)
-
-            # Identify the top N anomalies (e.g., top 5)
-            top_anomalies = anomalies_report.head(5)
-
-            # Generate recommendations or messages
-            recommendations = []
-            for index, row in top_anomalies.iterrows():
-                product_name = row['product_name']
-                quantity = row['quantity']
-                historical_avg = row['historical_avg_quantity']
-                z_score = row['quantity_z_score']
-                is_new_product = row['is_new_product']
-                issue_date = row['issue_date']
-
-                if is_new_product:
-                    message = (f"On {issue_date.date()}, you purchased '{product_name}' for the first time. "
-                               f"Consider if this purchase aligns with your usual spending habits.")
-                else:
-                    message = (f"On {issue_date.date()}, you purchased '{product_name}' in a quantity ({quantity}) "
-                               f"significantly different from your historical average ({historical_avg:.2f}).")
-
-                recommendations.append({
-                    'product_name': product_name,
-                    'quantity': quantity,
-                    'historical_avg_quantity': historical_avg,
-                    'quantity_z_score': z_score,
-                    'message': message
-                })
-
-            # Convert recommendations to DataFrame
-            recommendations_df = pd.DataFrame(recommendations)
+            # Identify the top N anomalies (e.g., top 5) and generate recommendations
+            top_anomalies = top_anomalies_per_user(anomalies_report.assign(customer_id=self.user_id), top_n=5)
+            recommendations_df = top_anomalies[
+                ['product_name', 'quantity', 'historical_avg_quantity', 'quantity_z_score', 'message']]
 
             # Save recommendations to CSV
             output_dir = 'output'
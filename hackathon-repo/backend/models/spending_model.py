@@ -0,0 +1,75 @@
+from sqlalchemy import Column, DateTime, Float, Index, Integer, String
+
+from utils.database import Base
+
+
+class ReceiptModel(Base):
+    __tablename__ = "receipts"
+
+    receipt_id = Column(String, primary_key=True)
+    customer_id = Column(Integer, nullable=False)
+    issue_date = Column(DateTime)
+    total_price = Column(Float)
+
+    __table_args__ = (
+        Index("ix_receipts_customer_date", "customer_id", "issue_date"),
+    )
+
+
+class SpendingItemModel(Base):
+    __tablename__ = "spending_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    customer_id = Column(Integer, nullable=False)
+    receipt_id = Column(String, nullable=False, index=True)
+    issue_date = Column(DateTime)
+    year = Column(Integer)
+    month = Column(Integer)
+    category_item = Column(String)
+    primary_category = Column(String, nullable=False)
+    subcategory = Column(String, nullable=False)
+    total_price = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_spending_items_customer_date", "customer_id", "issue_date"),
+        Index("ix_spending_items_category", "primary_category", "subcategory"),
+    )
+
+
+class MonthlyCategorySpendingModel(Base):
+    """
+    Summary table: spending of every user per (year, month, category, subcategory).
+    """
+    __tablename__ = "monthly_category_spending"
+
+    customer_id = Column(Integer, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    primary_category = Column(String, primary_key=True)
+    subcategory = Column(String, primary_key=True)
+    total_spent = Column(Float, nullable=False)
+    item_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_monthly_category_spending_period", "year", "month", "primary_category", "subcategory"),
+    )
+
+
+class CategoryStatisticsModel(Base):
+    """
+    Summary table: mean and sample variance of the per-user spend in a category
+    (level 'main', subcategory '') or subcategory (level 'subcategory') over the window from
+    January up to `month` of `year`, across the users who spent in it.
+    """
+    __tablename__ = "category_statistics"
+
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    level = Column(String, primary_key=True)
+    primary_category = Column(String, primary_key=True)
+    subcategory = Column(String, primary_key=True)
+    user_count = Column(Integer, nullable=False)
+    total_spent = Column(Float, nullable=False)
+    mean_spent = Column(Float)
+    # NULL for fewer than two users; the variance is stored as SQLite has no SQRT by default
+    variance_spent = Column(Float)
@@ -0,0 +1,232 @@
+from typing import Iterable, List, Optional
+
+import pandas as pd
+from sqlalchemy import delete, func, select, text
+
+from models.spending_model import (CategoryStatisticsModel, MonthlyCategorySpendingModel, ReceiptModel,
+                                   SpendingItemModel)
+from utils.database import async_engine, async_session, Base
+
+SPENDING_TABLES = [
+    ReceiptModel.__table__,
+    SpendingItemModel.__table__,
+    MonthlyCategorySpendingModel.__table__,
+    CategoryStatisticsModel.__table__,
+]
+
+# Rows per INSERT statement of the bulk load
+LOAD_CHUNK_SIZE = 5000
+
+REFRESH_MONTHLY_SPENDING = text("""
+    INSERT INTO monthly_category_spending
+        (customer_id, year, month, primary_category, subcategory, total_spent, item_count)
+    SELECT customer_id, year, month, primary_category, subcategory, SUM(total_price), COUNT(*)
+    FROM spending_items
+    WHERE year IS NOT NULL
+    GROUP BY customer_id, year, month, primary_category, subcategory
+""")
+
+# Spend of every user in the window from January up to :month of :year, per category
+# (level 'main') or per known subcategory (level 'subcategory'), then the mean and the sample
+# variance across the users in two passes, which is exact unlike SUM(x * x) - n * mean^2.
+REFRESH_CATEGORY_STATISTICS = """
+    INSERT INTO category_statistics
+        (year, month, level, primary_category, subcategory, user_count, total_spent, mean_spent, variance_spent)
+    WITH user_totals AS (
+        SELECT customer_id, primary_category, {subcategory} AS subcategory, SUM(total_spent) AS spent
+        FROM monthly_category_spending
+        WHERE year = :year AND month <= :month {condition}
+        GROUP BY customer_id, primary_category{group_by}
+    ), statistics AS (
+        SELECT primary_category, subcategory, COUNT(*) AS user_count, SUM(spent) AS total_spent,
+               AVG(spent) AS mean_spent
+        FROM user_totals
+        GROUP BY primary_category, subcategory
+    )
+    SELECT CAST(:year AS INTEGER), CAST(:month AS INTEGER), '{level}', s.primary_category, s.subcategory,
+           s.user_count, s.total_spent, s.mean_spent,
+           CASE WHEN s.user_count > 1
+                THEN SUM((t.spent - s.mean_spent) * (t.spent - s.mean_spent)) / (s.user_count - 1)
+           END
+    FROM statistics s
+    JOIN user_totals t ON t.primary_category = s.primary_category AND t.subcategory = s.subcategory
+    GROUP BY s.primary_category, s.subcategory, s.user_count, s.total_spent, s.mean_spent
+"""
+
+REFRESH_MAIN_STATISTICS = text(REFRESH_CATEGORY_STATISTICS.format(
+    level='main', subcategory="''", condition='', group_by=''
+))
+REFRESH_SUBCATEGORY_STATISTICS = text(REFRESH_CATEGORY_STATISTICS.format(
+    level='subcategory', subcategory='subcategory', condition="AND subcategory != 'Unknown'",
+    group_by=', subcategory'
+))
+# The same for the categories and subcategories of one primary category
+REFRESH_CATEGORY_MAIN_STATISTICS = text(REFRESH_CATEGORY_STATISTICS.format(
+    level='main', subcategory="''", condition='AND primary_category = :primary_category', group_by=''
+))
+REFRESH_CATEGORY_SUBCATEGORY_STATISTICS = text(REFRESH_CATEGORY_STATISTICS.format(
+    level='subcategory', subcategory='subcategory',
+    condition="AND subcategory != 'Unknown' AND primary_category = :primary_category", group_by=', subcategory'
+))
+
+ADD_MONTHLY_SPENDING = text("""
+    INSERT INTO monthly_category_spending
+        (customer_id, year, month, primary_category, subcategory, total_spent, item_count)
+    VALUES (:customer_id, :year, :month, :primary_category, :subcategory, :total_spent, :item_count)
+    ON CONFLICT (customer_id, year, month, primary_category, subcategory) DO UPDATE SET
+        total_spent = monthly_category_spending.total_spent + excluded.total_spent,
+        item_count = monthly_category_spending.item_count + excluded.item_count
+""")
+
+
+async def create_spending_tables(drop: bool = False) -> None:
+    async with async_engine.begin() as connection:
+        if drop:
+            await connection.run_sync(Base.metadata.drop_all, tables=SPENDING_TABLES)
+        await connection.run_sync(Base.metadata.create_all, tables=SPENDING_TABLES)
+
+
+def spending_rows(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows of the spending_items table from prepared spending data (see dataset_store).
+    """
+    return pd.DataFrame({
+        'customer_id': data['customer_id'].astype(int),
+        'receipt_id': data['receipt_id'].astype(str),
+        'issue_date': data['issue_date'],
+        'year': data['issue_date'].dt.year.astype('Int64'),
+        'month': data['issue_date'].dt.month.astype('Int64'),
+        'category_item': data['category_item'].astype(object),
+        'primary_category': data['primary_category'].astype(str),
+        'subcategory': data['subcategory'].astype(str),
+        'total_price': data['total_price'].astype(float),
+    })
+
+
+def receipt_rows(items: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per receipt. Every item row of the merged data repeats the receipt's total.
+    """
+    return items.groupby('receipt_id', sort=False, observed=True).agg(
+        customer_id=('customer_id', 'first'),
+        issue_date=('issue_date', 'first'),
+        total_price=('total_price', 'first'),
+    ).reset_index()
+
+
+async def load_spending_data(data: pd.DataFrame) -> None:
+    """
+    Replaces the receipts and spending rows with the prepared spending data and rebuilds the
+    summary tables.
+    """
+    items = spending_rows(data)
+    receipts = receipt_rows(items)
+
+    def insert(connection):
+        for table in (SpendingItemModel.__table__, ReceiptModel.__table__):
+            connection.execute(table.delete())
+        items.to_sql(SpendingItemModel.__tablename__, connection, if_exists='append', index=False,
+                     chunksize=LOAD_CHUNK_SIZE)
+        receipts.to_sql(ReceiptModel.__tablename__, connection, if_exists='append', index=False,
+                        chunksize=LOAD_CHUNK_SIZE)
+
+    async with async_engine.begin() as connection:
+        await connection.run_sync(insert)
+    await refresh_summaries()
+
+
+async def refresh_summaries() -> None:
+    """
+    Rebuilds the monthly spending and category statistics tables from the spending rows, for
+    every month of every year in the data.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(delete(MonthlyCategorySpendingModel))
+            await session.execute(delete(CategoryStatisticsModel))
+            await session.execute(REFRESH_MONTHLY_SPENDING)
+
+            years = (await session.execute(select(MonthlyCategorySpendingModel.year).distinct())).scalars().all()
+            for year in years:
+                for month in range(1, 13):
+                    parameters = {'year': year, 'month': month}
+                    await session.execute(REFRESH_MAIN_STATISTICS, parameters)
+                    await session.execute(REFRESH_SUBCATEGORY_STATISTICS, parameters)
+
+
+async def add_receipt(data: pd.DataFrame) -> bool:
+    """
+    Adds the prepared spending rows of one receipt (see dataset_store) and updates the summary
+    tables: the user's monthly spending, and the statistics of the receipt's primary categories
+    in the windows of its year that include its month. Returns False if the receipt is already
+    in the tables.
+    """
+    items = spending_rows(data)
+    receipt = receipt_rows(items)
+    receipt_id = receipt['receipt_id'].iloc[0]
+
+    dated = items[items['year'].notna()]
+    monthly = dated.groupby(['customer_id', 'year', 'month', 'primary_category', 'subcategory']).agg(
+        total_spent=('total_price', 'sum'), item_count=('total_price', 'size')
+    ).reset_index()
+
+    async with async_session() as session:
+        async with session.begin():
+            if await session.get(ReceiptModel, receipt_id) is not None:
+                return False
+            session.add(ReceiptModel(**receipt.iloc[0].to_dict()))
+            session.add_all(SpendingItemModel(**row) for row in items.astype(object).to_dict(orient='records'))
+            if monthly.empty:
+                return True
+
+            await session.execute(ADD_MONTHLY_SPENDING, monthly.astype(object).to_dict(orient='records'))
+            year, first_month = int(monthly['year'].iloc[0]), int(monthly['month'].iloc[0])
+            for primary_category in monthly['primary_category'].unique():
+                await session.execute(delete(CategoryStatisticsModel).where(
+                    CategoryStatisticsModel.year == year,
+                    CategoryStatisticsModel.month >= first_month,
+                    CategoryStatisticsModel.primary_category == primary_category,
+                ))
+                for month in range(first_month, 13):
+                    parameters = {'year': year, 'month': month, 'primary_category': primary_category}
+                    await session.execute(REFRESH_CATEGORY_MAIN_STATISTICS, parameters)
+                    await session.execute(REFRESH_CATEGORY_SUBCATEGORY_STATISTICS, parameters)
+    return True
+
+
+async def get_latest_year() -> Optional[int]:
+    async with async_session() as session:
+        return await session.scalar(select(func.max(MonthlyCategorySpendingModel.year)))
+
+
+async def get_user_category_spending(user_id: int, year: int, month: int) -> List[tuple]:
+    """
+    (primary_category, subcategory, total_spent) of a user from January up to `month` of `year`.
+    Reads only the user's rows of the monthly summary (its primary key starts with the user).
+    """
+    summary = MonthlyCategorySpendingModel
+    async with async_session() as session:
+        result = await session.execute(
+            select(summary.primary_category, summary.subcategory, func.sum(summary.total_spent))
+            .where(summary.customer_id == user_id, summary.year == year, summary.month <= month)
+            .group_by(summary.primary_category, summary.subcategory)
+            .order_by(summary.primary_category, summary.subcategory)
+        )
+        return result.all()
+
+
+async def get_category_statistics(year: int, month: int,
+                                  primary_categories: Iterable[str]) -> List[CategoryStatisticsModel]:
+    """
+    Cohort statistics of the given categories and their subcategories for the window.
+    """
+    statistics = CategoryStatisticsModel
+    async with async_session() as session:
+        result = await session.execute(
+            select(statistics).where(
+                statistics.year == year,
+                statistics.month == month,
+                statistics.primary_category.in_(list(primary_categories)),
+            )
+        )
+        return list(result.scalars())
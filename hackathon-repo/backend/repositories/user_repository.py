@@ -1,10 +1,90 @@
-from sqlalchemy import select
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from cachetools import TTLCache
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
 
 from models.user_model import UserModel
 from utils.database import async_session
+from utils.environment_variables import USER_CACHE_SIZE, USER_CACHE_TTL
+from utils.metrics import CACHE_LOOKUPS
+
+# Largest number of IDs bound in one IN clause
+ID_CHUNK_SIZE = 500
+
+# Read-through cache of users by ID. Writes through the ORM invalidate their rows (see the
+# listeners below), the TTL bounds the staleness of rows changed outside of this process.
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+
+def invalidate_users(user_ids: Iterable[int]) -> None:
+    with _cache_lock:
+        for user_id in user_ids:
+            user_cache.pop(user_id, None)
+
+
+def clear_user_cache() -> None:
+    with _cache_lock:
+        user_cache.clear()
+
+
+@event.listens_for(UserModel, 'after_insert')
+@event.listens_for(UserModel, 'after_update')
+@event.listens_for(UserModel, 'after_delete')
+def _on_user_written(mapper, connection, user: UserModel) -> None:
+    invalidate_users([user.id])
+    session = object_session(user)
+    if session is not None:
+        session.info.setdefault('written_user_ids', set()).add(user.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session: Session) -> None:
+    # A concurrent read between the flush and the commit may have cached the old row again
+    invalidate_users(session.info.pop('written_user_ids', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session: Session) -> None:
+    session.info.pop('written_user_ids', None)
+
+
+async def get_users_by_ids(user_ids: Iterable[int]) -> Dict[int, UserModel]:
+    """
+    Returns the existing users of the given IDs, in the order of the IDs. Cached users are served
+    from memory, all others are loaded in one session with one SELECT per `ID_CHUNK_SIZE` IDs.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    found, missing = {}, []
+    with _cache_lock:
+        for user_id in user_ids:
+            user = user_cache.get(user_id)
+            if user is not None:
+                found[user_id] = user
+            else:
+                missing.append(user_id)
+    CACHE_LOOKUPS.inc(len(found), cache='users', result='memory')
+    CACHE_LOOKUPS.inc(len(missing), cache='users', result='miss')
+
+    if missing:
+        loaded: List[UserModel] = []
+        async with async_session() as session:
+            for start in range(0, len(missing), ID_CHUNK_SIZE):
+                chunk = missing[start:start + ID_CHUNK_SIZE]
+                result = await session.execute(select(UserModel).where(UserModel.id.in_(chunk)))
+                loaded.extend(result.scalars())
+
+        with _cache_lock:
+            for user in loaded:
+                user_cache[user.id] = user
+                found[user.id] = user
+
+    return {user_id: found[user_id] for user_id in user_ids if user_id in found}
+
+
+async def get_user_by_id(user_id: int) -> Optional[UserModel]:
+    users = await get_users_by_ids([user_id])
+    return users.get(user_id)
 
-async def get_user_by_id(user_id: int) -> UserModel:
-    async with async_session() as session:
-        result = await session.execute(select(UserModel).where(UserModel.id == user_id))
-        user = result.scalars().first()  # `scalars()` extracts ORM objects from the result
-    return user
\ No newline at end of file
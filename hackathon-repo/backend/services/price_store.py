@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+from datetime import date, timedelta
+from typing import Dict, Optional
+
+import pandas as pd
+from alpha_vantage.async_support.timeseries import TimeSeries
+
+from utils.environment_variables import ALPHAVANTAGE_API_KEY, ALPHAVANTAGE_REQUESTS_PER_MINUTE
+from utils.metrics import OUTBOUND_REQUEST_SECONDS
+
+PRICES_DIR = 'data/prices'
+
+# A 'compact' response holds the last 100 trading days, about 140 calendar days
+COMPACT_WINDOW = timedelta(days=130)
+
+
+def normalize_symbol(symbol: str) -> str:
+    """
+    The form a symbol is stored, cached and locked under, so 'aapl' and 'AAPL' share one file.
+    """
+    return symbol.strip().upper()
+
+
+class TokenBucket:
+    """
+    Async rate limiter: allows `capacity` calls at once and refills `rate` tokens per second.
+    Callers wait in FIFO order until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> None:
+        # Created lazily so the lock belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PriceStore:
+    """
+    Local store of daily prices per symbol, kept in one CSV file per symbol.
+
+    Prices are downloaded incrementally: the first fetch of a symbol gets the full history, later
+    fetches only the recent 'compact' window, from which the days after the last stored date are
+    appended. A symbol is refreshed at most once per day, and all downloads share one Alpha Vantage
+    client and go through a token bucket so they stay within the API quota.
+    """
+
+    def __init__(self, directory: str = PRICES_DIR, requests_per_minute: float = ALPHAVANTAGE_REQUESTS_PER_MINUTE):
+        self.directory = directory
+        self.bucket = TokenBucket(rate=requests_per_minute / 60, capacity=max(1, int(requests_per_minute)))
+        self._client: Optional[TimeSeries] = None
+        self._prices: Dict[str, pd.DataFrame] = {}
+        self._checked: Dict[str, date] = {}
+        self._symbol_locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def client(self) -> TimeSeries:
+        if self._client is None:
+            self._client = TimeSeries(key=ALPHAVANTAGE_API_KEY, output_format='pandas')
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def _path(self, symbol: str) -> str:
+        return os.path.join(self.directory, f'{symbol}.csv')
+
+    def load(self, symbol: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the stored prices of a symbol (sorted by date) without downloading anything.
+        """
+        symbol = normalize_symbol(symbol)
+        prices = self._prices.get(symbol)
+        if prices is None and os.path.exists(self._path(symbol)):
+            prices = pd.read_csv(self._path(symbol), index_col='date', parse_dates=['date'])
+            self._prices[symbol] = prices
+        return prices
+
+    def _save(self, symbol: str, prices: pd.DataFrame) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f'{self._path(symbol)}.tmp'
+        prices.to_csv(temporary, index_label='date')
+        os.replace(temporary, self._path(symbol))
+        self._prices[symbol] = prices
+
+    async def _download(self, symbol: str, outputsize: str) -> pd.DataFrame:
+        await self.bucket.acquire()
+        start = time.perf_counter()
+        try:
+            data, _ = await self.client.get_daily(symbol=symbol, outputsize=outputsize)
+        except Exception:
+            OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - start, service='alphavantage', outcome='failed')
+            raise
+        OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - start, service='alphavantage', outcome='ok')
+        data.index = pd.to_datetime(data.index)
+        data.index.name = 'date'
+        return data.sort_index()
+
+    async def get_prices(self, symbol: str) -> pd.DataFrame:
+        """
+        Returns the daily prices of a symbol, downloading only what is missing locally.
+        """
+        symbol = normalize_symbol(symbol)
+        lock = self._symbol_locks.setdefault(symbol, asyncio.Lock())
+        async with lock:
+            today = date.today()
+            prices = self.load(symbol)
+            if prices is not None and self._checked.get(symbol) == today:
+                return prices
+
+            if prices is None or prices.empty:
+                prices = await self._download(symbol, outputsize='full')
+                self._save(symbol, prices)
+            else:
+                last_date = prices.index[-1]
+                if last_date.date() < today:
+                    outputsize = 'compact' if today - last_date.date() < COMPACT_WINDOW else 'full'
+                    recent = await self._download(symbol, outputsize=outputsize)
+                    new_rows = recent[recent.index > last_date]
+                    if not new_rows.empty:
+                        prices = pd.concat([prices, new_rows])
+                        self._save(symbol, prices)
+
+            self._checked[symbol] = today
+            return prices
+
+
+price_store = PriceStore()
@@ -0,0 +1,69 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from ml_services.cohort_scoring import ANOMALY_Z_SCORE_THRESHOLD, SCORE_COLUMNS
+from repositories import spending_repository
+
+
+async def resolve_year(year: Optional[int] = None) -> Optional[int]:
+    """
+    The given year, or the latest year in the spending tables (None if they are empty).
+    """
+    return year if year is not None else await spending_repository.get_latest_year()
+
+
+async def add_receipt(rows: pd.DataFrame) -> bool:
+    """
+    Adds an ingested receipt, as prepared spending rows, to the spending tables and their
+    summaries. Returns False if the tables already hold it.
+    """
+    return await spending_repository.add_receipt(rows)
+
+
+async def get_user_spending_scores(user_id: int, month: int, year: int) -> pd.DataFrame:
+    """
+    Anomaly scores of a user's categories from January up to `month` of `year`, in the layout of
+    `CohortScores.for_user`. Only the user's summary rows and the statistics of the user's
+    categories are read, so the work does not grow with the cohort.
+    """
+    rows = await spending_repository.get_user_category_spending(user_id, year, month)
+    spending = pd.DataFrame(rows, columns=['primary_category', 'subcategory', 'total_subcat_spent'])
+    if spending.empty:
+        return pd.DataFrame(columns=SCORE_COLUMNS)
+
+    category_statistics = await spending_repository.get_category_statistics(
+        year, month, spending['primary_category'].unique()
+    )
+    statistics = pd.DataFrame(
+        [(s.level, s.primary_category, s.subcategory, s.mean_spent, s.variance_spent) for s in category_statistics],
+        columns=['level', 'primary_category', 'subcategory', 'mean', 'variance']
+    )
+    statistics['std'] = np.sqrt(statistics['variance'].astype(float))
+
+    main = statistics[statistics['level'] == 'main'].set_index('primary_category')
+    subcategories = statistics[statistics['level'] == 'subcategory'].set_index(['primary_category', 'subcategory'])
+    pairs = pd.MultiIndex.from_frame(spending[['primary_category', 'subcategory']])
+
+    spending.insert(0, 'customer_id', user_id)
+    spending['mean_subcat_spent'] = subcategories['mean'].reindex(pairs).to_numpy(dtype=float)
+    spending['std_subcat_spent'] = subcategories['std'].reindex(pairs).to_numpy(dtype=float)
+    spending['total_main_spent'] = spending.groupby('primary_category')['total_subcat_spent'].transform('sum')
+    spending['mean_main_spent'] = main['mean'].reindex(spending['primary_category']).to_numpy(dtype=float)
+    spending['std_main_spent'] = main['std'].reindex(spending['primary_category']).to_numpy(dtype=float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        main_z_score = (spending['total_main_spent'] - spending['mean_main_spent']) / spending['std_main_spent']
+        subcat_z_score = (spending['total_subcat_spent'] - spending['mean_subcat_spent']) / spending['std_subcat_spent']
+    subcat_z_score = subcat_z_score.where(spending['std_subcat_spent'] != 0)
+    spending['main_z_score'] = main_z_score
+    spending['subcat_z_score'] = subcat_z_score
+
+    use_subcat = subcat_z_score.notna() & (subcat_z_score.abs() >= main_z_score.abs())
+    spending['final_z_score'] = np.where(use_subcat, subcat_z_score, main_z_score)
+    spending['anomaly_level'] = np.where(use_subcat, 'subcategory', 'main_category')
+    spending['is_anomaly'] = spending['final_z_score'] > ANOMALY_Z_SCORE_THRESHOLD
+
+    return spending[SCORE_COLUMNS]
+
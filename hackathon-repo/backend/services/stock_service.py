@@ -1,35 +1,30 @@
 from time import time
 from typing import Dict
 
-from alpha_vantage.async_support.timeseries import TimeSeries
 import pandas as pd
 import asyncio
 
+from services.price_store import price_store
+from services.symbol_search import SYMBOLS_FILE, symbol_index
 from utils.environment_variables import ALPHAVANTAGE_API_KEY
 
-ts = TimeSeries(key=ALPHAVANTAGE_API_KEY, output_format='pandas')
-
 def save_all_possible_stocks() -> None:
     url = f"https://www.alphavantage.co/query?function=LISTING_STATUS&apikey={ALPHAVANTAGE_API_KEY}"
 
     try:
         active_symbols = pd.read_csv(url)
-        active_symbols.to_csv('active_symbols.csv', index=False)
-        print("Data successfully saved to 'active_symbols.csv'.")
+        active_symbols.to_csv(SYMBOLS_FILE, index=False)
+        # The search index is rebuilt from the new listing on next use
+        symbol_index.reset()
+        print(f"Data successfully saved to '{SYMBOLS_FILE}'.")
     except Exception as e:
         print(f"An error occurred: {e}")
 
 async def get_stock_growth_over_calendar_year(stock_symbol: str) -> float:
-    ts = TimeSeries(key=ALPHAVANTAGE_API_KEY, output_format='pandas')
-
-    data, _ = await ts.get_daily(symbol=stock_symbol, outputsize='full')
-
-    await ts.close()
-
-    data.sort_index(inplace=True)
+    data = await price_store.get_prices(stock_symbol)
     start_date = '2024-01-02'
 
-    if start_date not in data.index:
+    if pd.Timestamp(start_date) not in data.index:
         raise ValueError(f"No data available for {start_date} for symbol {stock_symbol}")
 
     start_price = data.loc[start_date]['4. close']
@@ -60,6 +55,12 @@ async def get_multiple_stock_growth(stock_symbols: list[str]) -> Dict[str, float
 if __name__ == '__main__':
     start_time = time()
 
-    asyncio.run(get_multiple_stock_growth(['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA']))
+    async def main():
+        try:
+            await get_multiple_stock_growth(['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA'])
+        finally:
+            await price_store.close()
+
+    asyncio.run(main())
 
     print(f"Ececution time: {time() - start_time:.2f} seconds")
\ No newline at end of file
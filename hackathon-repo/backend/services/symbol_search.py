@@ -0,0 +1,125 @@
+import re
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from utils.lazy import Lazy
+
+SYMBOLS_FILE = 'data/active_symbols.csv'
+
+_TOKEN_PATTERN = re.compile(r'[0-9a-z]+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def _prefix_range(sorted_values: List[str], prefix: str):
+    """
+    Index range of the values starting with `prefix` in a sorted list.
+    """
+    start = bisect_left(sorted_values, prefix)
+    stop = bisect_left(sorted_values, prefix + '￿', lo=start)
+    return start, stop
+
+
+class SymbolIndex:
+    """
+    In-memory autocomplete index over the listed symbols.
+
+    Symbols are kept in a sorted array, so a symbol prefix is a binary search. Company names are
+    split into tokens with a sorted token list and a posting array per token; every query word is
+    matched as a token prefix and the postings are intersected. Exchange, asset type and status
+    filters are precomputed boolean masks.
+    """
+
+    def __init__(self, listings: pd.DataFrame):
+        self.listings = listings.reset_index(drop=True)
+        self.records = self.listings.to_dict(orient='records')
+
+        symbols = self.listings['symbol'].str.upper().to_numpy()
+        self._symbol_order = np.argsort(symbols, kind='stable')
+        self._sorted_symbols = symbols[self._symbol_order].tolist()
+        self._symbol_lengths = np.array([len(symbol) for symbol in symbols])
+
+        postings: Dict[str, list] = {}
+        for row, name in enumerate(self.listings['name']):
+            for token in set(tokenize(name)):
+                postings.setdefault(token, []).append(row)
+        self._tokens = sorted(postings)
+        self._postings = [np.array(postings[token], dtype=np.int32) for token in self._tokens]
+
+        self._masks = {
+            column: {value: (self.listings[column] == value).to_numpy() for value in self.listings[column].unique()}
+            for column in ('exchange', 'assetType', 'status')
+        }
+
+    @classmethod
+    def from_csv(cls, file_path: str = SYMBOLS_FILE) -> 'SymbolIndex':
+        listings = pd.read_csv(file_path, keep_default_na=False, dtype=str)
+        return cls(listings)
+
+    def _symbol_matches(self, query: str) -> np.ndarray:
+        start, stop = _prefix_range(self._sorted_symbols, query.upper())
+        return self._symbol_order[start:stop]
+
+    def _name_matches(self, query: str) -> np.ndarray:
+        matches = None
+        for word in tokenize(query):
+            start, stop = _prefix_range(self._tokens, word)
+            if start == stop:
+                return np.empty(0, dtype=np.int32)
+            rows = np.unique(np.concatenate(self._postings[start:stop]))
+            matches = rows if matches is None else np.intersect1d(matches, rows, assume_unique=True)
+        return matches if matches is not None else np.empty(0, dtype=np.int32)
+
+    def _filter_mask(self, exchange: Optional[str], asset_type: Optional[str], status: Optional[str]):
+        mask = None
+        for column, value in (('exchange', exchange), ('assetType', asset_type), ('status', status)):
+            if value is None:
+                continue
+            column_mask = self._masks[column].get(value)
+            if column_mask is None:
+                return np.zeros(len(self.records), dtype=bool)
+            mask = column_mask if mask is None else mask & column_mask
+        return mask
+
+    def search(self, query: str, limit: int = 10, exchange: Optional[str] = None,
+               asset_type: Optional[str] = None, status: Optional[str] = None) -> List[dict]:
+        """
+        Returns up to `limit` listings matching the query: exact symbol first, then symbol prefixes
+        (shortest first), then listings whose name matches every query word.
+        """
+        query = query.strip()
+        if not query or limit <= 0:
+            return []
+
+        mask = self._filter_mask(exchange, asset_type, status)
+
+        symbol_rows = self._symbol_matches(query)
+        if mask is not None:
+            symbol_rows = symbol_rows[mask[symbol_rows]]
+        # Stable sort keeps the alphabetical order among symbols of equal length
+        symbol_rows = symbol_rows[np.argsort(self._symbol_lengths[symbol_rows], kind='stable')]
+
+        results, seen = [], set()
+        for row in symbol_rows[:limit]:
+            results.append(self.records[row])
+            seen.add(row)
+
+        if len(results) < limit:
+            name_rows = self._name_matches(query)
+            if mask is not None:
+                name_rows = name_rows[mask[name_rows]]
+            for row in name_rows:
+                if row not in seen:
+                    results.append(self.records[row])
+                    if len(results) == limit:
+                        break
+
+        return results
+
+
+symbol_index = Lazy(SymbolIndex.from_csv)
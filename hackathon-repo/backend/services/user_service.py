@@ -1,5 +1,11 @@
+from typing import Iterable
+
 from repositories import user_repository
 
 async def get_user(user_id: int):
     user = await user_repository.get_user_by_id(user_id)
-    return user
\ No newline at end of file
+    return user
+
+async def get_users(user_ids: Iterable[int]):
+    users = await user_repository.get_users_by_ids(user_ids)
+    return list(users.values())
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The tests import the backend packages the way main.py does and use an in-memory database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+# Receipts posted by the tests go to a journal of their own
+os.environ.setdefault("INGESTED_RECEIPTS_DB", os.path.join(tempfile.mkdtemp(), "ingested_receipts.sqlite"))
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from controllers import advice_controller
+from ml_services.advice_engine import build_snapshot, load_snapshot
+from ml_services.spending_cube import get_spending_cube
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """
+    Replaces the snapshot and the store with fakes that record the thread they are called on.
+    """
+    threads = []
+    snapshot = build_snapshot(load_snapshot().data, 'test')
+
+    class Snapshots:
+        @staticmethod
+        def get():
+            threads.append(threading.get_ident())
+            return snapshot
+
+    def find_advice_result(snapshot, user_id, month, year):
+        threads.append(threading.get_ident())
+        return ('stored', user_id, month, year)
+
+    monkeypatch.setattr(advice_controller, 'spending_snapshot', Snapshots)
+    monkeypatch.setattr(advice_controller, 'find_advice_result', find_advice_result)
+    return threads
+
+
+def test_stored_results_are_looked_up_off_the_event_loop(lookups):
+    async def load():
+        return threading.get_ident(), await advice_controller.load_advice_result(12, 10, 2024)
+
+    loop_thread, result = asyncio.run(load())
+    assert result == ('stored', 12, 10, 2024)
+    assert len(lookups) == 2 and loop_thread not in lookups
+
+
+def test_unknown_users_are_not_found(lookups):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(advice_controller.load_advice_result(100000, 10, 2024))
+    assert error.value.status_code == 404
+
+
+def test_spending_trend_compares_the_last_months_with_the_year_before(lookups):
+    response = advice_controller.get_spending_trend(12, 10, None, 3, 12, 'primary_category')
+    snapshot = load_snapshot()
+    expected = get_spending_cube(snapshot).compare_windows((response['year'], 10), user_id=12)
+
+    assert response['recent_months'] == 3 and response['prior_months'] == 12
+    assert [row['primary_category'] for row in response['categories']] == expected['primary_category'].tolist()
+    assert [row['recent_monthly_spent'] for row in response['categories']] == \
+        pytest.approx(expected['recent_monthly_spent'].tolist())
+    # Categories without spending in the prior months have no change
+    assert all((row['change_ratio'] is None) == (row['prior_monthly_spent'] == 0) for row in response['categories'])
@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+import pytest
+
+from ml_services.analysis_pool import AnalysisPool
+from utils.metrics import ANALYSIS_STAGE_SECONDS, CACHE_LOOKUPS
+
+
+def record_in_worker(user_id: int) -> int:
+    """
+    Task recording metrics in the process it runs in; fails for negative user ids.
+    """
+    ANALYSIS_STAGE_SECONDS.observe(0.02, analyzer='test_analysis_pool', stage='record_in_worker')
+    CACHE_LOOKUPS.inc(cache='test_analysis_pool', result='miss')
+    if user_id < 0:
+        raise ValueError(f"User {user_id} does not exist in the dataset.")
+    return os.getpid()
+
+
+def test_metrics_recorded_in_worker_processes_reach_the_api_registry():
+    pool = AnalysisPool(workers=1)
+
+    async def run():
+        pid = await pool.run(('test', 1), record_in_worker, 1)
+        with pytest.raises(ValueError):
+            await pool.run(('test', -1), record_in_worker, -1)
+        return pid
+
+    try:
+        pid = asyncio.run(run())
+    finally:
+        pool.shutdown()
+
+    assert pid != os.getpid()
+    # Also the metrics of the failed task are forwarded
+    assert ANALYSIS_STAGE_SECONDS.count(analyzer='test_analysis_pool', stage='record_in_worker') == 2
+    assert CACHE_LOOKUPS.value(cache='test_analysis_pool', result='miss') == 2
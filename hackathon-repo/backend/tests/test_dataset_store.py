@@ -0,0 +1,36 @@
+import numpy as np
+
+from ml_services.advice_engine import SPENDING_DATA_FILE, load_snapshot
+from ml_services.dataset_store import (COMPACT_COLUMNS, COMPACT_SOURCE_COLUMNS, compact_spending_data, memory_report,
+                                       read_dataset, spending_prices)
+from ml_services.spending_cube import build_spending_cube
+
+
+def test_compact_layout_keeps_the_spending_rows_in_less_memory():
+    data = read_dataset(SPENDING_DATA_FILE, columns=COMPACT_SOURCE_COLUMNS)
+    compact = compact_spending_data(data)
+
+    assert list(compact.columns) == COMPACT_COLUMNS
+    assert compact['customer_id'].dtype == np.int32
+    assert compact['price_cents'].dtype == np.int32
+    assert all(compact[name].dtype == 'category' for name in ('receipt_id', 'primary_category', 'subcategory'))
+    # The cents give back exactly the prices read from the CSV
+    assert np.array_equal(spending_prices(compact), spending_prices(data))
+    assert (compact['receipt_id'].astype(str) == data['receipt_id'].astype(str)).all()
+
+    report = memory_report(compact)
+    assert report['column'].tolist() == [*COMPACT_COLUMNS, 'total']
+    assert report['bytes'].iloc[-1] == report['bytes'].iloc[:-1].sum()
+    assert report['bytes'].iloc[-1] < memory_report(data)['bytes'].iloc[-1]
+
+
+def test_snapshot_cube_is_the_cube_of_the_prepared_rows():
+    snapshot = load_snapshot()
+    assert list(snapshot.data.columns) == COMPACT_COLUMNS
+
+    built = build_spending_cube(snapshot.data)
+    expected = build_spending_cube(read_dataset(SPENDING_DATA_FILE))
+    assert np.array_equal(built.users, expected.users)
+    assert built.pairs.equals(expected.pairs)
+    assert np.array_equal(built.total, expected.total)
+    assert np.array_equal(built.sum_of_squares, expected.sum_of_squares)
@@ -0,0 +1,120 @@
+from datetime import datetime
+
+import pytest
+
+from ml_services.advice_engine import load_snapshot
+from ml_services.cohort_scoring import SCORE_COLUMNS, get_cohort_scores
+from ml_services.incremental_aggregates import get_live_spending
+from ml_services.receipt_journal import ReceiptJournal
+from ml_services.spending_cube import get_spending_cube
+from ml_services.spending_percentiles import get_spending_percentiles
+
+NEW_USER = 999999
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'ingested_receipts.sqlite')
+
+
+def ingest(live, receipt_id, user_id, year, month):
+    live.ingest(receipt_id, user_id, datetime(year, month, 14, 12, 30), [
+        {'category_item': 'Stravovanie/Potraviny', 'total_price': 480.5},
+        {'category_item': 'Bývanie a energie/null', 'total_price': 35.0},
+    ])
+
+
+def assert_same_scores(result, expected):
+    keys = ['primary_category', 'subcategory']
+    result = result.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    assert result[keys].astype(str).values.tolist() == expected[keys].astype(str).values.tolist()
+    for column in SCORE_COLUMNS[3:12]:
+        assert result[column].to_numpy(dtype=float) == pytest.approx(expected[column].to_numpy(dtype=float),
+                                                                     nan_ok=True), column
+    assert result['is_anomaly'].tolist() == expected['is_anomaly'].tolist()
+
+
+def test_ingested_receipts_give_the_scores_of_a_reloaded_snapshot(journal_path):
+    snapshot = load_snapshot(journal=ReceiptJournal(journal_path))
+    live = get_live_spending(snapshot)
+    year = live.last_period[0]
+    # Built before the receipts arrive, so they are updated rather than built with them
+    scores, percentiles = live.scores(year, 10), live.percentiles()
+
+    ingest(live, 'TEST-RECEIPT-1', 12, year, 5)
+    ingest(live, 'TEST-RECEIPT-2', NEW_USER, year, 5)
+    # Outside of the window of the scores
+    ingest(live, 'TEST-RECEIPT-3', 12, year, 11)
+
+    reloaded = load_snapshot(journal=ReceiptJournal(journal_path))
+    assert reloaded.version == f"{snapshot.version}+3"
+    expected = get_cohort_scores(reloaded, year, 10)
+    peers = expected.table[expected.table['subcategory'] == 'Potraviny']['customer_id'].unique()[:5].tolist()
+    for user_id in [12, NEW_USER, *peers]:
+        assert_same_scores(scores.for_user(user_id), expected.for_user(user_id))
+        assert scores.peer_average(user_id, 'Stravovanie', 'Potraviny') == \
+            pytest.approx(expected.peer_average(user_id, 'Stravovanie', 'Potraviny'))
+        assert scores.peer_average(user_id, 'Bývanie a energie') == \
+            pytest.approx(expected.peer_average(user_id, 'Bývanie a energie'))
+
+        for month in (5, 11):
+            comparison = percentiles.compare(user_id, (year, month))
+            expected_comparison = get_spending_percentiles(reloaded).compare(user_id, (year, month))
+            assert comparison[['primary_category', 'subcategory', 'users']].values.tolist() == \
+                expected_comparison[['primary_category', 'subcategory', 'users']].values.tolist()
+            for column in ['total_spent', 'percentile', 'median_spent']:
+                assert comparison[column].to_numpy() == pytest.approx(expected_comparison[column].to_numpy())
+
+    # Windows first asked for after the receipts were applied include them too
+    assert_same_scores(live.scores(year, 12).for_user(12), get_cohort_scores(reloaded, year, 12).for_user(12))
+
+
+def test_receipts_are_ingested_once_across_processes(journal_path):
+    # Two processes: each has its own connection to the journal and its own snapshot
+    first = get_live_spending(load_snapshot(journal=ReceiptJournal(journal_path)))
+    second = get_live_spending(load_snapshot(journal=ReceiptJournal(journal_path)))
+    year = first.last_period[0]
+    before = second.scores(year, 10).for_user(12)
+
+    ingest(first, 'TEST-RECEIPT-4', 12, year, 5)
+    with pytest.raises(ValueError):
+        ingest(second, 'TEST-RECEIPT-4', 12, year, 5)
+
+    # The failed attempt synced nothing, the next sync applies the receipt of the other process
+    second.sync()
+    assert second.position == first.position == 1
+    after = second.scores(year, 10).for_user(12)
+    potraviny = (after['subcategory'] == 'Potraviny').to_numpy()
+    assert after['total_subcat_spent'][potraviny].iloc[0] == pytest.approx(
+        before['total_subcat_spent'][(before['subcategory'] == 'Potraviny').to_numpy()].sum() + 480.5)
+    assert_same_scores(after, first.scores(year, 10).for_user(12))
+
+
+def test_only_the_results_of_users_with_new_receipts_change_version(journal_path):
+    live = get_live_spending(load_snapshot(journal=ReceiptJournal(journal_path)))
+    year = live.last_period[0]
+    assert live.result_version(12) == live.result_version(13) == live.snapshot.version
+
+    ingest(live, 'TEST-RECEIPT-5', 12, year, 5)
+    assert live.result_version(12) == f"{live.snapshot.version}/1"
+    assert live.result_version(13) == live.snapshot.version
+    assert not live.has_user(NEW_USER)
+
+
+def test_spending_trend_includes_the_ingested_receipts(journal_path):
+    live = get_live_spending(load_snapshot(journal=ReceiptJournal(journal_path)))
+    year = live.last_period[0]
+    # One receipt in the recent months, one in the prior months
+    ingest(live, 'TEST-RECEIPT-6', 12, year, 9)
+    ingest(live, 'TEST-RECEIPT-7', 12, year - 1, 11)
+
+    reloaded = get_spending_cube(load_snapshot(journal=ReceiptJournal(journal_path)))
+    for level, keys in [('primary_category', ['primary_category']),
+                        ('subcategory', ['primary_category', 'subcategory'])]:
+        trend = live.compare_windows(12, (year, 10), level=level)
+        expected = reloaded.compare_windows((year, 10), level=level, user_id=12)
+        assert trend[keys].astype(str).values.tolist() == expected[keys].astype(str).values.tolist()
+        for column in ['recent_monthly_spent', 'prior_monthly_spent', 'change_ratio']:
+            assert trend[column].to_numpy(dtype=float) == pytest.approx(expected[column].to_numpy(dtype=float),
+                                                                        nan_ok=True), (level, column)
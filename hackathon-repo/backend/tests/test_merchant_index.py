@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+from ml_services.merchant_index import build_merchant_rollups
+
+
+@pytest.fixture
+def rollups():
+    receipts = pd.DataFrame({
+        'customer_id': [1, 1, 1, 2, 2],
+        'issue_date': pd.to_datetime(['2023-05-02', '2024-02-10', '2024-02-11', '2024-02-01', '2024-11-30']),
+        'ico': [100, 100, 200, 100, 200],
+        'total_price': [5.0, 10.0, 4.0, 30.0, 8.0],
+    })
+    return build_merchant_rollups(receipts)
+
+
+def test_last_period_is_per_user(rollups):
+    assert rollups.last_period(1) == (2024, 2)
+    assert rollups.last_period(2) == (2024, 11)
+    assert rollups.last_period(1, 2023) == (2023, 5)
+    assert rollups.last_period(1, 2022) is None
+
+
+def test_top_merchants_compare_against_other_customers(rollups):
+    top = rollups.top_merchants(1, (2024, 2))
+
+    assert top['ico'].tolist() == [100, 200]
+    assert top['peer_customers'].tolist() == [1, 0]
+    assert top['peer_average_spent'].iloc[0] == pytest.approx(30.0)
+    assert top['share_of_month'].tolist() == pytest.approx([10 / 14, 4 / 14])
+
+
+def test_top_merchants_endpoint_defaults_to_the_users_latest_month():
+    import main
+
+    client = TestClient(main.app)
+    body = client.get('/merchants/top', params={'user_id': 12}).json()
+    assert body['merchants']
+
+    assert client.get('/merchants/top', params={'user_id': 12, 'year': 1999}).status_code == 404
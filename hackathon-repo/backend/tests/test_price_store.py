@@ -0,0 +1,80 @@
+import asyncio
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from services.price_store import PriceStore, TokenBucket
+
+
+class FakeTimeSeries:
+    """
+    Stand-in for the Alpha Vantage client, serving daily prices from the same first day up to
+    `days_ago` days before today, and recording the downloads.
+    """
+
+    def __init__(self, days_ago: int = 1):
+        index = pd.date_range(start='2024-01-01', end=pd.Timestamp(date.today() - timedelta(days=days_ago)), freq='D')
+        self.prices = pd.DataFrame({'4. close': range(len(index))}, index=index.strftime('%Y-%m-%d'), dtype=float)
+        self.downloads = []
+
+    async def get_daily(self, symbol: str, outputsize: str):
+        self.downloads.append((symbol, outputsize))
+        await asyncio.sleep(0.01)
+        # A 'compact' response holds the last 100 days, newest first like the real API
+        prices = self.prices if outputsize == 'full' else self.prices.iloc[-100:]
+        return prices.iloc[::-1].copy(), {}
+
+    async def close(self):
+        pass
+
+
+def store_with(client: FakeTimeSeries, directory) -> PriceStore:
+    store = PriceStore(directory=str(directory), requests_per_minute=6000)
+    store._client = client
+    return store
+
+
+def test_token_bucket_allows_bursts_then_refills_at_its_rate():
+    bucket = TokenBucket(rate=20, capacity=2)
+
+    async def acquire(count: int) -> float:
+        start = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    burst = asyncio.run(acquire(2))
+    refilled = asyncio.run(acquire(3))
+    assert burst < 0.04
+    # Three more tokens at 20 per second
+    assert refilled >= 0.14
+
+
+def test_symbols_are_downloaded_once_per_day_whatever_their_case(tmp_path):
+    client = FakeTimeSeries()
+    store = store_with(client, tmp_path)
+
+    async def fetch():
+        return await asyncio.gather(store.get_prices('aapl'), store.get_prices('AAPL'), store.get_prices(' Aapl'))
+
+    results = asyncio.run(fetch())
+    assert client.downloads == [('AAPL', 'full')]
+    assert all(prices is results[0] for prices in results)
+    assert results[0].index.is_monotonic_increasing and len(results[0]) == len(client.prices)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['AAPL.csv']
+
+
+def test_later_fetches_append_only_the_new_days(tmp_path):
+    asyncio.run(store_with(FakeTimeSeries(days_ago=6), tmp_path).get_prices('MSFT'))
+
+    # Some days later, in a new process: the stored file misses the last five days
+    client = FakeTimeSeries(days_ago=1)
+    prices = asyncio.run(store_with(client, tmp_path).get_prices('msft'))
+
+    assert client.downloads == [('MSFT', 'compact')]
+    expected = client.prices.sort_index()
+    assert prices.index.strftime('%Y-%m-%d').tolist() == expected.index.tolist()
+    assert prices['4. close'].tolist() == expected['4. close'].tolist()
+    stored = pd.read_csv(tmp_path / 'MSFT.csv', index_col='date', parse_dates=['date'])
+    assert stored.index.equals(prices.index)
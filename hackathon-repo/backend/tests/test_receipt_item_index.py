@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_services.receipt_item_index import PRODUCT_ITEMS_FILE, PRODUCTS_FILE, RECEIPTS_FILE, ReceiptItemIndex
+
+
+@pytest.fixture
+def small_index():
+    receipts = pd.DataFrame({'id': [10, 11, 12], 'receipt_id': ['A', 'B', 'C']})
+    products = pd.DataFrame({'id': [1, 2, 3], 'name': ['milk ', 'bread', 'ZLAVA'], 'item_type': ['K', 'K', 'Z'],
+                             'price': [1.5, 2.0, -0.4], 'category': ['dairy/milk', 'bakery/bread', 'discount']})
+    items = pd.DataFrame({'quantity': [2, 1, 3, 1], 'product_id': [1, 2, 1, 3], 'fs_receipt_id': [12, 12, 10, 11],
+                          'discount_id': [3, np.nan, np.nan, np.nan]})
+    return ReceiptItemIndex(receipts, items, products)
+
+
+def test_items_are_gathered_per_receipt(small_index):
+    items = small_index.items(['C', 'A', 'unknown'])
+
+    assert items['receipt_id'].tolist() == ['C', 'C', 'A']
+    assert items['product_name'].tolist() == ['milk', 'bread', 'milk']
+    assert items['total_price'].tolist() == [3.0, 2.0, 4.5]
+
+
+def test_sale_amounts_include_linked_discounts_and_sale_lines(small_index):
+    # Receipt C has a discount of -0.4 per unit on 2 units of milk, B a sale line of its own
+    assert small_index.sale_amounts(['C', 'B', 'A', 'unknown']) == pytest.approx([-0.8, -0.4, 0.0, 0.0])
+
+
+def test_shipped_discounted_receipt_has_non_zero_sale_amount():
+    index = ReceiptItemIndex.from_csv()
+    receipts = pd.read_csv(RECEIPTS_FILE, usecols=['id', 'receipt_id'])
+    items = pd.read_csv(PRODUCT_ITEMS_FILE, usecols=['quantity', 'fs_receipt_id', 'discount_id'])
+    prices = pd.read_csv(PRODUCTS_FILE, usecols=['id', 'price']).set_index('id')['price']
+
+    discounted = items[items['discount_id'].notna() & (items['fs_receipt_id'] == 1)]
+    expected = (prices.reindex(discounted['discount_id']).to_numpy() * discounted['quantity'].to_numpy()).sum()
+    receipt_id = receipts.loc[receipts['id'] == 1, 'receipt_id'].iloc[0]
+
+    assert expected < 0
+    assert index.sale_amounts([receipt_id])[0] == pytest.approx(expected)
+    assert (index.receipt_sale_amounts < 0).sum() > 0
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from ml_services.fake_ekasa_server import FakeEkasaServer
+from ml_services.receipt_fetcher import fetch_receipt_items_concurrently
+from ml_services.receipt_items import ReceiptItemStore
+from utils.metrics import CACHE_LOOKUPS, OUTBOUND_REQUEST_SECONDS
+
+RECEIPTS = {
+    f'O-{number}': [{'name': f'Product {number}', 'price': 1.5, 'quantity': number, 'itemType': 'K'}]
+    for number in range(1, 4)
+}
+
+
+@pytest.fixture
+def server():
+    with FakeEkasaServer(RECEIPTS) as fake_server:
+        yield fake_server
+
+
+def store_for(server, tmp_path, **kwargs):
+    return ReceiptItemStore(str(tmp_path / 'receipt_items.sqlite'),
+                            fetch_many=lambda ids: fetch_receipt_items_concurrently(ids, url=server.url), **kwargs)
+
+
+def lookups(result):
+    return CACHE_LOOKUPS.value(cache='receipt_items', result=result)
+
+
+def test_receipts_evicted_from_memory_are_read_from_disk(server, tmp_path):
+    store = store_for(server, tmp_path, memory_size=2)
+    assert store.get_many(['O-1', 'O-2', 'O-1']) == {'O-1': RECEIPTS['O-1'], 'O-2': RECEIPTS['O-2']}
+    assert server.request_count == 2
+
+    # O-1 was used least recently, so O-3 evicts it from memory
+    store.get('O-3')
+    memory, disk = lookups('memory'), lookups('disk')
+    assert store.get('O-2') == RECEIPTS['O-2']
+    assert store.get('O-1') == RECEIPTS['O-1']
+    assert (lookups('memory') - memory, lookups('disk') - disk) == (1, 1)
+
+    # Fetched receipts are kept forever, also by a new process reading the same file
+    assert store_for(server, tmp_path).get_many(RECEIPTS) == RECEIPTS
+    assert server.request_count == 3
+
+
+def test_failed_receipts_are_not_requested_again_until_the_negative_ttl_expires(server, tmp_path):
+    store = store_for(server, tmp_path, negative_ttl=0.3)
+    assert store.get('O-missing') == []
+    negative = lookups('negative')
+    assert store.get('O-missing') == []
+    assert lookups('negative') - negative == 1
+    assert server.requests_by_receipt['O-missing'] == 1
+
+    time.sleep(0.4)
+    assert store.get('O-missing') == []
+    assert server.requests_by_receipt['O-missing'] == 2
+
+
+def test_transient_errors_are_retried_with_backoff():
+    with FakeEkasaServer(RECEIPTS, failures=2) as server:
+        retried = OUTBOUND_REQUEST_SECONDS.count(service='ekasa', outcome='retried')
+        start = time.perf_counter()
+        items = fetch_receipt_items_concurrently(['O-1'], url=server.url, retries=2, backoff=0.05)
+        elapsed = time.perf_counter() - start
+
+        assert items == {'O-1': RECEIPTS['O-1']}
+        assert server.requests_by_receipt['O-1'] == 3
+        assert OUTBOUND_REQUEST_SECONDS.count(service='ekasa', outcome='retried') - retried == 2
+        # Waits of at least 0.05 and 0.1 seconds before the second and the third attempt
+        assert elapsed >= 0.15
+
+        # Out of retries the receipt could not be fetched
+        assert fetch_receipt_items_concurrently(['O-2'], url=server.url, retries=1, backoff=0.01) == {'O-2': None}
+        assert server.requests_by_receipt['O-2'] == 2
+
+
+def test_missing_receipts_are_not_retried(server):
+    assert fetch_receipt_items_concurrently(['O-missing'], url=server.url, retries=2, backoff=0.01) == \
+        {'O-missing': None}
+    assert server.requests_by_receipt['O-missing'] == 1
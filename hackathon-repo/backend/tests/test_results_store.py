@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from ml_services.results_store import ResultsStore, StoredResult
+
+
+def test_frames_keep_their_dtypes_through_the_durable_store(tmp_path):
+    frame = pd.DataFrame({
+        'product_name': ['milk', 'bread'],
+        'quantity': [2.0, 1.0],
+        'avg_other_users_spend': [10.0, np.nan],
+        'users': np.array([3, 4], dtype=np.int64),
+        'is_anomaly': [True, False],
+    })
+    db_path = str(tmp_path / 'results.db')
+    ResultsStore(db_path).put(12, '2024-10', 'v1', StoredResult('advice', {'anomalous_products': frame}))
+
+    # A new store has an empty memory tier, so the result comes from SQLite
+    stored = ResultsStore(db_path).get(12, '2024-10', 'v1')
+
+    assert stored.message == 'advice'
+    pd.testing.assert_frame_equal(stored.frame('anomalous_products'), frame)
+
+
+def test_results_of_other_dataset_versions_are_not_returned(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    store.put(12, '2024-10', 'v1', StoredResult(None))
+
+    assert store.get(12, '2024-10', 'v2') is None
+    assert store.delete_other_versions('v2') == 1
+    assert store.get(12, '2024-10', 'v1') is None
+
+
+def test_results_of_users_with_new_receipts_are_kept_with_their_snapshot(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    store.put(12, '2024-10', 'v1', StoredResult(None))
+    store.put(12, '2024-10', 'v2', StoredResult(None))
+    store.put(13, '2024-10', 'v2/7', StoredResult(None))
+    store.put(14, '2024-10', 'v2', StoredResult(None))
+
+    assert store.delete_other_versions('v2') == 1
+    assert store.get(13, '2024-10', 'v2/7') is not None
+
+    # A new receipt of user 12 makes the user's results of the snapshot itself stale
+    assert store.delete_user_versions(12, 'v2/9') == 1
+    assert store.get(12, '2024-10', 'v2') is None
+    assert store.get(14, '2024-10', 'v2') is not None
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+from ml_services.receipt_item_index import ReceiptItemIndex
+from ml_services.savings_engine import build_savings_table
+
+
+@pytest.fixture
+def savings():
+    receipts_index = pd.DataFrame({'id': [1, 2, 3], 'receipt_id': ['A', 'B', 'C']})
+    products = pd.DataFrame({'id': [1, 2], 'name': ['cheese', 'ZLAVA'], 'item_type': ['K', 'Z'],
+                             'price': [2.0, -0.5], 'category': ['dairy/cheese', 'discount']})
+    items = pd.DataFrame({'quantity': [3, 1, 1], 'product_id': [1, 1, 1], 'fs_receipt_id': [1, 2, 3],
+                          'discount_id': [2, 2, np.nan]})
+    index = ReceiptItemIndex(receipts_index, items, products)
+
+    receipts = pd.DataFrame({
+        'customer_id': [7, 7, 7, 8],
+        'create_date': pd.to_datetime(['2024-09-03', '2024-10-05', '2024-10-20', '2024-10-01']),
+        'category': ['Food/Dairy', 'Food/Dairy', 'Food/Dairy', 'Food/Dairy'],
+        'receipt_id': ['A', 'B', 'C', 'A'],
+    })
+    return build_savings_table(receipts, index)
+
+
+def test_sale_amounts_are_summed_per_user_category_and_month(savings):
+    assert savings.savings_per_category(7, (2024, 10), (2024, 10)) == pytest.approx({'Food/Dairy': -0.5})
+    assert savings.savings_per_category(7, (2024, 1), (2024, 12)) == pytest.approx({'Food/Dairy': -2.0})
+    assert savings.savings_per_category(8, (2024, 10), (2024, 10)) == pytest.approx({'Food/Dairy': -1.5})
+    assert savings.savings_per_category(9, (2024, 1), (2024, 12)) == {}
+
+
+def test_last_period(savings):
+    assert savings.last_period(7) == (2024, 10)
+    assert savings.last_period() == (2024, 10)
+    assert savings.last_period(9) is None
+
+
+def test_discounted_categories_endpoint_defaults_to_the_users_latest_month():
+    import main
+
+    client = TestClient(main.app)
+    response = client.get('/get_discounted_categories', params={'user_id': 2})
+    assert response.status_code == 200
+    body = response.json()
+    assert body['start'] == body['end']
+
+    whole_year = client.get('/get_discounted_categories', params={'user_id': 2, 'year': 2024}).json()
+    assert (whole_year['start']['month'], whole_year['end']['month']) == (1, 12)
+    assert any(amount < 0 for amount in whole_year['discounted_categories'].values())
@@ -0,0 +1,80 @@
+import gc
+import weakref
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_services.advice_engine import build_snapshot, derived_tables, load_snapshot, SNAPSHOT_COLUMNS
+from ml_services.cohort_scoring import get_cohort_scores
+from ml_services.shared_snapshot import Derived, SharedDataset, attach, attach_tables, publish
+from ml_services.spending_cube import get_spending_cube
+from ml_services.spending_percentiles import get_spending_percentiles
+
+
+@pytest.fixture(scope='module')
+def data():
+    return load_snapshot().data[SNAPSHOT_COLUMNS]
+
+
+def test_tables_are_published_with_the_snapshot(data, tmp_path):
+    tables = derived_tables(data)
+    publish(data, 'v1', str(tmp_path), tables=tables)
+
+    attached = attach_tables('v1', str(tmp_path))
+    assert sorted(attached) == sorted(tables)
+    for name, table in tables.items():
+        pd.testing.assert_frame_equal(attached[name], table, check_dtype=False, check_categorical=False)
+    # Object columns come back dictionary-encoded and memory-mapped
+    assert isinstance(attached['cube_pairs']['primary_category'].dtype, pd.CategoricalDtype)
+    assert not attached['cube_cells']['total'].to_numpy().flags.owndata
+    pd.testing.assert_frame_equal(attach('v1', str(tmp_path), 'cube_users'), tables['cube_users'])
+
+
+def test_attached_snapshot_uses_published_cube_and_percentiles(data, tmp_path):
+    publish(data, 'v1', str(tmp_path), tables=derived_tables(data))
+    attached = build_snapshot(attach('v1', str(tmp_path)), 'v1', attach_tables('v1', str(tmp_path)))
+    built = build_snapshot(data, 'v1')
+
+    attached_cube, built_cube = get_spending_cube(attached), get_spending_cube(built)
+    assert not attached_cube.total.flags.owndata
+    for a, b in zip(attached_cube.window((2024, 1), (2024, 10)), built_cube.window((2024, 1), (2024, 10))):
+        np.testing.assert_array_equal(a, b)
+    assert attached_cube.last_period == built_cube.last_period
+
+    period = built_cube.last_period
+    for user_id in sorted(built.customer_ids)[:10]:
+        pd.testing.assert_frame_equal(get_spending_percentiles(attached).compare(user_id, period),
+                                      get_spending_percentiles(built).compare(user_id, period))
+        pd.testing.assert_frame_equal(get_cohort_scores(attached, period[0], 10).for_user(user_id),
+                                      get_cohort_scores(built, period[0], 10).for_user(user_id))
+
+
+def test_derived_values_are_released_with_the_snapshot(data, tmp_path):
+    root = str(tmp_path)
+    publish(data, 'v1', root)
+    dataset = SharedDataset(build=build_snapshot, fallback=lambda: None, root=root, check_interval=0)
+    first = dataset.get()
+    cube = weakref.ref(get_spending_cube(first))
+    assert get_spending_cube(first) is cube()
+
+    publish(data.iloc[:100], 'v2', root)
+    second = dataset.get()
+    assert second.version == 'v2'
+    del first
+    gc.collect()
+    assert cube() is None
+    assert get_spending_cube(second).count.sum() == data.iloc[:100]['issue_date'].notna().sum()
+
+
+def test_derived_provider_follows_the_dataset_version(data, tmp_path):
+    root = str(tmp_path)
+    publish(data, 'v1', root)
+    dataset = SharedDataset(build=lambda frame, version, tables: frame, fallback=lambda: None, root=root,
+                            check_interval=0)
+    sizes = Derived(dataset, len)
+    assert sizes.get() == len(data)
+    assert sizes.get() == len(data)
+
+    publish(data.iloc[:100], 'v2', root)
+    assert sizes.get() == 100
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_services.spending_cube import build_spending_cube
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    size = 500
+    categories = np.array(['Food', 'Food', 'Home', 'Transport'])
+    subcategories = np.array(['Dairy', 'Unknown', 'Garden', 'Fuel'])
+    pairs = rng.integers(0, len(categories), size)
+    return pd.DataFrame({
+        'customer_id': rng.choice([3, 5, 8, 13, 21], size),
+        'primary_category': categories[pairs],
+        'subcategory': subcategories[pairs],
+        'total_price': rng.uniform(1, 50, size).round(2),
+        'issue_date': pd.Timestamp('2023-11-01') + pd.to_timedelta(rng.integers(0, 365, size), unit='D'),
+    })
+
+
+def reference_window(data, start, end, keys):
+    ordinals = data['issue_date'].dt.year * 12 + data['issue_date'].dt.month - 1
+    window = data[(ordinals >= start[0] * 12 + start[1] - 1) & (ordinals <= end[0] * 12 + end[1] - 1)]
+    return window.groupby(['customer_id', *keys])['total_price'].agg(['sum', 'size', lambda v: (v ** 2).sum()])
+
+
+def test_cube_stores_only_occupied_cells(data):
+    cube = build_spending_cube(data)
+    ordinals = data['issue_date'].dt.year * 12 + data['issue_date'].dt.month - 1
+    occupied = data.assign(ordinal=ordinals).groupby(['customer_id', 'primary_category', 'subcategory', 'ordinal'])
+
+    assert len(cube.total) == occupied.ngroups
+    assert cube.count.sum() == len(data)
+    assert cube.user_offsets[-1] == len(cube.total)
+    assert cube.last_period == (2024, 10)
+
+
+@pytest.mark.parametrize('start, end', [((2024, 1), (2024, 6)), ((2020, 1), (2030, 12)), ((2024, 3), (2024, 3))])
+@pytest.mark.parametrize('level, keys', [('subcategory', ['primary_category', 'subcategory']),
+                                         ('primary_category', ['primary_category'])])
+def test_window_matches_grouped_rows(data, start, end, level, keys):
+    cube = build_spending_cube(data)
+    total, count, sum_of_squares = cube.window(start, end, level)
+    expected = reference_window(data, start, end, keys)
+
+    assert total.shape == (len(cube.users), len(cube._labels(level)))
+    frame = cube.window_frame(start, end, level).set_index(['customer_id', *keys])
+    assert frame['total_spent'].to_numpy() == pytest.approx(expected['sum'].to_numpy())
+    assert frame['item_count'].to_numpy().tolist() == expected['size'].tolist()
+    assert total.sum() == pytest.approx(expected['sum'].sum())
+    assert sum_of_squares.sum() == pytest.approx(expected.iloc[:, 2].sum())
+    assert count.sum() == expected['size'].sum()
+
+
+def test_user_views(data):
+    cube = build_spending_cube(data)
+    user_frame = cube.window_frame((2024, 1), (2024, 6), user_id=8)
+    all_frame = cube.window_frame((2024, 1), (2024, 6))
+    pd.testing.assert_frame_equal(user_frame, all_frame[all_frame['customer_id'] == 8].reset_index(drop=True))
+
+    monthly = cube.monthly_totals(8)
+    user_rows = data[data['customer_id'] == 8]
+    expected = user_rows.groupby([user_rows['issue_date'].dt.year, user_rows['issue_date'].dt.month,
+                                  'primary_category'])['total_price'].sum()
+    assert monthly['total_spent'].to_numpy() == pytest.approx(expected.to_numpy())
+    assert monthly[['year', 'month']].to_numpy().tolist() == [list(key[:2]) for key in expected.index]
+
+    assert cube.window_frame((2024, 1), (2024, 6), user_id=4).empty
+    assert cube.monthly_totals(4).empty
+
+
+@pytest.mark.parametrize('level, keys', [('subcategory', ['primary_category', 'subcategory']),
+                                         ('primary_category', ['primary_category'])])
+def test_compare_windows_matches_grouped_rows(data, level, keys):
+    cube = build_spending_cube(data)
+    # The last 3 months up to October 2024 against the 12 months before them
+    recent = reference_window(data, (2024, 8), (2024, 10), keys)['sum'] / 3
+    prior = reference_window(data, (2023, 8), (2024, 7), keys)['sum'] / 12
+    expected = pd.concat([recent.rename('recent'), prior.rename('prior')], axis=1).fillna(0.0).sort_index()
+
+    comparison = cube.compare_windows((2024, 10), level=level).set_index(['customer_id', *keys])
+    assert comparison.index.tolist() == expected.index.tolist()
+    assert comparison['recent_monthly_spent'].to_numpy() == pytest.approx(expected['recent'].to_numpy())
+    assert comparison['prior_monthly_spent'].to_numpy() == pytest.approx(expected['prior'].to_numpy())
+    change = np.where(expected['prior'] > 0, expected['recent'] / expected['prior'] - 1, np.nan)
+    assert comparison['change_ratio'].to_numpy() == pytest.approx(change, nan_ok=True)
+
+    user = cube.compare_windows((2024, 10), level=level, user_id=8)
+    pd.testing.assert_frame_equal(user, comparison.loc[[8]].reset_index())
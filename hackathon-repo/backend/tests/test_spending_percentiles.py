@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_services.spending_cube import build_spending_cube
+from ml_services.spending_percentiles import SpendingPercentiles, build_spending_percentiles
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(1)
+    size = 800
+    categories = np.array(['Food', 'Food', 'Home', 'Transport'])
+    subcategories = np.array(['Dairy', 'Unknown', 'Garden', 'Fuel'])
+    pairs = rng.integers(0, len(categories), size)
+    return pd.DataFrame({
+        'customer_id': rng.integers(1, 40, size),
+        'primary_category': categories[pairs],
+        'subcategory': subcategories[pairs],
+        'total_price': rng.integers(1, 20, size).astype(float),
+        'issue_date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 120, size), unit='D'),
+    })
+
+
+def reference(data, user_id, period):
+    month = data[(data['issue_date'].dt.year == period[0]) & (data['issue_date'].dt.month == period[1])]
+    subcategories = month[month['subcategory'] != 'Unknown'].groupby(
+        ['primary_category', 'subcategory', 'customer_id'])['total_price'].sum()
+    categories = month.groupby(['primary_category', 'customer_id'])['total_price'].sum()
+    categories.index = pd.MultiIndex.from_arrays([categories.index.get_level_values(0), [''] * len(categories),
+                                                  categories.index.get_level_values(1)])
+    spends = pd.concat([subcategories, categories]).rename_axis(['primary_category', 'subcategory', 'customer_id'])
+
+    rows = []
+    for (primary_category, subcategory), group in spends.groupby(level=[0, 1], sort=False):
+        if user_id in group.index.get_level_values(2):
+            spend = group.xs(user_id, level=2).iloc[0]
+            rows.append((primary_category, subcategory, spend,
+                         100.0 * ((group < spend).sum() + 0.5 * (group == spend).sum()) / len(group),
+                         len(group), group.median()))
+    return pd.DataFrame(rows, columns=['primary_category', 'subcategory', 'total_spent', 'percentile', 'users',
+                                       'median_spent']).sort_values(['subcategory', 'primary_category'])
+
+
+def test_percentiles_match_ranks_of_grouped_rows(data):
+    percentiles = build_spending_percentiles(build_spending_cube(data))
+    for user_id in (1, 7, 22):
+        for period in ((2024, 1), (2024, 3)):
+            result = percentiles.compare(user_id, period)
+            expected = reference(data, user_id, period)
+            result = result.sort_values(['subcategory', 'primary_category'])
+            assert len(result) == len(expected) > 0
+            pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True),
+                                          check_dtype=False)
+
+
+def test_unknown_users_and_periods(data):
+    percentiles = build_spending_percentiles(build_spending_cube(data))
+    assert percentiles.compare(1000, (2024, 1)).empty
+    assert percentiles.compare(1, (2023, 1)).empty
+
+
+def test_percentiles_keep_no_dense_arrays(data):
+    cube = build_spending_cube(data)
+    percentiles = build_spending_percentiles(cube)
+    assert not any(isinstance(getattr(percentiles, name), type(cube)) for name in SpendingPercentiles.__dataclass_fields__)
+    assert all(getattr(percentiles, name).ndim == 1 for name in ('cell_spend', 'values', 'groups'))
+    assert len(percentiles.values) <= 2 * len(cube.total)
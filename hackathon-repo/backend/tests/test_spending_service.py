@@ -0,0 +1,96 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from ml_services.advice_engine import SPENDING_DATA_FILE, build_snapshot
+from ml_services.cohort_scoring import SCORE_COLUMNS, get_cohort_scores
+from ml_services.dataset_store import append_rows, read_dataset
+from ml_services.receipt_journal import ReceiptJournal
+from repositories.spending_repository import create_spending_tables, load_spending_data
+from services.spending_service import add_receipt, get_user_spending_scores, resolve_year
+from utils.database import async_engine
+
+
+def test_sql_scores_match_the_cohort_scores():
+    data = read_dataset(SPENDING_DATA_FILE)
+    snapshot = build_snapshot(data, 'test')
+    users = sorted(snapshot.customer_ids)
+
+    async def load_and_score():
+        try:
+            await create_spending_tables(drop=True)
+            await load_spending_data(data)
+            year = await resolve_year()
+            return year, {(user_id, month): await get_user_spending_scores(user_id, month, year)
+                          for user_id in users for month in (1, 6, 10, 12)}
+        finally:
+            # The connections belong to this event loop
+            await async_engine.dispose()
+
+    year, sql_scores = asyncio.run(load_and_score())
+    assert year == data['issue_date'].dt.year.max()
+
+    compared = 0
+    for (user_id, month), sql in sql_scores.items():
+        expected = get_cohort_scores(snapshot, year, month).for_user(user_id)
+        assert len(sql) == len(expected)
+        if expected.empty:
+            continue
+
+        keys = ['primary_category', 'subcategory']
+        sql = sql.sort_values(keys).reset_index(drop=True)
+        expected = expected.sort_values(keys).reset_index(drop=True)
+        assert sql[keys].astype(str).values.tolist() == expected[keys].astype(str).values.tolist()
+        for column in SCORE_COLUMNS[3:12]:
+            assert sql[column].to_numpy(dtype=float) == pytest.approx(expected[column].to_numpy(dtype=float),
+                                                                      nan_ok=True), (user_id, month, column)
+        assert sql['anomaly_level'].tolist() == expected['anomaly_level'].tolist()
+        assert sql['is_anomaly'].tolist() == expected['is_anomaly'].tolist()
+        compared += 1
+
+    assert compared > 100
+
+
+def test_added_receipts_give_the_scores_of_a_full_load(tmp_path):
+    data = read_dataset(SPENDING_DATA_FILE)
+    journal = ReceiptJournal(str(tmp_path / 'ingested_receipts.sqlite'))
+    year = int(data['issue_date'].dt.year.max())
+    items = [
+        {'category_item': 'Stravovanie/Potraviny', 'total_price': 480.5},
+        {'category_item': 'Bývanie a energie/null', 'total_price': 35.0},
+    ]
+    for receipt_id, user_id, month in [('TEST-RECEIPT-1', 12, 5), ('TEST-RECEIPT-2', 999999, 5),
+                                       ('TEST-RECEIPT-3', 12, 11)]:
+        journal.append(receipt_id, user_id, datetime(year, month, 14, 12, 30), items)
+    users = [12, 13, 999999]
+
+    async def scores():
+        return {(user_id, month): await get_user_spending_scores(user_id, month, year)
+                for user_id in users for month in (4, 5, 10, 12)}
+
+    async def add_then_load():
+        try:
+            await create_spending_tables(drop=True)
+            await load_spending_data(data)
+            for position in range(1, 4):
+                assert await add_receipt(journal.read(after=position - 1, until=position))
+            # A receipt already in the tables is not added twice
+            assert not await add_receipt(journal.read(after=0, until=1))
+            added = await scores()
+
+            await create_spending_tables(drop=True)
+            await load_spending_data(append_rows(data, journal.read()))
+            return added, await scores()
+        finally:
+            await async_engine.dispose()
+
+    added, loaded = asyncio.run(add_then_load())
+    for key, expected in loaded.items():
+        assert not expected.empty or key[0] == 999999
+        result = added[key]
+        assert result[['primary_category', 'subcategory']].values.tolist() == \
+            expected[['primary_category', 'subcategory']].values.tolist(), key
+        for column in SCORE_COLUMNS[3:12]:
+            assert result[column].to_numpy(dtype=float) == pytest.approx(expected[column].to_numpy(dtype=float),
+                                                                         nan_ok=True), (key, column)
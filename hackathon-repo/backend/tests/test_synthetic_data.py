@@ -0,0 +1,19 @@
+import os
+
+import pandas as pd
+
+from ml_services.synthetic_data import GeneratorConfig, generate
+from utils.environment_variables import DATA_DIR
+
+
+def test_spending_rows_use_the_product_category_hierarchy(tmp_path):
+    generate(GeneratorConfig(users=20, receipts=300, chunk_size=120), str(tmp_path))
+
+    spending = pd.read_csv(tmp_path / 'Merged_Spending_Data.csv')
+    items = pd.read_csv(tmp_path / 'ProductItems.csv')
+    categories = pd.read_csv(os.path.join(DATA_DIR, 'ProductCategories.csv'))
+    first_categories = categories.sort_values('id').drop_duplicates('product_id').set_index('product_id')['category']
+
+    # Spending rows are written in item order, so row i is the item i
+    assert len(spending) == len(items)
+    assert (spending['category_item'].to_numpy() == first_categories.reindex(items['product_id']).to_numpy()).all()
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ml_services.advice_engine import load_snapshot
+from ml_services.receipt_item_index import receipt_item_index
+from ml_services.time_series_analyzer import (find_product_anomalies, product_history_stats, product_purchases,
+                                              score_purchases, top_anomalies_per_user)
+
+
+def per_user_anomalies(purchases, year, month):
+    """
+    The product anomalies computed user by user, the way SpendingAnalyzer does for one user.
+    """
+    periods = list(zip(purchases['issue_date'].dt.year, purchases['issue_date'].dt.month))
+    before = pd.Series([period < (year, month) for period in periods], index=purchases.index)
+    target = pd.Series([period == (year, month) for period in periods], index=purchases.index)
+
+    frames = []
+    for user_id in sorted(purchases['customer_id'].unique()):
+        user = purchases['customer_id'] == user_id
+        history = purchases[user & before]
+        if history.empty or not (user & target).any():
+            continue
+        scored = score_purchases(purchases[user & target], product_history_stats(history))
+        frames.append(top_anomalies_per_user(scored))
+    return pd.concat(frames, ignore_index=True)
+
+
+def assert_same_anomalies(result, expected):
+    assert len(result) > 0
+    assert result['customer_id'].tolist() == expected['customer_id'].tolist()
+    assert result['product_name'].tolist() == expected['product_name'].tolist()
+    assert result['quantity_z_score'].to_numpy() == pytest.approx(expected['quantity_z_score'].to_numpy())
+    assert result['message'].tolist() == expected['message'].tolist()
+
+
+def test_earlier_years_are_history_of_the_target_month():
+    rng = np.random.default_rng(0)
+    size = 400
+    purchases = pd.DataFrame({
+        'customer_id': rng.choice([1, 2, 3], size),
+        'receipt_id': [f'R{i}' for i in range(size)],
+        'product_name': rng.choice(['Milk', 'Bread', 'Apples', 'Coffee', 'Rice'], size),
+        'quantity': rng.integers(1, 4, size).astype(float),
+        'total_price': rng.uniform(1, 10, size).round(2),
+        'issue_date': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 670, size), unit='D'),
+    })
+    # Bought in October of the year before only, so it is history and not a new product
+    purchases.loc[len(purchases)] = [1, 'R-OLD', 'Tea', 1.0, 3.5, pd.Timestamp('2023-10-05')]
+    purchases.loc[len(purchases)] = [1, 'R-NEW', 'Tea', 1.0, 3.5, pd.Timestamp('2024-10-05')]
+    # Only bought in the target month, so without history
+    purchases.loc[len(purchases)] = [4, 'R-4', 'Tea', 1.0, 3.5, pd.Timestamp('2024-10-06')]
+
+    result = find_product_anomalies(purchases, 2024, 10)
+    assert_same_anomalies(result, per_user_anomalies(purchases, 2024, 10))
+    assert 4 not in result['customer_id'].tolist()
+    assert not result[result['product_name'] == 'Tea']['is_new_product'].any()
+    # A purchase of October 2023 is not a purchase of the target month
+    assert (result['issue_date'].dt.year == 2024).all()
+
+
+def test_purchases_of_the_shipped_data_match_the_per_user_loop():
+    purchases = product_purchases(load_snapshot().data, receipt_item_index.get())
+    assert {'customer_id', 'product_name', 'quantity', 'primary_category'} <= set(purchases.columns)
+
+    assert_same_anomalies(find_product_anomalies(purchases, 2024, 10), per_user_anomalies(purchases, 2024, 10))
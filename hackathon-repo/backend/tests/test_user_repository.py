@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from cachetools import TTLCache
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from controllers import user_controller
+from models.user_model import UserModel
+from repositories import user_repository
+from utils.database import Base, async_engine, async_session
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(user_repository, 'user_cache', TTLCache(maxsize=100, ttl=60, timer=clock))
+    return clock
+
+
+def run_with_users(test):
+    """
+    Runs `test` on a users table holding users 1 to 3, in one event loop, as the connections
+    belong to it.
+    """
+    async def run():
+        try:
+            async with async_engine.begin() as connection:
+                await connection.run_sync(Base.metadata.drop_all, tables=[UserModel.__table__])
+                await connection.run_sync(Base.metadata.create_all, tables=[UserModel.__table__])
+            async with async_session() as session:
+                async with session.begin():
+                    session.add_all(UserModel(id=user_id, username=f'user{user_id}', monthly_spend=100 * user_id)
+                                    for user_id in (1, 2, 3))
+            return await test()
+        finally:
+            await async_engine.dispose()
+
+    return asyncio.run(run())
+
+
+async def update_outside_of_the_orm(user_id: int, username: str) -> None:
+    async with async_engine.begin() as connection:
+        await connection.execute(text("UPDATE users SET username = :username WHERE id = :id"),
+                                 {'username': username, 'id': user_id})
+
+
+def test_cached_users_expire_after_the_ttl(clock):
+    async def test():
+        users = await user_repository.get_users_by_ids([3, 1, 99, 1])
+        assert list(users) == [3, 1]
+
+        await update_outside_of_the_orm(1, 'renamed')
+        assert (await user_repository.get_user_by_id(1)).username == 'user1'
+        clock.now += 61
+        assert (await user_repository.get_user_by_id(1)).username == 'renamed'
+
+    run_with_users(test)
+
+
+def test_writes_through_the_orm_invalidate_cached_users(clock):
+    async def test():
+        assert (await user_repository.get_user_by_id(2)).username == 'user2'
+        async with async_session() as session:
+            async with session.begin():
+                (await session.get(UserModel, 2)).username = 'renamed'
+        assert (await user_repository.get_user_by_id(2)).username == 'renamed'
+
+        async with async_session() as session:
+            async with session.begin():
+                await session.delete(await session.get(UserModel, 2))
+        assert await user_repository.get_user_by_id(2) is None
+
+    run_with_users(test)
+
+
+def test_users_endpoint_returns_the_found_and_the_missing_ids(clock):
+    async def test():
+        response = await user_controller.get_users(['3,1', '99', '1'])
+        assert [user.id for user in response['users']] == [3, 1]
+        assert response['missing'] == [99]
+
+    run_with_users(test)
+
+    with pytest.raises(HTTPException) as error:
+        user_controller.parse_user_ids(['1,x'])
+    assert error.value.status_code == 422
+    with pytest.raises(HTTPException) as error:
+        user_controller.parse_user_ids([','.join(map(str, range(user_controller.MAX_USER_IDS + 1)))])
+    assert error.value.status_code == 422
@@ -1,14 +1,33 @@
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from utils.environment_variables import DATABASE_URL
+from utils.environment_variables import (DATABASE_URL, DATABASE_ECHO, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW,
+                                         DATABASE_POOL_TIMEOUT, DATABASE_POOL_RECYCLE)
 
-async_engine = create_async_engine(
-    url = DATABASE_URL,
-    echo=True,
-)
 
-async_session = async_sessionmaker(async_engine)
+def engine_options(url: str) -> dict:
+    """
+    Keyword arguments of the engine. The pool settings only apply to server databases, SQLite
+    (used for local runs) keeps the pool SQLAlchemy picks for it.
+    """
+    options = {'echo': DATABASE_ECHO}
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update(
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_timeout=DATABASE_POOL_TIMEOUT,
+            # Replace connections before the server or a proxy drops them as idle
+            pool_recycle=DATABASE_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+    return options
+
+
+async_engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+
+# Objects stay readable after the commit, as lazy refreshes are not possible with asyncio
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
 
 # async def db_check():
 #     async with async_session() as session:
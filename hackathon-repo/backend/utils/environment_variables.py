@@ -5,4 +5,29 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 ALPHAVANTAGE_API_KEY = os.getenv("ALPHAVANTAGE_API_KEY")
+ALPHAVANTAGE_REQUESTS_PER_MINUTE = float(os.getenv("ALPHAVANTAGE_REQUESTS_PER_MINUTE", "5"))
 
+DATA_DIR = os.getenv("DATA_DIR", "ml_services/data")
+# Load the datasets when the API starts instead of on the first request that needs them
+PRELOAD_DATA = os.getenv("PRELOAD_DATA", "true").lower() in ("1", "true", "yes")
+# Published read-only snapshots shared by all worker processes, see ml_services/shared_snapshot.py
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(DATA_DIR, "snapshots"))
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", "5"))
+EKASA_RECEIPT_URL = os.getenv("EKASA_RECEIPT_URL", "https://ekasa.financnasprava.sk/mdu/api/v1/opd/receipt/find")
+RECEIPT_ITEMS_DB = os.getenv("RECEIPT_ITEMS_DB", "ml_services/data/cache/receipt_items.sqlite")
+RESULTS_DB = os.getenv("RESULTS_DB", "ml_services/data/cache/results.sqlite")
+# Receipts posted to the API; unlike the caches this is the only copy of them
+INGESTED_RECEIPTS_DB = os.getenv("INGESTED_RECEIPTS_DB", os.path.join(DATA_DIR, "ingested_receipts.sqlite"))
+
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "false").lower() in ("1", "true", "yes")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "10"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "20"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Processes running the advice analysis; 0 runs it in threads of the API process instead
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Analyses allowed to wait for a worker before requests are rejected with 503
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", "32"))
@@ -0,0 +1,27 @@
+import argparse
+import asyncio
+import os
+
+from ml_services.dataset_store import append_rows, read_dataset
+from ml_services.receipt_journal import receipt_journal
+from repositories.spending_repository import create_spending_tables, load_spending_data
+from utils.environment_variables import DATA_DIR
+
+
+async def init_spending(csv_path: str):
+    data = read_dataset(csv_path)
+    # The receipts ingested through the API, as the advice snapshot holds them too
+    ingested = receipt_journal.get().read()
+    if not ingested.empty:
+        data = append_rows(data, ingested)
+
+    await create_spending_tables(drop=True)
+    await load_spending_data(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the spending data into the database and build the summaries.")
+    parser.add_argument('csv_path', nargs='?', default=os.path.join(DATA_DIR, 'Merged_Spending_Data.csv'))
+    arguments = parser.parse_args()
+
+    asyncio.run(init_spending(arguments.csv_path))
@@ -0,0 +1,40 @@
+import threading
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar('T')
+
+_MISSING = object()
+
+
+class Lazy(Generic[T]):
+    """
+    A value created by `factory` on first use, once, even when many threads ask for it at the
+    same time. Module-level datasets are wrapped in it so that importing a module stays cheap;
+    the API loads them up front in its startup hook.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self.factory = factory
+        self._value = _MISSING
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._value is not _MISSING
+
+    def get(self) -> T:
+        value = self._value
+        if value is _MISSING:
+            with self._lock:
+                # Another thread may have created it while this one waited for the lock
+                value = self._value
+                if value is _MISSING:
+                    value = self._value = self.factory()
+        return value
+
+    def reset(self) -> None:
+        """
+        Drops the value, the next `get` creates it again.
+        """
+        with self._lock:
+            self._value = _MISSING
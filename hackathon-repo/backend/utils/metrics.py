@@ -0,0 +1,263 @@
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Upper bounds (in seconds) of the histogram buckets, from 1 ms to 30 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics: List['Metric'] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'Metric') -> None:
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics.append(metric)
+
+    def expose(self) -> str:
+        """
+        Current values of all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def drain(self) -> Dict[str, dict]:
+        """
+        The values recorded since the last drain, by metric name, and resets them. A worker
+        process sends these to the API process, which merges them into its own registry.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        drained = {metric.name: metric.drain() for metric in metrics}
+        return {name: values for name, values in drained.items() if values}
+
+    def merge(self, drained: Dict[str, dict]) -> None:
+        """
+        Adds values drained from the registry of another process.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            if metric.name in drained:
+                metric.merge(drained[metric.name])
+
+
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    """
+    Base of the metric types. Values are kept per combination of label values and updated
+    under a lock, so recording is a dictionary lookup and an addition; nothing is computed
+    until the metrics are scraped.
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 registry: Optional[MetricsRegistry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def drain(self) -> dict:
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict) -> None:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def merge(self, values: dict) -> None:
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0.0) + value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: Optional[MetricsRegistry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        # Index of the first bucket the value fits in, len(buckets) for the +Inf bucket
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bucket] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the `with` block, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[2] if state is not None else 0
+
+    def merge(self, values: dict) -> None:
+        with self._lock:
+            for key, (bucket_counts, total, count) in values.items():
+                state = self._values.get(key)
+                if state is None:
+                    state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                state[0] = [mine + theirs for mine, theirs in zip(state[0], bucket_counts)]
+                state[1] += total
+                state[2] += count
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([*state[0]], state[1], state[2]) for key, state in self._values.items()}
+
+        for key, (bucket_counts, total, count) in sorted(values.items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for upper_bound, bucket_count in zip((*self.buckets, float('inf')), bucket_counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', {**labels, 'le': _format_value(upper_bound)}, cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator observing the duration of every call of a function or coroutine function.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def instrument_stages(*method_names: str):
+    """
+    Class decorator timing the given methods in ANALYSIS_STAGE_SECONDS, labelled with the method
+    name and the module-qualified class name (several modules define a UserTransactionAnalyzer).
+    """
+    def decorator(cls):
+        analyzer = f"{cls.__module__.rsplit('.', 1)[-1]}.{cls.__name__}"
+        for method_name in method_names:
+            method = inspect.getattr_static(cls, method_name)
+            wrap = timed(ANALYSIS_STAGE_SECONDS, analyzer=analyzer, stage=method_name)
+            if isinstance(method, staticmethod):
+                setattr(cls, method_name, staticmethod(wrap(method.__func__)))
+            else:
+                setattr(cls, method_name, wrap(method))
+        return cls
+
+    return decorator
+
+
+ANALYSIS_STAGE_SECONDS = Histogram(
+    'analysis_stage_duration_seconds', 'Duration of the steps of the spending analysis.', ('analyzer', 'stage')
+)
+OUTBOUND_REQUEST_SECONDS = Histogram(
+    'outbound_request_duration_seconds', 'Duration of HTTP calls to external services by outcome.',
+    ('service', 'outcome')
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Cache lookups by cache and result (memory, disk, negative or miss).', ('cache', 'result')
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Duration of the requests handled by the API.', ('method', 'route', 'status')
+)
+ANALYSIS_POOL_REQUESTS = Counter(
+    'analysis_pool_requests_total', 'Analyses by outcome: submitted to the pool, coalesced with a running one or '
+    'rejected because the pool was saturated.', ('task', 'result')
+)